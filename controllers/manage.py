@@ -2,6 +2,9 @@ from itertools import groupby
 import csv
 import io
 
+# Number of uploaded students inserted in each batch by load_students
+LOAD_CHUNK_SIZE = 500
+
 
 @auth.requires(
     auth.has_membership(auth.id_group("admin"))
@@ -123,9 +126,12 @@ def load_students():
         return ", ".join(lst)
 
     if form.accepts(request.vars):
-        # get the data from the request, converting from uploaded bytes into StringIO
-        data = io.StringIO(request.vars.myfile.value.decode("UTF-8-SIG"))
-        data = csv.DictReader(data)
+        # Stream the uploaded file as text rather than reading it all into memory
+        upload = request.vars.myfile.file
+        upload.seek(0)
+        data = csv.DictReader(
+            io.TextIOWrapper(upload, encoding="UTF-8-SIG", newline="")
+        )
 
         # create an html upload report as the function runs
         html = ""
@@ -155,78 +161,151 @@ def load_students():
             # Nothing is likely to work from this point, so bail early
             return dict(form=form, html=html, known_courses=known_courses)
 
-        # extract the contents into a big list of dictionaries to work with
-        # rather than having an iterator that runs through once
-        data = [row for row in data]
+        # The rows are validated as they are read, only keeping the problems found,
+        # and valid rows are inserted in chunks. The whole upload is rolled back if
+        # any problems are found, so the report can be built once the file is read.
+        problems = dict(
+            blank=0,
+            unknown_courses=set(),
+            bad_emails=set(),
+            bad_cids=set(),
+            existing_cids=set(),
+            bad_names=False,
+        )
 
-        # Look for blank rows (all empty strings)
-        blank = ["".join(row.values()) == "" for row in data]
+        def _validated_rows(rows):
+            """Yields the non-blank rows, recording problems along the way"""
 
-        if sum(blank):
-            html = CAT(
-                html,
-                H4("Blank lines"),
-                P(f"The input file contains {sum(blank)} blank rows."),
+            for row in rows:
+                # Look for blank rows (all empty strings)
+                if "".join(row.values()) == "":
+                    problems["blank"] += 1
+                    continue
+
+                valid = True
+
+                # - courses are recognized?
+                if row["course"] not in course_map:
+                    problems["unknown_courses"].add(row["course"])
+                    valid = False
+
+                # bad student emails
+                if IS_EMAIL()(row["student_email"])[1] is not None:
+                    problems["bad_emails"].add(row["student_email"])
+                    valid = False
+
+                # non numeric CID
+                if not row["student_cid"].isdigit():
+                    problems["bad_cids"].add(row["student_cid"])
+                    valid = False
+
+                # empty names or just whitespace
+                for name in (row["student_first_name"], row["student_last_name"]):
+                    if name.isspace() or name == "":
+                        problems["bad_names"] = True
+                        valid = False
+
+                yield row, valid
+
+        def _insert_chunk(chunk):
+            """Inserts a chunk of rows and their active student presentations"""
+
+            # pre-existing CIDs, only looking up the CIDs in this chunk
+            cids = [int(row["student_cid"]) for row in chunk]
+            existing_cids = db(db.students.student_cid.belongs(cids)).select(
+                db.students.student_cid
+            )
+            existing_cids = {v.student_cid for v in existing_cids} - inserted_cids
+
+            if existing_cids:
+                problems["existing_cids"] |= existing_cids
+                return
+
+            # Skip inserting once problems have been found, which includes any
+            # invalid rows in this chunk
+            if any(problems.values()):
+                return
+
+            students = []
+            for row in chunk:
+                row["course"] = course_map[row["course"]]
+                students.append(db.students._filter_fields(row))
+
+            st_ids = db.students.bulk_insert(students)
+            inserted_cids.update(cids)
+
+            db.student_presentations.bulk_insert(
+                [
+                    dict(
+                        student=st_id,
+                        course_presentation=stpres,
+                        academic_year=CURRENT_PROJECT_YEAR,
+                    )
+                    for st_id, row in zip(st_ids, chunk)
+                    for stpres in active_pres_map[row["course"]]
+                ]
             )
 
-            data = [row for row, bl in zip(data, blank) if not bl]
+        inserted_cids = set()
+        chunk = []
+        n_students = 0
+
+        for row, valid in _validated_rows(data):
+            n_students += 1
 
-        # - repackage the data into fields to do checks
-        fields = {key: [item[key] for item in data] for key in headers}
+            # Rows with other problems are still checked for existing CIDs
+            if valid or row["student_cid"].isdigit():
+                chunk.append(row)
 
-        # - courses are recognized?
-        unknown_courses = set(fields["course"]).difference(known_courses)
+            if len(chunk) == LOAD_CHUNK_SIZE:
+                _insert_chunk(chunk)
+                chunk = []
+
+        if chunk:
+            _insert_chunk(chunk)
+
+        # Build the report in the order of the checks
+        if problems["blank"]:
+            html = CAT(
+                html,
+                H4("Blank lines"),
+                P(f"The input file contains {problems['blank']} blank rows."),
+            )
 
-        if len(unknown_courses) > 0:
+        if len(problems["unknown_courses"]) > 0:
             html = CAT(
                 html,
                 H4("Unknown courses"),
                 P("These courses are found in the file but are not recognized:"),
-                P(_format_error(unknown_courses)),
+                P(_format_error(problems["unknown_courses"])),
                 P("Valid values are: ", ", ".join(known_courses)),
             )
 
-        # bad student emails
-        bad_emails = [IS_EMAIL()(x) for x in fields["student_email"]]
-        bad_emails = [x[0] for x in bad_emails if x[1] is not None]
-        if len(bad_emails) > 0:
+        if len(problems["bad_emails"]) > 0:
             html = CAT(
                 html,
                 H4("Invalid student emails"),
                 P("The following are not well formatted emails: "),
-                P(_format_error(set(bad_emails))),
+                P(_format_error(problems["bad_emails"])),
             )
 
-        # non numeric CID
-        cids = set(fields["student_cid"])
-        bad_cids = [x for x in cids if not x.isdigit()]
-        if len(bad_cids) > 0:
+        if len(problems["bad_cids"]) > 0:
             html = CAT(
                 html,
                 H4("Invalid student CID numbers"),
                 P("The following are not valid CIDs: "),
-                P(_format_error(set(bad_cids))),
+                P(_format_error(problems["bad_cids"])),
             )
 
-        # pre-existing CIDs
-        existing_cids = db(db.students).select(db.students.student_cid)
-        existing_cids = [v.student_cid for v in existing_cids]
-        cids = set([int(v) for v in cids])
-
-        bad_cids = cids.intersection(existing_cids)
-        if len(bad_cids) > 0:
+        if len(problems["existing_cids"]) > 0:
             html = CAT(
                 html,
                 H4("Invalid student CID numbers"),
                 P("The following CIDs are already associated with students: "),
-                P(_format_error(set(bad_cids))),
+                P(_format_error(problems["existing_cids"])),
             )
 
-        # empty names or just whitespace
-        names = set(fields["student_first_name"] + fields["student_last_name"])
-        bad_names = [x for x in names if x.isspace() or x == ""]
-
-        if len(bad_names) > 0:
+        if problems["bad_names"]:
             html = CAT(
                 html,
                 H4("Invalid student names"),
@@ -236,22 +315,11 @@ def load_students():
                 ),
             )
 
-        # NOW insert students and create active student presentations.
-
         if html == "":
-            for each_student in data:
-                each_student["course"] = course_map[each_student["course"]]
-                st_id = db.students.insert(**each_student)
-
-                for stpres in active_pres_map[each_student["course"]]:
-                    db.student_presentations.insert(
-                        student=st_id,
-                        course_presentation=stpres,
-                        academic_year=CURRENT_PROJECT_YEAR,
-                    )
-
-            # load the assignments
-            html = CAT(H2(str(len(data)) + " students successfully uploaded"))
+            html = CAT(H2(str(n_students) + " students successfully uploaded"))
+        else:
+            # Remove any chunks inserted before the problems were found
+            db.rollback()
 
     else:
         html = ""
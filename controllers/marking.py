@@ -5,7 +5,6 @@ from pathlib import Path
 import csv
 import itertools
 import random
-import copy
 import uuid
 from itertools import groupby, chain
 import simplejson as json
@@ -17,13 +16,25 @@ from marking_functions import (
     zip_pdfs,
     download_grades,
     query_report_marker_grades,
+    update_assignment_grades,
+    rebuild_assignment_grades,
+    update_marker_progress,
+    prefetch_assignment_references,
     get_form_header,
     assignment_to_sqlform,
     style_sqlform,
+    compiled_form,
+    invalidate_compiled_form,
+    autosave_assignment,
+    version_matches,
 )
 from sharepoint import scan_files
+from pdf_cache import PDFCache
+from mail_queue import job_progress
+from marking_analytics import grade_analytics
 
 from staff_auth import staff_authorised
+from typeahead import typeahead_widget
 import sharepoint
 import markdown  # gluon provides MARKDOWN but lacks extensions.
 from mailer import Mail
@@ -166,6 +177,7 @@ def marking_role_details():
             new_recid = db.marking_roles.insert(**form_update_args)
         else:
             record.update_record(**form_update_args)
+            invalidate_compiled_form(record.id)
 
         redirect(URL("marking", "marking_roles"))
 
@@ -327,7 +339,12 @@ def marking_files():
 
 @auth.requires_membership("admin")
 def rescan_sharepoint():
-    scan_files()
+    changes = scan_files(full="full" in request.vars)
+
+    session.flash = (
+        "Sharepoint scanned: {inserted} new, {updated} updated and {deleted} "
+        "removed files".format(**changes)
+    )
 
     redirect(URL("marking_files"))
 
@@ -345,23 +362,25 @@ def new_assignment():
     db.assignments.assignment_data.writable = False
 
     # Form requires an member of staff from the db and only allows assignments to be
-    # added to student presentations from the current project year.
+    # added to student presentations from the current project year. The options are
+    # found using typeahead searches, so the validators only check submitted values.
+    response.files.append(URL("static", "js/typeahead.js"))
+
     db.assignments.marker.requires = IS_IN_DB(
         db, "teaching_staff.id", "%(last_name)s, %(first_name)s (%(email)s)"
     )
+    db.assignments.marker.widget = typeahead_widget("staff")
 
     ps_reqr = IS_IN_DB(
         db(db.student_presentations.academic_year == CURRENT_PROJECT_YEAR),
         "student_presentations.id",
-        lambda row: (
-            f"{row.student.student_last_name}, "
-            f"{row.student.student_first_name} ("
-            f"{row.course_presentation.name})"
-        ),
-        sort=True,
+        "%(id)s",
     )
 
     db.assignments.student_presentation.requires = ps_reqr
+    db.assignments.student_presentation.widget = typeahead_widget(
+        "students", year=CURRENT_PROJECT_YEAR
+    )
 
     # The form should also only populate the marking role dropdown using _active_
     # marking roles.
@@ -377,6 +396,7 @@ def new_assignment():
     )
 
     if form.process().accepted:
+        update_marker_progress([form.vars.marker])
         response.flash = "Assignment created"
         redirect(URL("assignments"))
 
@@ -480,6 +500,7 @@ def assignments():
         ("cpdf", "Download Confidential PDFs", zip_pdfs, {"confidential": True}),
         ("pdf", "Download Public PDFs", zip_pdfs, {}),
         ("grades", "Download Grades", download_grades, {}),
+        ("csvgrades", "Download Grades (CSV)", download_grades, {"output": "csv"}),
     )
 
     buttons = [
@@ -503,7 +524,8 @@ def assignments():
         ][0]
 
         # Starting from the base query, add any keywords currently in use by the SQLFORM.grid
-        # back into the db to get the selected rows and hence the list of ids
+        # to get a query selecting the rows. The action functions use this as a subquery,
+        # so the ids of the selected rows are never loaded here.
         qry = db.assignments.student_presentation == db.student_presentations.id
 
         if not "all" in request.vars.keys():
@@ -512,39 +534,171 @@ def assignments():
         if request.get_vars.keywords is not None:
             qry &= smart_query(fields, request.get_vars.keywords)
 
-        records = db(qry).select(db.assignments.id)
-        records = [r.id for r in records]
+        # Feed that into the action function
+        action_func(ids=qry, **action_args)
+
+    # Show mail jobs that are still sending or finished in the last day
+    recent = datetime.datetime.now() - datetime.timedelta(days=1)
+    mail_jobs = db(
+        (db.mail_jobs.completed_on == None) | (db.mail_jobs.completed_on > recent)
+    ).select(orderby=~db.mail_jobs.id)
+
+    return dict(
+        form=grid, actions=actions, old_new=old_new, mail_jobs=mail_jobs
+    )
 
-        # Feed those into the action function
-        action_func(ids=records, **action_args)
 
-    return dict(form=grid, actions=actions, old_new=old_new)
+def call():
+    session.forget()
+    return service()
+
+
+@service.json
+@auth.requires_membership("admin")
+def mail_job_progress(job_id):
+    """
+    Service to report the progress of a queued mail job to the assignments page.
+    This only reads the job progress: the emails are sent by the scheduler or the
+    cron mail worker.
+    """
+
+    return job_progress(int(job_id))
+
+
+@auth.requires_membership("admin")
+def marking_analytics():
+    """
+    Shows analytics of the submitted grades for an academic year: grade
+    distributions by presentation and role, marker bias against the cohort and
+    differences between markers for double marked students. The year and the
+    threshold used to flag large differences are set by URL variables and each table
+    can be downloaded as CSV using the download variable.
+    """
+
+    try:
+        year = int(request.vars.year or CURRENT_PROJECT_YEAR)
+        threshold = float(request.vars.threshold or 10)
+    except ValueError:
+        session.flash = "Invalid year or threshold"
+        redirect(URL("marking_analytics"))
+
+    tables = grade_analytics(year, threshold)
+
+    titles = dict(
+        distributions="Grade distributions",
+        bias="Marker bias",
+        differences="Differences between markers",
+        flags="Students with large differences between markers",
+    )
+
+    if request.vars.download in tables:
+        table = tables[request.vars.download]
+
+        data = io.StringIO()
+        writer = csv.writer(data)
+        writer.writerow(table["headers"])
+        writer.writerows(table["rows"])
+
+        filename = f"{request.vars.download}_{year}.csv"
+        raise HTTP(
+            200,
+            data.getvalue(),
+            **{
+                "Content-Type": "text/csv",
+                "Content-Disposition": f"attachment;filename={filename};",
+            },
+        )
+
+    form = FORM(
+        "Academic year: ",
+        INPUT(_name="year", _value=year, _type="number"),
+        " Difference threshold: ",
+        INPUT(_name="threshold", _value=threshold, _type="number", _step="any"),
+        " ",
+        INPUT(_type="submit", _value="Update", _class="btn btn-secondary"),
+        _method="GET",
+    )
+
+    content = []
+
+    for key, table in tables.items():
+        content.extend(
+            [
+                H3(titles[key]),
+                A(
+                    "Download CSV",
+                    _href=URL(
+                        vars=dict(year=year, threshold=threshold, download=key)
+                    ),
+                ),
+                TABLE(
+                    TR(*[TH(hdr) for hdr in table["headers"]]),
+                    *[TR(*[TD(val) for val in row]) for row in table["rows"]],
+                    _class="table table-striped table-sm",
+                ),
+            ]
+        )
+
+    return dict(form=form, content=CAT(*content))
+
+
+@auth.requires_membership("admin")
+def rebuild_grades():
+    """
+    Rebuilds the table of exported grades from the assignment data for all
+    assignments. This is used to fill the table for existing assignments and could
+    be needed if the grade_export settings of a marking role form change. The
+    rebuild rewrites the whole table, so it is only run when the confirmation form
+    is posted.
+    """
+
+    form = FORM(
+        INPUT(_type="submit", _value="Rebuild grades", _class="btn btn-primary")
+    )
+
+    if form.accepts(request.post_vars, session):
+        n_assignments = rebuild_assignment_grades()
+        session.flash = f"Grades rebuilt for {n_assignments} assignments"
+        redirect(URL("assignments"))
+
+    return dict(form=form)
 
 
 @auth.requires_membership("admin")
 def marker_progress():
-    db.markers._format = "%(last_name)s, %(first_name)s"
+    """
+    Shows the counts of completed and uncompleted reports by marker and role for the
+    current project year. The counts are read from the maintained counts table, which
+    is rebuilt if it is empty or if the rebuild variable is set.
+    """
+
+    if "rebuild" in request.vars or db(db.marker_progress_counts).isempty():
+        update_marker_progress()
 
     status_count = db(
-        (db.assignments.student_presentation == db.student_presentations.id)
-        & (db.student_presentations.academic_year == CURRENT_PROJECT_YEAR)
-        & (db.assignments.marker_role_id == db.marking_roles.id)
+        (db.marker_progress_counts.academic_year == CURRENT_PROJECT_YEAR)
+        & (db.marker_progress_counts.marker_role_id == db.marking_roles.id)
         & (db.marking_roles.is_active == True)
+        & (db.marker_progress_counts.marker == db.teaching_staff.id),
+        ignore_common_filters=True,
     ).select(
-        db.assignments.marker,
-        db.assignments.marker_role_id,
-        db.assignments.marker_role_id.count().with_alias("n"),
-        db.assignments.status,
-        groupby=[
-            db.assignments.marker,
-            db.assignments.status,
-            db.assignments.marker_role_id,
-        ],
+        db.teaching_staff.id,
+        db.teaching_staff.first_name,
+        db.teaching_staff.last_name,
+        db.marking_roles.name,
+        db.marker_progress_counts.status,
+        db.marker_progress_counts.n,
     )
 
-    # Render names and sort by marker
-    status_count = list(status_count.render())
-    status_count.sort(key=lambda x: x.assignments.marker)
+    # Sort by marker surname, keeping markers with the same name separate
+    status_count = sorted(
+        status_count,
+        key=lambda rw: (
+            rw.teaching_staff.last_name,
+            rw.teaching_staff.first_name,
+            rw.teaching_staff.id,
+        ),
+    )
 
     # Get a template count (not completed, completed) by marker role
     count_template = db(db.marking_roles.is_active == True).select(
@@ -579,16 +733,18 @@ def marker_progress():
     table = [hdr, subhdr]
 
     # Loop over the marker data
-    for marker, data in groupby(status_count, lambda x: x.assignments.marker):
+    for _, data in groupby(status_count, lambda x: x.teaching_staff.id):
         # Fill in a copy of the count template to fix order and gaps
-        marker_counts = copy.deepcopy(count_template)
+        marker_counts = {ky: [0, 0] for ky in count_template}
+        data = list(data)
+        staff = data[0].teaching_staff
+        marker = f"{staff.last_name}, {staff.first_name}"
 
         for this_count in data:
-            details = this_count.assignments
             # Use a logical index to put completed/released in 1 and everything else in 0
-            marker_counts[details.marker_role_id][
-                details.status in ["Submitted", "Released"]
-            ] += this_count.n
+            marker_counts[this_count.marking_roles.name][
+                this_count.marker_progress_counts.status in ["Submitted", "Released"]
+            ] += this_count.marker_progress_counts.n
 
         # Style the row
         row = [
@@ -650,8 +806,28 @@ def edit_assignment():
         db.assignments, deletable=delete_ok, record=record, readonly=readonly
     )
 
-    if form.process(onvalidation=submit_validation).accepted:
+    # The assignment data is not edited here, but detect_record_change rejects the
+    # form if the assignment has been changed since the form was loaded. The version
+    # is incremented so that open report pages cannot then save over this edit.
+    def _edit_validation(form):
+        submit_validation(form)
+        form.vars.version = (record.version or 0) + 1
+
+    if form.process(
+        onvalidation=_edit_validation, detect_record_change=True
+    ).accepted:
+        update_assignment_grades([record.id])
+        update_marker_progress([record.marker, form.vars.marker])
+        PDFCache().invalidate(
+            record.student_presentation, form.vars.student_presentation
+        )
         redirect(URL("assignments"))
+    elif getattr(form, "record_changed", False):
+        session.flash = (
+            "This assignment has been changed since the form was loaded. "
+            "The current details are shown below."
+        )
+        redirect(URL("edit_assignment", args=record.id))
 
     return dict(form=form)
 
@@ -826,51 +1002,68 @@ def load_assignments():
                 known_presentations=known_presentations,
             )
 
-        # NOW validate students presentations
+        # NOW validate students presentations. The students, student presentations
+        # and staff needed are loaded in bulk and the rows checked against lookups.
         bad_student_records = []
         bad_stpres_records = []
 
+        student_rows = db(
+            db.students.student_cid.belongs([int(cid) for cid in cids])
+        ).select(
+            db.students.id,
+            db.students.student_cid,
+            db.students.student_first_name,
+            db.students.student_last_name,
+            orderby=db.students.id,
+        )
+
+        student_lookup = {}
+        for rw in student_rows:
+            student_lookup.setdefault(
+                (rw.student_cid, rw.student_first_name, rw.student_last_name), rw.id
+            )
+
+        stpres_rows = db(
+            db.student_presentations.student.belongs(set(student_lookup.values()))
+        ).select(
+            db.student_presentations.id,
+            db.student_presentations.student,
+            db.student_presentations.academic_year,
+            db.student_presentations.course_presentation,
+            orderby=db.student_presentations.id,
+        )
+
+        stpres_lookup = {}
+        for rw in stpres_rows:
+            stpres_lookup.setdefault(
+                (rw.student, rw.academic_year, rw.course_presentation), rw.id
+            )
+
         for this_student in data:
-            student_record = (
-                db(
-                    (db.students.student_cid == int(this_student["student_cid"]))
-                    & (
-                        db.students.student_first_name
-                        == this_student["student_first_name"]
-                    )
-                    & (
-                        db.students.student_last_name
-                        == this_student["student_last_name"]
-                    )
+            student_id = student_lookup.get(
+                (
+                    int(this_student["student_cid"]),
+                    this_student["student_first_name"],
+                    this_student["student_last_name"],
                 )
-                .select()
-                .first()
             )
 
-            if student_record is None:
+            if student_id is None:
                 bad_student_records.append(this_student)
                 continue
 
-            stpres_record = (
-                db(
-                    (db.student_presentations.student == student_record.id)
-                    & (
-                        db.student_presentations.academic_year
-                        == int(this_student["academic_year"])
-                    )
-                    & (
-                        db.student_presentations.course_presentation
-                        == known_presentations[this_student["course_presentation"]]
-                    )
+            stpres_id = stpres_lookup.get(
+                (
+                    student_id,
+                    int(this_student["academic_year"]),
+                    known_presentations[this_student["course_presentation"]],
                 )
-                .select()
-                .first()
             )
 
-            if stpres_record is None:
+            if stpres_id is None:
                 bad_stpres_records.append(this_student)
             else:
-                this_student["stpres_id"] = stpres_record.id
+                this_student["stpres_id"] = stpres_id
 
         if len(bad_student_records) > 0:
             html = CAT(
@@ -917,15 +1110,21 @@ def load_assignments():
         staff_email_map = {}
         bad_staff_records = []
 
+        staff_rows = db(
+            db.teaching_staff.email.lower().belongs([st.lower() for st in staff])
+        ).select(
+            db.teaching_staff.id, db.teaching_staff.email, orderby=db.teaching_staff.id
+        )
+
+        staff_lookup = {}
+        for rw in staff_rows:
+            staff_lookup.setdefault(rw.email.lower(), rw.id)
+
         for this_staff in staff:
-            staff_record = (
-                db(db.teaching_staff.email.lower() == this_staff.lower())
-                .select()
-                .first()
-            )
+            staff_id = staff_lookup.get(this_staff.lower())
 
-            if staff_record is not None:
-                staff_email_map[this_staff] = staff_record.id
+            if staff_id is not None:
+                staff_email_map[this_staff] = staff_id
             else:
                 bad_staff_records.append(this_staff)
 
@@ -965,6 +1164,7 @@ def load_assignments():
                     )
 
             db.assignments.bulk_insert(assignments)
+            update_marker_progress(staff_email_map.values())
 
             # load the assignments
             html = CAT(H2(str(len(assignments)) + " assignments successfully created"))
@@ -1246,9 +1446,6 @@ def presentation_overview():
 
     marker = session.magic_auth
 
-    # and edit representations
-    db.assignments.status.represent = lambda id, row: status_dict[row.status]
-
     # This is automatically all years.
     db.assignments._common_filter = None
 
@@ -1260,8 +1457,20 @@ def presentation_overview():
         session.flash = "Unknown presentation details"
         redirect(URL("index"))
 
-    # Get any assignment rows associated with the presentation id
+    # Get any assignment rows associated with the presentation id, along with the
+    # rows they reference
     rows = db(db.assignments.student_presentation == presentation_id).select()
+    prefetch_assignment_references(rows)
+
+    # Get the exported grades for those rows in order
+    grade_rows = db(
+        db.assignment_grades.assignment.belongs([rw.id for rw in rows])
+    ).select(
+        orderby=(db.assignment_grades.assignment, db.assignment_grades.position)
+    )
+    grades_by_assignment = {
+        ky: list(vl) for ky, vl in groupby(grade_rows, key=lambda rw: rw.assignment)
+    }
 
     if rows:
         content = [
@@ -1277,17 +1486,12 @@ def presentation_overview():
         ]
 
         # Create a summary table
-        for idx, this_row in enumerate(rows):
-            # now render it to get representations of ids etc
-            rend_row = rows.render(idx)
-
+        for this_row in rows:
             if this_row.status in ["Submitted", "Released"]:
-                # Extract the exported grades from the row
-                display_grades = this_row.marker_role_id.form_json["grade_export"]
-                display_vals = [this_row.assignment_data[x] for x in display_grades]
-
+                # Get the exported grades for the row
                 grades = [
-                    P(f"{nm}: {gr}") for nm, gr in zip(display_grades, display_vals)
+                    P(f"{gr.field_name}: {gr.grade_text}")
+                    for gr in grades_by_assignment.get(this_row.id, [])
                 ]
                 grades = DIV(*grades)
 
@@ -1311,9 +1515,11 @@ def presentation_overview():
             content.append(
                 (
                     TR(
-                        TD(rend_row.marker_role_id),
-                        TD(rend_row.marker),
-                        TD(rend_row.status),
+                        TD(this_row.marker_role_id.name),
+                        TD(
+                            f"{this_row.marker.first_name} {this_row.marker.last_name}"
+                        ),
+                        TD(status_dict[this_row.status]),
                         TD(grades),
                         TD(link),
                     )
@@ -1378,6 +1584,9 @@ def write_report():
             session.flash = "Unknown assignment id provided"
             redirect(URL("index"))
 
+        # Load the referenced rows used to build the page
+        prefetch_assignment_references(record)
+
     # Get the marker record
     marker = session.magic_auth
 
@@ -1447,33 +1656,71 @@ def write_report():
 
     # process the form to handle storing the data, via a validation function
     # that checks required fields are complete when users press submit. The validation
-    # method retrieves form details from the session.
-    session.form_json = record.marker_role_id.form_json
+    # method retrieves the marking role from the session.
+    session.form_role_id = record.marker_role_id.id
+
+    form.process(onvalidation=submit_validation, keepvalues=True)
+
+    # Only store accepted forms that were posted using one of the two buttons.
+    # Readonly forms are never accepted.
+    button = [nm for nm in ("submit", "save") if nm in request.post_vars]
 
-    if form.process(onvalidation=submit_validation).accepted:
+    if form.accepted and not button:
+        response.flash = "Unknown form action, changes to report not saved"
+    elif form.accepted:
         # add the id from the record into the data (an id is needed by the form code)
         data = form.vars
         data["id"] = record.id
 
-        if "save" in list(request.vars.keys()):
-            session.flash = "Changes to report saved"
-            record.update_record(assignment_data=data, status="Started")
-        elif "submit" in list(request.vars.keys()):
-            session.flash = "Report submitted"
-            record.update_record(
-                assignment_data=data,
+        # The version of the report that the page was loaded with - the save only
+        # succeeds if the report has not been saved elsewhere since then.
+        try:
+            base_version = int(request.post_vars.version)
+        except (TypeError, ValueError):
+            base_version = record.version or 0
+
+        update = dict(assignment_data=data, version=base_version + 1)
+
+        if button[0] == "submit":
+            flash = "Report submitted"
+            update.update(
                 status="Submitted",
                 submission_date=datetime.datetime.now(),
                 submission_ip=request.client,
             )
+        else:
+            flash = "Changes to report saved"
+            update.update(status="Started")
+
+        saved = db(
+            (db.assignments.id == record.id) & version_matches(base_version)
+        ).update(**update)
+
+        if saved:
+            session.flash = flash
+            update_assignment_grades([record.id])
+            update_marker_progress([record.marker])
+            PDFCache().invalidate(record.student_presentation)
+
+            redirect(URL("write_report", vars={"record": record.id}))
+
+        # Reject the save, keeping the submitted values in the form, and load the
+        # current version so that saving again replaces the stored report.
+        record = db.assignments[record.id]
+        response.flash = (
+            "This report has been saved elsewhere since you opened it, so your "
+            "changes have not been saved. Your changes are shown below: saving "
+            "again will replace the stored report with them."
+        )
 
-        # TODO - Would be neater to use ajax here rather than reloading the page
-        # but parking that for another day.
-        redirect(URL("write_report", vars={"record": record.id}))
-
-    # Style SQLFORM
+    # Style SQLFORM, adding the report version to editable forms
     html = style_sqlform(record, form, readonly)
 
+    if not readonly:
+        html.insert(
+            -1, INPUT(_type="hidden", _name="version", _value=record.version or 0)
+        )
+
     # Provide any available files
     expected_files = record.marker_role_id.form_json.get("submitted_files")
     if expected_files:
@@ -1530,11 +1777,92 @@ def write_report():
 
     my_assignments = P(A("Back to my assignments", _href=URL("my_assignments")))
 
+    # Settings for the autosave script - the token is checked by autosave_report
+    # to make sure that saves come from this page.
+    if not readonly:
+        if session.autosave_token is None:
+            session.autosave_token = uuid.uuid4().hex
+
+        autosave = json.dumps(
+            dict(
+                url=URL("autosave_report"),
+                record=record.id,
+                version=record.version or 0,
+                token=session.autosave_token,
+                interval=configuration.get("marking.autosave_interval") or 10,
+            )
+        )
+    else:
+        autosave = None
+
     return dict(
         header=CAT(admin_warn, *header),
         save_and_submit=save_and_submit,
         form=CAT(*html),
         files=files,
+        autosave=autosave,
+    )
+
+
+@staff_authorised
+def autosave_report():
+    """
+    JSON service used by write_report to save changes to a report in the background.
+    It expects a JSON body containing the record id, the autosave token for the
+    session, the version of the report being edited and a dictionary of changed
+    form values. The changes are merged into the stored report data and the new
+    version is returned. If the report has been saved elsewhere since the page was
+    loaded, the changes are refused and the current version is returned.
+    """
+
+    if request.env.request_method != "POST":
+        raise HTTP(405)
+
+    try:
+        payload = json.loads(request.body.read())
+        record_id = int(payload["record"])
+        version = int(payload["version"])
+        changes = dict(payload["changes"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTP(400, "Invalid autosave request")
+
+    if session.autosave_token is None or payload.get("token") != session.autosave_token:
+        raise HTTP(403, "Invalid autosave token")
+
+    # allow old reports to be saved, matching write_report
+    db.assignments._common_filter = None
+    record = db.assignments[record_id]
+
+    if record is None:
+        raise HTTP(404, "Unknown assignment id")
+
+    # Access control matches write_report: admins can always save, markers can save
+    # their own reports until they are submitted.
+    if not auth.has_membership("admin") and (
+        record.status in ["Submitted", "Released"]
+        or session.magic_auth.id != record.marker
+    ):
+        raise HTTP(403, "Report cannot be edited")
+
+    new_version, errors = autosave_assignment(record, changes, version)
+
+    if new_version is None:
+        return response.json(
+            dict(
+                saved=False,
+                version=db.assignments[record_id].version or 0,
+                message="This report has been changed elsewhere. Reload the "
+                "page before making further changes.",
+            )
+        )
+
+    return response.json(
+        dict(
+            saved=True,
+            version=new_version,
+            errors=errors,
+            saved_at=datetime.datetime.now().strftime("%H:%M:%S"),
+        )
     )
 
 
@@ -1542,20 +1870,16 @@ def submit_validation(form):
     """
     Takes a submitted form and checks that all components tagged as
     required in the JSON description have been completed. Requires that
-    the appropriate form JSON has been stored in the session object, since
+    the marking role id has been stored in the session object, since
     it seems to be impossible to pass extra arguments to onvalidation functions.
+    The required components are taken from the compiled form for the role.
     """
 
-    if "submit" in list(request.vars.keys()):
-        for q in session.form_json["questions"]:
-            for c in q["components"]:
-                if c["required"] and form.vars[c["variable"]] in [None, ""]:
-                    if c["type"] == "rubric":
-                        form.errors[c["variable"]] = "You must select an option"
-                    elif c["type"] == "comment":
-                        form.errors[c["variable"]] = "Please provide comments"
-                    elif c["type"] == "select":
-                        form.errors[c["variable"]] = "Please select a grade"
+    if "submit" in list(request.vars.keys()) and session.form_role_id is not None:
+        role = db.marking_roles[session.form_role_id]
+        for variable, message in compiled_form(role)["required"]:
+            if form.vars[variable] in [None, ""]:
+                form.errors[variable] = message
 
 
 def criteria_and_forms():
@@ -1682,6 +2006,8 @@ def download_pdf():
             session.flash = "Unknown project marking record id provided"
             redirect(URL("index"))
 
+        prefetch_assignment_references(record)
+
         if not record.status in ["Submitted", "Released"]:
             session.flash = "This report has not yet been submitted or released"
             redirect(URL("index"))
@@ -1,8 +1,17 @@
 import datetime
 from staff_auth import staff_authorised
-from gluon.sqlhtml import ExportClass
-from io import StringIO
+from marking_functions import stream_csv_file
 import secrets
+from project_search import search_projects, ranked_orderby
+from page_cache import cached_page, project_counter, STAFF_COUNTER
+from project_facets import (
+    FACET_FIELDS,
+    FACET_VAR_PREFIX,
+    selected_facets,
+    facet_filter,
+    facet_counts,
+)
+from typeahead import search, labels_for, typeahead_widget
 
 ## -----------------------------------------------------------------------------
 ## Project proposal handlers.
@@ -25,7 +34,22 @@ def index():
 
     """
     Controller to serve up the contents of the proposals database as a nice
-    searchable grid.
+    searchable grid. Pages for anonymous users are cached until a project or a
+    member of staff is changed or the project year rolls over.
+    """
+
+    return cached_page(
+        ["projects", STAFF_COUNTER],
+        lambda: _project_grid(request.get_vars),
+        key_parts=[PROJECT_ROLLOVER_DAY],
+    )
+
+
+def _project_grid(get_vars):
+
+    """
+    Builds the proposals grid for the index page, using the search keywords and
+    selected facets from the request variables.
     """
 
     # Hide the internal ID numbers and project student (used in links)
@@ -91,6 +115,64 @@ def index():
         dict(header="Open", body=lambda row: filled_icons[row.project_student is None]),
     ]
 
+    # Search keywords use the full text index rather than the grid query builder,
+    # and matching projects are shown best match first unless another order is
+    # chosen.
+    keywords = get_vars.keywords
+    search_ids = search_projects(keywords) if keywords else []
+
+    # Filter the projects by any selected facet values and count the matching
+    # projects for each facet value
+    qry = (
+        (db.projects.date_created > PROJECT_ROLLOVER_DAY)
+        & (db.projects.concealed == False)
+        & (db.projects.lead_supervisor == db.teaching_staff.id)
+        & (db.teaching_staff.is_active == True)
+    )
+
+    selected = selected_facets(get_vars)
+
+    counts = facet_counts(
+        qry & db.projects.id.belongs(search_ids) if keywords else qry, selected
+    )
+
+    if selected:
+        qry &= facet_filter(selected)
+
+    def facet_url(fld, value):
+        # Toggle a value in the facet selection, keeping the other grid variables
+        # but returning to the first page
+        link_vars = {ky: vl for ky, vl in get_vars.items() if ky not in ("page",)}
+        values = list(selected.get(fld, []))
+        if value in values:
+            values.remove(value)
+        else:
+            values.append(value)
+        link_vars[FACET_VAR_PREFIX + fld] = values
+        return URL(vars=link_vars)
+
+    facet_blocks = []
+    for fld, label in FACET_FIELDS.items():
+        values = counts[fld]
+        counted = {val for val, _ in values}
+        values += [(val, 0) for val in selected.get(fld, []) if val not in counted]
+
+        if not values:
+            continue
+
+        items = [
+            LI(
+                A(
+                    B(f"{val} ({n})") if val in selected.get(fld, []) else f"{val} ({n})",
+                    _href=facet_url(fld, val),
+                )
+            )
+            for val, n in values
+        ]
+        facet_blocks.append(DIV(H5(label), UL(*items), _class="col-sm"))
+
+    facets = DIV(*facet_blocks, _class="row")
+
     # show the standard grid display
     # - restrict list display to a few key fields
     # - sub in a custom view function for the normal details link
@@ -99,12 +181,7 @@ def index():
     # - display projects created after project rollover day
 
     grid = SQLFORM.grid(
-        (
-            (db.projects.date_created > PROJECT_ROLLOVER_DAY)
-            & (db.projects.concealed == False)
-            & (db.projects.lead_supervisor == db.teaching_staff.id)
-            & (db.teaching_staff.is_active == True)
-        ),
+        qry,
         fields=[
             db.projects.project_student,
             db.projects.lead_supervisor,
@@ -118,7 +195,9 @@ def index():
         maxtextlength=250,
         create=False,  # using a custom create form
         csv=True,
-        searchable=True,
+        searchable=lambda sfields, keywords: db.projects.id.belongs(search_ids),
+        advanced_search=False,
+        orderby=ranked_orderby(search_ids),
         # exportclasses =  dict(
         #   csv_with_hidden_cols=(ExporterCSV_hidden, 'CSV (hidden cols)',T(...))),
         exportclasses=dict(
@@ -148,13 +227,15 @@ def index():
     # if grid.element('.web2py_console form') is not None:
     #     grid.element('.web2py_console form').append(download)
 
-    return dict(grid=grid)
+    return dict(grid=grid, facets=facets)
 
 
 def view_project():
 
     """
-    Controller to provide a nicely styled custom view of project details
+    Controller to provide a nicely styled custom view of project details. Pages
+    for anonymous users are cached until the project or a member of staff is
+    changed.
     """
 
     # retrieve the news post id from the page arguments passed by the button
@@ -165,7 +246,25 @@ def view_project():
         session.flash = CENTER(B("No project number provided."), _style="color: red")
         redirect(URL("projects", "index"))
 
-    project = db.projects(int(project_id))
+    try:
+        project_id = int(project_id)
+    except ValueError:
+        session.flash = CENTER(B("Invalid project number."), _style="color: red")
+        redirect(URL("projects", "index"))
+
+    return cached_page(
+        [project_counter(project_id), STAFF_COUNTER],
+        lambda: _project_details(project_id),
+    )
+
+
+def _project_details(project_id):
+
+    """
+    Builds the project details for the view_project page
+    """
+
+    project = db.projects(project_id)
 
     if project is None:
         session.flash = CENTER(B("Invalid project number."), _style="color: red")
@@ -246,9 +345,17 @@ def view_project():
 
     if project.other_supervisors is not None:
 
+        # Load the other supervisors with one query rather than following each reference
+        other_supervisors = db(
+            db.teaching_staff.id.belongs([int(s) for s in project.other_supervisors]),
+            ignore_common_filters=True,
+        ).select(
+            db.teaching_staff.first_name,
+            db.teaching_staff.last_name,
+            db.teaching_staff.email,
+        )
         other_supervisors = [
-            f"{s.first_name} {s.last_name} ({s.email})"
-            for s in project.other_supervisors
+            f"{s.first_name} {s.last_name} ({s.email})" for s in other_supervisors
         ]
         other_supervisors = DIV(
             DIV(B("Other supervisors"), _class="col-sm-3"),
@@ -500,15 +607,17 @@ def project_details():
         "course_restrictions",
     ]
 
-    # Format the student selection dropdown labels
-    # NOTE: https://stackoverflow.com/questions/53100625/
+    # Students and staff are picked using typeahead searches rather than drop down
+    # menus of every option. The labels of any existing values are loaded together.
 
-    def repr_string(row):
-        return (
-            f"{row.student.student_last_name}, "
-            f"{row.student.student_first_name} ("
-            f"{row.course_presentation.name})"
-        )
+    response.files.append(URL("static", "js/typeahead.js"))
+
+    db.projects.lead_supervisor.widget = typeahead_widget("staff")
+    db.projects.internal_supervisor.widget = typeahead_widget("staff", internal_only=1)
+    db.projects.other_supervisors.widget = typeahead_widget("staff")
+
+    def student_label(value):
+        return labels_for("students", [value]).get(value)
 
     # Put in constraints
 
@@ -573,36 +682,44 @@ def project_details():
     # What students are available to pick if needed
     if record is None or record.project_student is None:
 
-        # find a list of current students that have not already been assigned a project
+        # Current students that have not already been assigned a project. The
+        # validator only checks the submitted value, the options come from the
+        # typeahead search.
         qry = db(
             (db.student_presentations.academic_year == CURRENT_PROJECT_YEAR)
-            & (db.projects.project_student == None)
-        )
-        left = db.projects.on(
-            db.student_presentations.id == db.projects.project_student
+            & ~db.student_presentations.id.belongs(
+                db(db.projects.project_student != None)._select(
+                    db.projects.project_student
+                )
+            )
         )
 
         ps_reqr = IS_NULL_OR(
             IS_IN_DB(
                 qry,
                 "student_presentations.id",
-                lambda row: repr_string(row),
-                left=left,
-                zero="Select a student to assign this project",
-                sort=True,
+                "%(id)s",
             )
         )
 
         db.projects.project_student.requires = ps_reqr
+        db.projects.project_student.widget = typeahead_widget(
+            "students",
+            placeholder="Start typing to find a student to assign this project",
+            year=CURRENT_PROJECT_YEAR,
+            unassigned=1,
+        )
 
     elif auth.has_membership("admin"):
 
         # Admin can remove student.
+        assigned_label = student_label(record.project_student)
+
         ps_reqr = IS_NULL_OR(
             IS_IN_DB(
                 db(db.student_presentations.id == record.project_student),
                 "student_presentations.id",
-                lambda row: repr_string(row),
+                lambda row: assigned_label,
                 zero="Remove this assigned student",
                 # default=record.project_student,
                 sort=True,
@@ -615,7 +732,7 @@ def project_details():
 
         # Lock down set project students
         db.projects.project_student.writable = False
-        db.projects.project_student.represent = lambda row: repr_string(row)
+        db.projects.project_student.represent = lambda value: student_label(value)
 
     buttons = [
         TAG.button(
@@ -905,6 +1022,36 @@ def validate_project(form):
         form.internal_being_set = False
 
 
+@staff_authorised
+def typeahead():
+    """
+    JSON search service for the typeahead widgets used to pick students and staff on
+    the project and marking assignment forms. The source variable sets whether to
+    search students or staff and the term variable gives the text typed so far.
+    """
+
+    session.forget(response)
+
+    source = request.vars.source
+    year = request.vars.year
+
+    if source not in ("students", "staff"):
+        raise HTTP(404, "Unknown typeahead source")
+
+    if source == "students" and not str(year).isdigit():
+        raise HTTP(400, "An academic year is needed to search students")
+
+    results = search(
+        source,
+        request.vars.term,
+        year=int(year) if source == "students" else None,
+        internal_only=bool(request.vars.internal_only),
+        unassigned=bool(request.vars.unassigned),
+    )
+
+    return response.json(dict(results=results))
+
+
 def _none_to_dash(val, row, fmt, none_val="----"):
     """General purpose reformatter to take a row and return a formatted value
     unless the value is None, then return "----"
@@ -1090,42 +1237,83 @@ def project_action():
         redirect(URL('projects', redir))
 
 
-class AllocationsCSV(ExportClass):
+# Column names in the project allocations download. This file is the input to
+# marking/load_assignments, with the addition of marker columns.
+ALLOCATION_COLUMNS = [
+    "student_cid",
+    "student_first_name",
+    "student_last_name",
+    "academic_year",
+    "course_presentation",
+    "project_title",
+    "supervisor_name",
+    "supervisor_roles",
+]
+
+
+def _allocation_values(rows):
+    """Generator of the CSV header and the values for each allocation row"""
+
+    yield ALLOCATION_COLUMNS
+
+    for row in rows:
+        staff = row.teaching_staff
+
+        yield [
+            row.students.student_cid,
+            row.students.student_first_name,
+            row.students.student_last_name,
+            row.student_presentations.academic_year,
+            row.course_presentations.name,
+            row.projects.project_title or "----",
+            "----" if staff.id is None else f"{staff.first_name} {staff.last_name}",
+            "----" if staff.id is None else staff.email,
+        ]
+
+
+def _download_allocations(qry, fields, keywords, filename):
     """
-    This is an allocations specific export class - bit of an overkill, but offers finer
-    control over the structure of the download file (represent, and changing column names)
+    Downloads the project allocations matching the grid search as a CSV file. The
+    supervisor details are joined into the query, rather than loaded for each row.
+    The rows are read from the database cursor one at a time and written to a
+    temporary file before the response is returned, while the request still holds
+    the database connection, and the file is then sent in chunks.
     """
 
-    label = "CSV"
-    file_ext = "csv"
-    content_type = "text/csv"
-
-    def __init__(self, rows):
-        ExportClass.__init__(self, rows)
-
-    def export(self):
-        if self.rows:
-            s = StringIO()
-
-            # There is no way to rename the fields being written out, but _can_ write
-            # them to the StringIO first and then leave off the colnames in the export
-            colnames = [
-                "student_cid",
-                "student_first_name",
-                "student_last_name",
-                "academic_year",
-                "course_presentation",
-                "project_title",
-                "supervisor_name",
-                "supervisor_roles",
-            ]
+    if keywords:
+        qry &= SQLFORM.build_query(fields, keywords)
+
+    qry &= db.student_presentations.course_presentation == db.course_presentations.id
+
+    # Common filters are ignored so that projects led by inactive staff are included
+    rows = db(qry, ignore_common_filters=True).iterselect(
+        db.students.student_cid,
+        db.students.student_first_name,
+        db.students.student_last_name,
+        db.student_presentations.academic_year,
+        db.course_presentations.name,
+        db.projects.project_title,
+        db.teaching_staff.id,
+        db.teaching_staff.first_name,
+        db.teaching_staff.last_name,
+        db.teaching_staff.email,
+        left=[
+            db.projects.on(db.student_presentations.id == db.projects.project_student),
+            db.teaching_staff.on(db.projects.lead_supervisor == db.teaching_staff.id),
+        ],
+        orderby=db.students.student_last_name | db.students.student_first_name,
+    )
 
-            s.write(",".join(colnames) + "\n")
+    filename = filename or f"project_allocations_{datetime.date.today().isoformat()}"
 
-            self.rows.export_to_csv_file(s, represent=True, write_colnames=False)
-            return s.getvalue()
-        else:
-            return None
+    raise HTTP(
+        200,
+        stream_csv_file(_allocation_values(rows)),
+        **{
+            "Content-Type": "text/csv",
+            "Content-Disposition": f"attachment;filename={filename}.csv;",
+        },
+    )
 
 
 def project_allocations():
@@ -1233,23 +1421,33 @@ def project_allocations():
     db.student_presentations.id.readable = False
     db.student_presentations.student.readable = False
 
+    qry = db.students.id == db.student_presentations.student
+
+    fields = [
+        db.students.student_cid,
+        db.students.student_first_name,
+        db.students.student_last_name,
+        db.student_presentations.academic_year,
+        db.student_presentations.course_presentation,
+        db.projects.project_title,
+        db.projects.lead_supervisor,
+        db.projects.id,
+    ]
+
+    # The download uses the grid search keywords but is streamed separately from the
+    # grid, which would load all of the rows and look up the supervisor for each row.
+    if request.vars._export_type == "csv":
+        _download_allocations(
+            qry, fields, request.vars.keywords, request.vars._export_filename
+        )
+
     # Left join - so that students with no project appear with null projects
-    # - Setting csv=False suppresses download buttons, but the exportclasses machinery
-    #   is still availabe using the URL vars _export_type and _export_filename
+    # - Setting csv=False suppresses download buttons
     # - Bit of a hack using represent to add in supervisor email without having join
     #   teaching_staff in to the table - lazy really.
     form = SQLFORM.grid(
-        (db.students.id == db.student_presentations.student),
-        fields=[
-            db.students.student_cid,
-            db.students.student_first_name,
-            db.students.student_last_name,
-            db.student_presentations.academic_year,
-            db.student_presentations.course_presentation,
-            db.projects.project_title,
-            db.projects.lead_supervisor,
-            db.projects.id,
-        ],
+        qry,
+        fields=fields,
         headers={
             "students.student_cid": "CID",
             "students.student_first_name": "First Name",
@@ -1267,12 +1465,9 @@ def project_allocations():
         details=False,
         links=links,
         csv=False,
-        exportclasses=dict(
-            csv=(AllocationsCSV, "CSV", T(...)),
-        ),
     )
 
-    # Insert a download button using the exportclasses machinery
+    # Insert a download button for the streamed CSV file
     download = A(
         "Download",
         _class="btn btn-secondary btn-sm",
@@ -1,4 +1,5 @@
 from mailer import Mail
+from db_indexes import index_report
 
 # ---- Action for login/register/etc (required for auth) -----
 def user():
@@ -172,3 +173,16 @@ def email_log():
     
     return dict(form=form)
 
+
+## --------------------------------------------------------------------------------
+## DATABASE INDEXES
+## --------------------------------------------------------------------------------
+
+@auth.requires_membership('admin')
+def database_indexes():
+    
+    # Shows whether the managed indexes exist and which indexes are used by the
+    # query plans for the frequent queries from the controllers
+    indexes, queries = index_report(db)
+    
+    return dict(indexes=indexes, queries=queries, dbname=db._dbname)
@@ -0,0 +1,14 @@
+## --------------------------------------------------------------------------------
+## MAIL QUEUE WORKER
+## Sends the queued bulk mail jobs when the web2py scheduler is not enabled (see
+## modules/mail_queue.py). This needs to run with the app models loaded, for example
+## every minute from the system crontab:
+##
+##   * * * * * cd /home/www-data/web2py && python web2py.py -S marking_reports -M \
+##       -R applications/marking_reports/cron/process_mail_queue.py
+##
+## Overlapping runs are safe, because each message is claimed before it is sent.
+## --------------------------------------------------------------------------------
+from mail_queue import process_mail_queue
+
+process_mail_queue()
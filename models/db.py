@@ -137,15 +137,22 @@ response.google_analytics_id = configuration.get('google.analytics_id')
 # -------------------------------------------------------------------------
 # maybe use the scheduler
 # -------------------------------------------------------------------------
+# - the scheduler is used to send queued mail jobs if enabled, otherwise
+#   those jobs are sent by running cron/process_mail_queue.py from cron.
 if configuration.get('scheduler.enabled'):
     from gluon.scheduler import Scheduler
-    scheduler = Scheduler(db, heartbeat=configuration.get('scheduler.heartbeat'))
+    from mail_queue import process_mail_job
+    scheduler = Scheduler(db, heartbeat=configuration.get('scheduler.heartbeat'),
+                          tasks=dict(process_mail_job=process_mail_job))
+else:
+    scheduler = None
 
 # Store db, config and auth in the current object so it can be imported by modules
 from gluon import current
 current.db = db
 current.configuration = configuration
 current.auth = auth
+current.scheduler = scheduler
 
 # -------------------------------------------------------------------------
 # after defining tables, uncomment below to enable auditing
@@ -1,3 +1,5 @@
+from marking_functions import backfill_assignment_grades
+
 # Turn on signed tables
 db._common_fields.append(auth.signature)
 
@@ -112,7 +114,9 @@ db.define_table(
 
 # This table records what the assignments are. The data field holds a JSON object
 # containing the content of the variables listed in the correct report
-# template which is defined by the marking form.
+# template which is defined by the marking form. The version is incremented
+# whenever the data is saved, so that saves from an out of date copy of a report
+# can be detected.
 
 db.define_table(
     "assignments",
@@ -129,10 +133,41 @@ db.define_table(
         default="Created",
         writable=False,
     ),
+    Field("version", "integer", default=0, readable=False, writable=False),
     # migrate=False, fake_migrate=True,
 )
 
 
+# This table holds the exported grade fields (grade_export in the form JSON) from each
+# assignment, one row per field, along with any numeric percentage in the grade. It
+# allows grades to be queried without decoding the assignment data and is maintained
+# by update_assignment_grades in marking_functions.
+
+db.define_table(
+    "assignment_grades",
+    Field("assignment", "reference assignments", ondelete="CASCADE"),
+    Field("field_name", "string"),
+    Field("position", "integer"),
+    Field("grade_text", "text"),
+    Field("grade_percent", "integer"),
+)
+
+
+# This table holds counts of assignments by marker, role, status and year, so that
+# the marker progress page does not need to group all current assignments. It is
+# maintained by update_marker_progress in marking_functions wherever assignments are
+# created or change status.
+
+db.define_table(
+    "marker_progress_counts",
+    Field("marker", "reference teaching_staff"),
+    Field("marker_role_id", "reference marking_roles"),
+    Field("status", "string"),
+    Field("academic_year", "integer"),
+    Field("n", "integer"),
+)
+
+
 # This table stores data about the files held in sharepoint that are to be provided
 # to markers. Typically, this is thesis files to Markers, but could be any combination
 # of presentation and role. The unique id provides a permanent reference to retrieve
@@ -152,3 +187,23 @@ db.define_table(
     Field("student", "reference student_presentations"),
     Field("matching_issues", "string"),
 )
+
+# This table records the last modified time of each Sharepoint folder when it was
+# last scanned, so that rescans only need to list the files in changed folders.
+
+db.define_table(
+    "sharepoint_folders",
+    Field("relative_url", "string"),
+    Field("time_last_modified", "string"),
+)
+
+
+# Create the indexes for frequent queries on the marking tables when migrations are
+# enabled (see modules/db_indexes.py)
+
+apply_indexes(db, "assignments", "assignment_grades", "marking_files")
+
+# Add the exported grades for any assignments that do not have them yet, once per
+# process (see modules/marking_functions.py)
+
+backfill_assignment_grades()
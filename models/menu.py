@@ -65,6 +65,7 @@ if auth.has_membership("admin"):
             ),
             (T("View Marking Assignments"), False, URL("marking", "assignments"), []),
             (T("View Marker Progress"), False, URL("marking", "marker_progress"), []),
+            (T("Marking Analytics"), False, URL("marking", "marking_analytics"), []),
             (T("View Submitted Files"), False, URL("marking", "submitted_files"), []),
             (T("Marking Files"), False, URL("marking", "marking_files"), []),
         ]
@@ -196,6 +197,12 @@ if auth.has_membership("admin"):
                 (DIV(_class="dropdown-divider"), False, False, []),
                 (CAT(T("View Users"), badge), False, URL("sm_admin", "show_users"), []),
                 (T("View Email Log"), False, URL("sm_admin", "email_log"), []),
+                (
+                    T("Database Indexes"),
+                    False,
+                    URL("sm_admin", "database_indexes"),
+                    [],
+                ),
                 (
                     T("Database (requires site password)"),
                     False,
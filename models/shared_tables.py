@@ -1,4 +1,9 @@
 import secrets
+from db_indexes import apply_indexes
+from project_search import setup_project_search
+from project_facets import setup_project_facets
+from page_cache import setup_project_counters
+from typeahead import setup_typeahead_counters
 from timetabler_functions import get_year_start_date
 from marking_functions import (
       get_project_rollover_date, 
@@ -10,7 +15,8 @@ from marking_functions import (
 # Email log
 # - db table just to record who got emailed what and when. Doesn't record message
 #   content since these emails are all from templates - record the template and
-#   the dictionary of info used to fill out the template to save bits.
+#   the dictionary of info used to fill out the template to save bits. The log_key
+#   is used to recover buffered entries without duplication (see modules/mailer.py).
 ## -----------------------------------------------------------------------------
 
 db.define_table('email_log',
@@ -21,7 +27,35 @@ db.define_table('email_log',
                 Field('email_template_dict','json'),
                 Field('sent','boolean'),
                 Field('status', 'string'),
-                Field('message_date','datetime'))
+                Field('message_date','datetime'),
+                Field('log_key', 'string', unique=True))
+
+## -----------------------------------------------------------------------------
+# Mail jobs
+# - Bulk mail-outs are queued as a job with one item per message and then sent by
+#   a scheduler worker or by the cron mail worker (see modules/mail_queue.py). The item holds the rendered message body, because the
+#   templates need the request to build URLs, and tracks sending attempts.
+## -----------------------------------------------------------------------------
+
+db.define_table('mail_jobs',
+                Field('action', 'string'),
+                Field('status', 'string', default='Queued'),
+                Field('n_items', 'integer', default=0),
+                Field('n_sent', 'integer', default=0),
+                Field('n_failed', 'integer', default=0),
+                Field('created_on', 'datetime'),
+                Field('completed_on', 'datetime'))
+
+db.define_table('mail_job_items',
+                Field('job', 'reference mail_jobs'),
+                Field('email_to', 'text'),
+                Field('subject', 'string'),
+                Field('email_template', 'string'),
+                Field('email_template_dict', 'json'),
+                Field('html_body', 'text'),
+                Field('status', 'string', default='Pending'),
+                Field('attempts', 'integer', default=0),
+                Field('last_attempt', 'datetime'))
 
 ## --------------------------------------------------------------------------------
 # SECURITY AND STAFF AUTHENTICATION
@@ -234,3 +268,47 @@ db.define_table('projects',
                 Field('date_created', 'date'),
                 Field('concealed', 'boolean', default=False, required=True))
 
+
+# The values of the descriptive project fields, one row per project, field and value,
+# used to filter and count projects (see modules/project_facets.py).
+
+db.define_table('project_facets',
+                Field('project', 'reference projects', ondelete='CASCADE'),
+                Field('facet', 'string'),
+                Field('facet_value', 'string'))
+
+# Change counters used to invalidate the cached public project pages, incremented for
+# the whole projects table and for individual projects (see modules/page_cache.py).
+# The updated_on times are in UTC. The students and teaching_staff counters are
+# incremented by the typeahead callbacks (see modules/typeahead.py) and the cached
+# pages also depend on the teaching_staff counter.
+
+db.define_table('cache_counters',
+                Field('name', 'string', unique=True),
+                Field('counter', 'integer', default=0),
+                Field('updated_on', 'datetime'))
+
+## -----------------------------------------------------------------------------
+# Indexes
+# - Creates any missing indexes for frequent queries on these tables (see
+#   modules/db_indexes.py). The database_indexes admin page reports on the indexes
+#   and queries for all tables, so it also loads the marking and timetabler models.
+## -----------------------------------------------------------------------------
+
+if request.controller == 'sm_admin' and request.function == 'database_indexes':
+    response.models_to_run.append(r'^(marking|timetabler)/\w+\.py$')
+
+apply_indexes(db, 'email_log', 'magic_links', 'students', 'student_presentations',
+              'projects', 'project_facets')
+
+# Full text search index over the project proposals (see modules/project_search.py)
+setup_project_search(db)
+
+# Facet values for the project proposals (see modules/project_facets.py)
+setup_project_facets(db)
+
+# Invalidation of the cached public project pages (see modules/page_cache.py)
+setup_project_counters(db)
+
+# Invalidation of the typeahead search indexes (see modules/typeahead.py)
+setup_typeahead_counters(db)
@@ -89,4 +89,7 @@ db.define_table('events',
                 Field('conceal', 'boolean', default=False),
                 common_filter = lambda query: db.events.conceal == False)
 
+# Index the events by module when migrations are enabled (see modules/db_indexes.py)
+apply_indexes(db, 'events')
+
 
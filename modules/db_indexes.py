@@ -0,0 +1,306 @@
+## --------------------------------------------------------------------------------
+## DATABASE INDEXES
+## The DAL only creates indexes for primary keys and unique fields, so the indexes
+## needed by the most frequent queries are defined here. Each model file calls
+## apply_indexes after defining its tables, which creates any missing indexes. This
+## does not depend on the migrate setting, so the indexes are also added to existing
+## production databases. The existing indexes are only checked once per process for
+## each table, so this adds no queries to normal requests.
+##
+## The hot_queries function gives examples of the frequent queries from the
+## controllers, built from the DAL so that they match the SQL the controllers send,
+## and index_report uses the database EXPLAIN output to show which indexes they use.
+## --------------------------------------------------------------------------------
+import re
+
+# Index definitions by table: a list of (index name, [field names])
+INDEXES = {
+    "email_log": [
+        ("email_log_log_key_idx", ["log_key"]),
+    ],
+    "assignments": [
+        ("assignments_student_presentation_idx", ["student_presentation"]),
+        ("assignments_marker_status_idx", ["marker", "status"]),
+        ("assignments_status_idx", ["status"]),
+    ],
+    "assignment_grades": [
+        ("assignment_grades_assignment_idx", ["assignment"]),
+    ],
+    "student_presentations": [
+        ("student_presentations_academic_year_idx", ["academic_year"]),
+    ],
+    "marking_files": [
+        ("marking_files_student_idx", ["student"]),
+        ("marking_files_unique_id_idx", ["unique_id"]),
+    ],
+    "magic_links": [
+        ("magic_links_token_idx", ["token"]),
+    ],
+    "students": [
+        ("students_student_cid_idx", ["student_cid"]),
+    ],
+    "projects": [
+        ("projects_project_student_idx", ["project_student"]),
+        ("projects_date_created_idx", ["date_created"]),
+    ],
+    "project_facets": [
+        ("project_facets_facet_value_idx", ["facet", "facet_value"]),
+        ("project_facets_project_idx", ["project"]),
+    ],
+    "events": [
+        ("events_module_id_idx", ["module_id"]),
+    ],
+}
+
+# Indexes that enforce unique values. The email log keys are also defined as unique
+# in the table, but the DAL does not add the constraint to an existing SQLite table.
+UNIQUE_INDEXES = {"email_log_log_key_idx"}
+
+
+def hot_queries(db):
+    """Returns examples of the frequent queries from the controllers
+
+    Returns a list of (controller, description, SQL) tuples. The SQL is built from
+    the DAL, so it includes any common filters on the tables. Queries on tables that
+    are not defined in db are left out.
+    """
+
+    queries = [
+        (
+            "marking/my_marking",
+            "Assignments for a marker by status",
+            "assignments",
+            lambda: db(
+                (db.assignments.marker == 1)
+                & db.assignments.status.belongs(["Not started", "Started"])
+            )._select(db.assignments.id),
+        ),
+        (
+            "marking/presentation_overview",
+            "Assignments for a student presentation",
+            "assignments",
+            lambda: db(db.assignments.student_presentation == 1)._select(
+                db.assignments.id
+            ),
+        ),
+        (
+            "marking/assignments",
+            "Assignments by status",
+            "assignments",
+            lambda: db(db.assignments.status == "Submitted")._select(
+                db.assignments.id
+            ),
+        ),
+        (
+            "marking/download_grades",
+            "Grades for an assignment",
+            "assignment_grades",
+            lambda: db(db.assignment_grades.assignment == 1)._select(
+                db.assignment_grades.id
+            ),
+        ),
+        (
+            "marking/assignments",
+            "Student presentations for a year",
+            "student_presentations",
+            lambda: db(db.student_presentations.academic_year == 2021)._select(
+                db.student_presentations.id
+            ),
+        ),
+        (
+            "marking/write_report",
+            "Submitted files for a student",
+            "marking_files",
+            lambda: db(db.marking_files.student == 1)._select(db.marking_files.id),
+        ),
+        (
+            "marking/rescan_sharepoint",
+            "Submitted file by Sharepoint id",
+            "marking_files",
+            lambda: db(db.marking_files.unique_id == "x")._select(
+                db.marking_files.id
+            ),
+        ),
+        (
+            "staff/authorise",
+            "Magic link by token",
+            "magic_links",
+            lambda: db(db.magic_links.token == "x")._select(db.magic_links.id),
+        ),
+        (
+            "manage/load_students",
+            "Students by CID",
+            "students",
+            lambda: db(db.students.student_cid == 1)._select(db.students.id),
+        ),
+        (
+            "projects/project_allocations",
+            "Projects for a student presentation",
+            "projects",
+            lambda: db(db.projects.project_student == 1)._select(db.projects.id),
+        ),
+        (
+            "projects/index",
+            "Projects by creation date",
+            "projects",
+            lambda: db(db.projects)._select(
+                db.projects.id, orderby=~db.projects.date_created
+            ),
+        ),
+        (
+            "projects/index",
+            "Projects with a facet value",
+            "project_facets",
+            lambda: db(
+                (db.project_facets.facet == "project_type")
+                & db.project_facets.facet_value.belongs(["Fieldwork"])
+            )._select(db.project_facets.project),
+        ),
+        (
+            "timetabler/module_view",
+            "Events for a module",
+            "events",
+            lambda: db(db.events.module_id == 1)._select(db.events.id),
+        ),
+    ]
+
+    return [
+        (controller, description, build())
+        for controller, description, table_name, build in queries
+        if table_name in db.tables
+    ]
+
+
+# Tables that have been checked by this process
+_APPLIED = set()
+
+
+def existing_indexes(db, table_name):
+    """Returns the set of index names on a table in the database"""
+
+    name = db._adapter.adapt(table_name)
+
+    if db._dbname == "sqlite":
+        sql = f"SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = {name};"
+    elif db._dbname == "postgres":
+        sql = f"SELECT indexname FROM pg_indexes WHERE tablename = {name};"
+    elif db._dbname == "mysql":
+        sql = (
+            "SELECT DISTINCT index_name FROM information_schema.statistics "
+            f"WHERE table_schema = DATABASE() AND table_name = {name};"
+        )
+    else:
+        return set()
+
+    return {rw[0] for rw in db.executesql(sql)}
+
+
+def apply_indexes(db, *table_names):
+    """Creates any missing indexes for a set of tables
+
+    This runs whatever the migrate setting is. An index that cannot be created, for
+    example because migrations are off and the table has not been created yet, is
+    skipped and tried again by the next process.
+    """
+
+    for table_name in table_names:
+        if table_name in _APPLIED:
+            continue
+
+        table = db[table_name]
+        present = existing_indexes(db, table_name)
+
+        for index_name, field_names in INDEXES.get(table_name, []):
+            if index_name in present:
+                continue
+
+            columns = ", ".join(table[fld]._rname for fld in field_names)
+
+            # Guard against another process creating the index at the same time
+            if_not_exists = "IF NOT EXISTS " if db._dbname in ("sqlite", "postgres") else ""
+
+            unique = "UNIQUE " if index_name in UNIQUE_INDEXES else ""
+
+            try:
+                db.executesql(
+                    f"CREATE {unique}INDEX {if_not_exists}{index_name} "
+                    f"ON {table._rname} ({columns});"
+                )
+                db.commit()
+            except Exception:
+                db.rollback()
+
+        _APPLIED.add(table_name)
+
+
+def explain(db, sql):
+    """Returns the query plan for some SQL and the names of the indexes it uses"""
+
+    if db._dbname == "sqlite":
+        plan = [rw[-1] for rw in db.executesql(f"EXPLAIN QUERY PLAN {sql}")]
+        indexes = [
+            mt.group(1)
+            for step in plan
+            for mt in [re.search(r"USING (?:COVERING )?INDEX (\w+)", step)]
+            if mt
+        ]
+    elif db._dbname == "postgres":
+        plan = [rw[0] for rw in db.executesql(f"EXPLAIN {sql}")]
+        indexes = [
+            mt.group(1)
+            for step in plan
+            for mt in [re.search(r"Index (?:Only )?Scan (?:Backward )?(?:using|on) (\w+)", step)]
+            if mt
+        ]
+    elif db._dbname == "mysql":
+        rows = db.executesql(f"EXPLAIN {sql}", as_dict=True)
+        plan = [f"{rw['table']}: {rw['type']} {rw['key'] or ''}" for rw in rows]
+        indexes = [rw["key"] for rw in rows if rw["key"]]
+    else:
+        plan = ["EXPLAIN is not supported for this database"]
+        indexes = []
+
+    return plan, indexes
+
+
+def index_report(db):
+    """Reports the defined indexes and the indexes used by the hot queries
+
+    Returns a list of dictionaries for the defined indexes, showing whether each
+    index exists in the database, and a list of dictionaries giving the query plan
+    and indexes used for each of the hot_queries.
+    """
+
+    indexes = []
+    for table_name, table_indexes in INDEXES.items():
+        present = existing_indexes(db, table_name)
+        for index_name, field_names in table_indexes:
+            indexes.append(
+                dict(
+                    table=table_name,
+                    name=index_name,
+                    fields=", ".join(field_names),
+                    present=index_name in present,
+                )
+            )
+
+    queries = []
+    for controller, description, sql in hot_queries(db):
+        try:
+            plan, used = explain(db, sql)
+        except Exception as err:
+            # Tables from a model that has not been migrated yet
+            db.rollback()
+            plan, used = [f"Could not explain query: {err}"], []
+
+        queries.append(
+            dict(
+                controller=controller,
+                description=description,
+                sql=sql,
+                plan=plan,
+                indexes=used,
+            )
+        )
+
+    return indexes, queries
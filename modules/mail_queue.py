@@ -0,0 +1,212 @@
+## --------------------------------------------------------------------------------
+## E-MAIL JOB QUEUE
+## Bulk mail-outs (distributing marking to markers and releasing reports to students)
+## are added to a queue as a job containing one item per message, rather than being
+## sent inside the request. The message bodies are rendered when the job is queued,
+## because the templates use the request to build absolute URLs.
+##
+## The queue is worked outside of web requests, in one of two ways:
+## - If the web2py scheduler is enabled, a process_mail_job task is queued for the
+##   job and a scheduler worker sends the messages.
+## - Otherwise, cron/process_mail_queue.py must be run regularly from cron with the
+##   app models loaded. Each run works through all of the unfinished jobs.
+## The job progress service used by the assignments page only reports the progress of
+## a job and never sends messages, so closing the page does not stop a job.
+##
+## Items that fail to send are retried on later passes until MAX_ATTEMPTS is reached.
+## Items are claimed with a conditional update before sending, so that two workers can
+## never send the same message.
+## --------------------------------------------------------------------------------
+import datetime
+import time
+
+from gluon import current
+from mailer import Mail, render_email_template
+
+MAX_ATTEMPTS = 3
+RETRY_DELAY = datetime.timedelta(minutes=2)
+STALE_CLAIM = datetime.timedelta(minutes=15)
+
+
+def queue_mail_job(action, messages):
+    """Adds a mail job to the queue
+
+    Takes a description of the action and a list of dictionaries giving the 'to',
+    'subject', 'email_template' and 'email_template_dict' for each message. Returns the
+    id of the new job.
+    """
+
+    db = current.db
+    now = datetime.datetime.now()
+
+    job_id = db.mail_jobs.insert(
+        action=action, status="Queued", n_items=len(messages), created_on=now
+    )
+
+    items = [
+        dict(
+            job=job_id,
+            email_to=msg["to"],
+            subject=msg["subject"],
+            email_template=msg["email_template"],
+            email_template_dict=msg["email_template_dict"],
+            html_body=render_email_template(
+                msg["email_template"], msg["email_template_dict"]
+            ),
+            status="Pending",
+            attempts=0,
+        )
+        for msg in messages
+    ]
+
+    db.mail_job_items.bulk_insert(items)
+
+    scheduler = getattr(current, "scheduler", None)
+
+    if scheduler is not None:
+        scheduler.queue_task(
+            "process_mail_job", pvars=dict(job_id=job_id), timeout=3600, immediate=True
+        )
+
+    return job_id
+
+
+def process_mail_items(job_id, limit=None):
+    """Sends pending messages for a job
+
+    This makes a single pass over the items that are due to be sent, sending at most
+    limit messages using a single mail server login, and then updates the job
+    progress. It returns the number of items still waiting to be sent.
+    """
+
+    db = current.db
+    now = datetime.datetime.now()
+    items = db.mail_job_items
+
+    # Release claims left by a worker that died while sending
+    db(
+        (items.job == job_id)
+        & (items.status == "Sending")
+        & (items.last_attempt < now - STALE_CLAIM)
+    ).update(status="Pending")
+
+    due = db(
+        (items.job == job_id)
+        & (items.status == "Pending")
+        & ((items.last_attempt == None) | (items.last_attempt < now - RETRY_DELAY))
+    ).select(items.id, orderby=items.id, limitby=None if limit is None else (0, limit))
+
+    if due:
+        db(db.mail_jobs.id == job_id).update(status="Running")
+        db.commit()
+
+        mailer = Mail()
+        mailer.login()
+
+        for due_item in due:
+            # Claim the item - the update only succeeds if nothing else has claimed it
+            claimed = db((items.id == due_item.id) & (items.status == "Pending")).update(
+                status="Sending", last_attempt=datetime.datetime.now()
+            )
+            db.commit()
+
+            if not claimed:
+                continue
+
+            item = items[due_item.id]
+
+            success = mailer.sendmail(
+                to=item.email_to,
+                subject=item.subject,
+                email_template=item.email_template,
+                email_template_dict=item.email_template_dict,
+                html_body=item.html_body,
+            )
+
+            attempts = item.attempts + 1
+
+            if success:
+                status = "Sent"
+            elif attempts < MAX_ATTEMPTS:
+                status = "Pending"
+            else:
+                status = "Failed"
+
+            item.update_record(status=status, attempts=attempts)
+            db.commit()
+
+        mailer.logout()
+
+    return update_job_progress(job_id)
+
+
+def update_job_progress(job_id):
+    """Updates the counts and status of a job and returns the number of unsent items"""
+
+    db = current.db
+    items = db.mail_job_items
+
+    counts = db(items.job == job_id).select(
+        items.status, items.id.count().with_alias("n"), groupby=items.status
+    )
+    counts = {rw.mail_job_items.status: rw.n for rw in counts}
+
+    remaining = counts.get("Pending", 0) + counts.get("Sending", 0)
+    job_update = dict(n_sent=counts.get("Sent", 0), n_failed=counts.get("Failed", 0))
+
+    if not remaining:
+        job_update.update(
+            status="Complete" if not job_update["n_failed"] else "Complete with failures",
+            completed_on=datetime.datetime.now(),
+        )
+
+    db(db.mail_jobs.id == job_id).update(**job_update)
+    db.commit()
+
+    return remaining
+
+
+def process_mail_job(job_id):
+    """Scheduler task to send all of the messages in a job, including retries"""
+
+    while process_mail_items(job_id):
+        time.sleep(RETRY_DELAY.total_seconds())
+
+    return current.db.mail_jobs[job_id].status
+
+
+def process_mail_queue():
+    """Sends the due messages for all unfinished jobs
+
+    This is run from cron when the scheduler is not enabled. Messages that fail are
+    retried by later runs once RETRY_DELAY has passed. Returns the number of items
+    still waiting to be sent.
+    """
+
+    db = current.db
+
+    jobs = db(db.mail_jobs.status.belongs(["Queued", "Running"])).select(
+        db.mail_jobs.id, orderby=db.mail_jobs.id
+    )
+
+    return sum(process_mail_items(job.id) for job in jobs)
+
+
+def job_progress(job_id):
+    """Returns a dictionary describing the progress of a job"""
+
+    db = current.db
+
+    job = db.mail_jobs[job_id]
+
+    if job is None:
+        return None
+
+    return dict(
+        id=job.id,
+        action=job.action,
+        status=job.status,
+        n_items=job.n_items,
+        n_sent=job.n_sent,
+        n_failed=job.n_failed,
+    )
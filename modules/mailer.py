@@ -6,18 +6,429 @@
 ## it in an mailbox on the account using IMAP. A Mail instance can be used just to
 ## send a single message but can also be created, logged in and recycled for several
 ## messages to reduce handling time.
+##
+## Server connections are kept in a process wide pool, so that logging in for a
+## single message (login links, password resets) can reuse an open and authenticated
+## connection rather than repeating the connection, STARTTLS and login handshakes.
+## Pooled connections are checked with a NOOP before reuse and dropped if they have
+## been idle for too long or fail the check.
+##
+## Each message sent (or failed) is recorded in the email_log table. Log entries are
+## buffered for the lifetime of a logged in session and written with a single
+## bulk_insert, rather than inserting and committing each entry. To make this crash
+## safe, each entry is also appended to a spool file with a unique log_key, and any
+## spool files left behind are replayed into the table, skipping entries whose key is
+## already present. Each file is claimed by renaming it before it is replayed, so two
+## processes never replay the same file.
+##
+## Copies of sent messages are stored in the IMAP mailbox together when the session
+## logs out, rather than adding an IMAP round trip between each message. The copies
+## waiting to be stored are also written to a spool file, so that copies from a
+## process that dies before logging out are stored by a later session.
+##
+## Templated messages for bulk mail-outs use the same template many times, so the
+## compiled templates are cached (and recompiled if the template file changes) and
+## the plain text versions of message bodies are memoised.
 ## --------------------------------------------------------------------------------
+import atexit
 import datetime
+import glob
+import hashlib
+import io
+import os
 import time
+import threading
+import uuid
+import weakref
 import imaplib
 import socket
 import smtplib
 import simplejson as json
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from collections import OrderedDict
 import html2text
 
 from gluon import current
+from gluon.template import parse_template
+
+
+class _ConnectionPool:
+    """A thread safe store of idle, logged in mail server connections
+
+    Connections are stored against a key giving the protocol, host and user. A
+    connection is only ever held by one Mail instance: acquire removes it from the
+    pool and release returns it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def acquire(self, key, check, close, max_idle):
+        """Returns a healthy idle connection for a key or None"""
+
+        while True:
+            with self._lock:
+                conns = self._idle.get(key)
+                if not conns:
+                    return None
+                conn, last_used = conns.pop()
+
+            if time.monotonic() - last_used < max_idle and check(conn):
+                return conn
+
+            close(conn)
+
+    def release(self, key, conn, close, max_size):
+        """Returns a connection to the pool, closing it if the pool is full"""
+
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < max_size:
+                conns.append((conn, time.monotonic()))
+                return
+
+        close(conn)
+
+    def close_all(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+
+        for key, conns in idle.items():
+            close = _close_smtp if key[0] == "smtp" else _close_imap
+            for conn, _ in conns:
+                close(conn)
+
+
+def _check_smtp(conn):
+    try:
+        return conn.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+
+def _close_smtp(conn):
+    try:
+        conn.quit()
+    except (smtplib.SMTPException, OSError):
+        conn.close()
+
+
+def _check_imap(conn):
+    try:
+        return conn.noop()[0] == "OK"
+    except (imaplib.IMAP4.error, OSError):
+        return False
+
+
+def _close_imap(conn):
+    try:
+        conn.logout()
+    except (imaplib.IMAP4.error, OSError):
+        pass
+
+
+_POOL = _ConnectionPool()
+atexit.register(_POOL.close_all)
+
+## --------------------------------------------------------------------------------
+## EMAIL TEMPLATES
+## --------------------------------------------------------------------------------
+
+# Compiled email templates, keyed by file path, holding the file mtime and code
+_TEMPLATE_CACHE = {}
+
+# Plain text versions of message bodies keyed by the SHA1 hash of the html
+_TEXT_CACHE = OrderedDict()
+_TEXT_CACHE_SIZE = 256
+_TEXT_CACHE_LOCK = threading.Lock()
+
+
+def render_email_template(email_template, email_template_dict):
+    """
+    Renders one of the templates in views/email_templates. This is equivalent to
+    current.response.render, but the template is only parsed and compiled the first
+    time it is used (or after the template file is changed).
+    """
+
+    response = current.response
+    views = os.path.join(current.request.folder, "views")
+    filename = "email_templates/" + email_template
+    path = os.path.join(views, filename)
+
+    mtime = os.path.getmtime(path)
+    cached = _TEMPLATE_CACHE.get(path)
+
+    if cached is None or cached[0] != mtime:
+        code = parse_template(filename, path=views, context=response._view_environment)
+        cached = (mtime, compile(code, path, "exec"))
+        _TEMPLATE_CACHE[path] = cached
+
+    environment = dict(response._view_environment)
+    environment.update(email_template_dict)
+
+    # The compiled code writes to response.body, so swap in a new buffer
+    body = response.body
+    response.body = io.StringIO()
+
+    try:
+        exec(cached[1], environment)
+        html = response.body.getvalue()
+    finally:
+        response.body.close()
+        response.body = body
+
+    return html
+
+
+def html_to_text(html):
+    """Converts an html message body to plain text, memoising recent conversions"""
+
+    key = hashlib.sha1(html.encode("utf-8")).hexdigest()
+
+    with _TEXT_CACHE_LOCK:
+        text = _TEXT_CACHE.get(key)
+        if text is not None:
+            _TEXT_CACHE.move_to_end(key)
+            return text
+
+    text = html2text.html2text(html)
+
+    with _TEXT_CACHE_LOCK:
+        _TEXT_CACHE[key] = text
+        while len(_TEXT_CACHE) > _TEXT_CACHE_SIZE:
+            _TEXT_CACHE.popitem(last=False)
+
+    return text
+
+
+## --------------------------------------------------------------------------------
+## EMAIL LOG BUFFER
+## --------------------------------------------------------------------------------
+
+# Spool files older than this (in seconds) can be recovered by another session
+SPOOL_RECOVERY_AGE = 600
+
+_LIVE_BUFFERS = weakref.WeakSet()
+
+# Mail sessions in this process, whose IMAP spool files are still in use
+_LIVE_MAILS = weakref.WeakSet()
+
+
+def _flush_live_buffers():
+    """Flushes any unwritten log entries when the process exits"""
+
+    for buffer in list(_LIVE_BUFFERS):
+        try:
+            buffer.flush(commit=True)
+        except Exception:
+            # The entries remain in the spool file and are recovered later
+            pass
+
+
+atexit.register(_flush_live_buffers)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _claim_spool_files(folder, live):
+    """
+    Claims the spool files in a folder that are ready to be replayed and returns
+    their paths. Spool files are named pid_id.jsonl while they are being written
+    and pid_id.sealed once closed. A file is ready once it has not been modified for
+    SPOOL_RECOVERY_AGE seconds and is not one of the live paths still in use in
+    this process, and an open file is only ready if the process that wrote it has
+    died. Each file is claimed by renaming it to pid_id.claimpid.recovering, which
+    is atomic, so that only one process replays it. Files left claimed by a process
+    that died while replaying them are claimed again.
+    """
+
+    cutoff = time.time() - SPOOL_RECOVERY_AGE
+    claimed = []
+
+    for path in glob.glob(os.path.join(folder, "*_*.*")):
+        if path in live:
+            continue
+
+        try:
+            if os.path.getmtime(path) > cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+
+        name = os.path.basename(path)
+        base, *suffix = name.split(".")
+
+        if suffix == ["jsonl"]:
+            pid = int(base.split("_")[0])
+            if pid != os.getpid() and _pid_alive(pid):
+                continue
+        elif suffix[-1:] == ["recovering"]:
+            pid = int(suffix[0])
+            if pid == os.getpid() or _pid_alive(pid):
+                continue
+        elif suffix != ["sealed"]:
+            continue
+
+        claim = os.path.join(folder, f"{base}.{os.getpid()}.recovering")
+
+        try:
+            os.rename(path, claim)
+        except FileNotFoundError:
+            # Claimed by another process
+            continue
+
+        claimed.append(claim)
+
+    return claimed
+
+
+def _read_spool(path):
+    """Reads the entries from a spool file, skipping a partial final line"""
+
+    entries = []
+
+    with open(path) as spool:
+        for line in spool:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                pass
+
+    return entries
+
+
+def _insert_missing(db, entries):
+    """
+    Inserts log entries that are not already in the email log, using the log_key of
+    each entry, and returns the number inserted.
+    """
+
+    keys = [ent["log_key"] for ent in entries]
+    present = db(db.email_log.log_key.belongs(keys)).select(db.email_log.log_key)
+    present = {rw.log_key for rw in present}
+
+    missing = [ent for ent in entries if ent["log_key"] not in present]
+
+    if missing:
+        db.email_log.bulk_insert(missing)
+
+    return len(missing)
+
+
+class EmailLogBuffer:
+    """Collects email log entries and writes them to the email_log table in bulk
+
+    Entries are held in memory and in an append-only spool file until flush is
+    called. Flushing inserts the entries and seals the spool file, which is then
+    only removed by recover once its entries are confirmed to be in the table. This
+    means that log entries survive both a process crash and a rollback of the
+    transaction they were inserted in. The sealed files of a buffer are not
+    recovered while the buffer is still in use, so that a long running request
+    does not have its entries replayed before it commits.
+    """
+
+    def __init__(self, db, folder, max_size=50):
+        self.db = db
+        self.folder = folder
+        self.max_size = max_size
+
+        self.entries = []
+        self._spool = None
+        self._spool_path = None
+        self._sealed = set()
+
+        _LIVE_BUFFERS.add(self)
+
+    def add(self, **entry):
+        """Adds an entry, flushing the buffer if it has reached its maximum size"""
+
+        entry["log_key"] = uuid.uuid4().hex
+
+        if self._spool is None:
+            os.makedirs(self.folder, exist_ok=True)
+            self._spool_path = os.path.join(
+                self.folder, f"{os.getpid()}_{uuid.uuid4().hex}.jsonl"
+            )
+            self._spool = open(self._spool_path, "a")
+
+        spool_entry = dict(entry, message_date=entry["message_date"].isoformat())
+        self._spool.write(json.dumps(spool_entry) + "\n")
+        self._spool.flush()
+
+        self.entries.append(entry)
+
+        if len(self.entries) >= self.max_size:
+            self.flush()
+
+    def flush(self, commit=False):
+        """
+        Writes the buffered entries to the email log. This does not commit by
+        default, so the entries are committed along with the surrounding request
+        or task transaction.
+        """
+
+        entries = self.entries
+        self.entries = []
+
+        if self._spool is not None:
+            self._spool.close()
+            sealed_path = self._spool_path[:-6] + ".sealed"
+            os.replace(self._spool_path, sealed_path)
+            self._sealed.add(sealed_path)
+            self._spool = None
+            self._spool_path = None
+
+        if entries:
+            _insert_missing(self.db, entries)
+
+        if commit:
+            self.db.commit()
+
+        self.recover()
+
+    def recover(self):
+        """
+        Replays old spool files into the email log. Sealed files and open files left
+        by dead processes are replayed: each file is claimed first, so that only one
+        process replays it, and is only removed once all of its entries are found in
+        the table, so a replay is never lost to a rollback. A file with entries that
+        had to be inserted is released again to be checked by a later recovery.
+        """
+
+        live = set()
+        for buffer in _LIVE_BUFFERS:
+            live.add(buffer._spool_path)
+            live.update(buffer._sealed)
+
+        for path in _claim_spool_files(self.folder, live):
+            entries = _read_spool(path)
+
+            for ent in entries:
+                ent["message_date"] = datetime.datetime.fromisoformat(
+                    ent["message_date"]
+                )
+
+            if not entries or not _insert_missing(self.db, entries):
+                os.remove(path)
+            else:
+                # Release the file, touching it so that it is not checked again
+                # until the replayed entries have been committed
+                base = os.path.basename(path).split(".")[0]
+                sealed_path = os.path.join(self.folder, base + ".sealed")
+                os.replace(path, sealed_path)
+                os.utime(sealed_path)
 
 
 class Mail:
@@ -37,50 +448,216 @@ class Mail:
 
         self.logged_in = None  # ternary: None, False (failed) and True
 
-    def login(self):
-        # creates connections to the smtp and imap servers for mail
-        # send and storage
+        # Pool settings: the number of idle connections kept for each server and
+        # the time in seconds an idle connection is trusted to still be open.
+        self.pool_size = current.configuration.get("email.pool_size") or 2
+        self.pool_max_idle = current.configuration.get("email.pool_max_idle") or 240
+
+        self._smtp_key = ("smtp", self.smtp_host, self.smtp_user)
+        self._imap_key = ("imap", self.imap_host, self.imap_user)
+
+        # Messages waiting to be stored in the IMAP mailbox, and the spool file
+        # holding them until they are stored
+        self._imap_pending = []
+        self._imap_spool = None
+        self._imap_spool_path = None
+        self._imap_spool_folder = os.path.join(
+            current.request.folder, "databases", "imap_spool"
+        )
+
+        _LIVE_MAILS.add(self)
+
+        # Buffer for the email log entries
+        self._log = EmailLogBuffer(
+            current.db,
+            os.path.join(current.request.folder, "databases", "email_log_spool"),
+            current.configuration.get("email.log_buffer_size") or 50,
+        )
+
+    def _connect_smtp(self):
+        """Gets a logged in SMTP connection, from the pool if possible"""
+
+        smtp_server = _POOL.acquire(
+            self._smtp_key, _check_smtp, _close_smtp, self.pool_max_idle
+        )
+
+        if smtp_server is not None:
+            return smtp_server
 
         smtp_server = smtplib.SMTP(self.smtp_host)
         smtp_server.ehlo()
-        start_tls = smtp_server.starttls()
+        smtp_server.starttls()
 
         try:
-            status, message = smtp_server.login(self.smtp_user, self.password)
-        except smtplib.SMTPAuthenticationError as e:
-            # Logout to close any connetions and then set False to show failure
+            smtp_server.login(self.smtp_user, self.password)
+        except smtplib.SMTPAuthenticationError:
+            _close_smtp(smtp_server)
+            raise
+
+        return smtp_server
+
+    def _connect_imap(self):
+        """Gets a logged in IMAP connection, from the pool if possible"""
+
+        imap_server = _POOL.acquire(
+            self._imap_key, _check_imap, _close_imap, self.pool_max_idle
+        )
+
+        if imap_server is not None:
+            return imap_server
+
+        imap_server = imaplib.IMAP4_SSL(self.imap_host, 993)
+
+        try:
+            imap_server.login(self.imap_user, self.password)
+        except (imaplib.IMAP4.error, socket.error):
+            _close_imap(imap_server)
+            raise
+
+        return imap_server
+
+    def login(self):
+        # gets connections to the smtp and imap servers for mail
+        # send and storage
+
+        try:
+            self.smtp_server = self._connect_smtp()
+        except (smtplib.SMTPException, OSError):
+            # Logout to close any connections and then set False to show failure
             self.logout()
             self.logged_in = False
             return
 
-        self.smtp_server = smtp_server
-
         if self.use_imap:
-            imap_server = imaplib.IMAP4_SSL(self.imap_host, 993)
             try:
-                imap_server.login(self.imap_user, self.password)
-            except socket.error:
-                # Logout to close any connetions and then set False to show failure
+                self.imap_server = self._connect_imap()
+            except (imaplib.IMAP4.error, OSError):
+                # Logout to close any connections and then set False to show failure
                 self.logout()
                 self.logged_in = False
                 return
-
-            self.imap_server = imap_server
         else:
             self.imap_server = None
 
         self.logged_in = True
 
     def logout(self):
+        # stores any pending messages and then returns the connections to the pool
+
+        if self._imap_pending or self.imap_server is not None:
+            self._store_pending()
 
         if self.smtp_server is not None:
-            self.smtp_server.quit()
+            _POOL.release(self._smtp_key, self.smtp_server, _close_smtp, self.pool_size)
+            self.smtp_server = None
 
         if self.imap_server is not None:
-            self.imap_server.logout()
+            _POOL.release(self._imap_key, self.imap_server, _close_imap, self.pool_size)
+            self.imap_server = None
 
         self.logged_in = None
 
+        self._log.flush()
+
+    def _send(self, message):
+        """Sends a message, reconnecting once if the pooled connection has dropped
+
+        If the reconnection fails, the session is marked as not logged in, so that
+        later sends fail cleanly rather than using the missing connection.
+        """
+
+        try:
+            self.smtp_server.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            _close_smtp(self.smtp_server)
+            self.smtp_server = None
+
+            try:
+                self.smtp_server = self._connect_smtp()
+            except (smtplib.SMTPException, OSError):
+                self.logged_in = False
+                raise
+
+            self.smtp_server.send_message(message)
+
+    def _queue_copy(self, message, log_details):
+        """Adds a sent message to the copies waiting to be stored in the mailbox"""
+
+        copy = dict(message=message.as_string(), log_details=log_details)
+
+        if self._imap_spool is None:
+            os.makedirs(self._imap_spool_folder, exist_ok=True)
+            self._imap_spool_path = os.path.join(
+                self._imap_spool_folder, f"{os.getpid()}_{uuid.uuid4().hex}.jsonl"
+            )
+            self._imap_spool = open(self._imap_spool_path, "a")
+
+        self._imap_spool.write(json.dumps(copy, default=str) + "\n")
+        self._imap_spool.flush()
+
+        self._imap_pending.append(copy)
+
+    def _store_pending(self):
+        """
+        Stores sent messages in the Marking_Reports mailbox. The appends for all of
+        the messages sent in a session are made together at logout, so that storing
+        copies does not add a round trip to the server between each message sent.
+        The spool file for the session is then removed and any copies left in the
+        spool by sessions in processes that have died are stored.
+        """
+
+        pending = self._imap_pending
+        self._imap_pending = []
+
+        self._append_copies(pending)
+
+        if self._imap_spool is not None:
+            self._imap_spool.close()
+            os.remove(self._imap_spool_path)
+            self._imap_spool = None
+            self._imap_spool_path = None
+
+        live = {mail._imap_spool_path for mail in _LIVE_MAILS}
+
+        for path in _claim_spool_files(self._imap_spool_folder, live):
+            self._append_copies(_read_spool(path))
+            os.remove(path)
+
+    def _append_copies(self, copies):
+        """Appends copies of sent messages to the mailbox, logging any failures"""
+
+        for copy in copies:
+            stored = False
+
+            # Try twice, in case a pooled connection has dropped
+            for _ in range(2):
+                try:
+                    if self.imap_server is None:
+                        self.imap_server = self._connect_imap()
+
+                    status, _ = self.imap_server.append(
+                        '"Marking_Reports"',
+                        "\\Seen",
+                        imaplib.Time2Internaldate(time.time()),
+                        copy["message"].encode("utf-8"),
+                    )
+                    stored = status == "OK"
+                    break
+                except (imaplib.IMAP4.abort, OSError):
+                    # Discard the dropped connection so that a new one is used
+                    if self.imap_server is not None:
+                        _close_imap(self.imap_server)
+                        self.imap_server = None
+                except imaplib.IMAP4.error:
+                    break
+
+            if not stored:
+                self._logmail(
+                    False,
+                    "Message did not store (IMAP error) - it _did_ send",
+                    **copy["log_details"]
+                )
+
     def sendmail(
         self,
         to,
@@ -89,11 +666,13 @@ class Mail:
         email_template=None,
         email_template_dict=None,
         text=None,
+        html_body=None,
     ):
         """
         This sends an html body text to a recipient, including a text representation.
         If the Mail instance hasn't already been logged in, then it will log in
-        just for this email.
+        just for this email. An already rendered html_body can be provided with the
+        template name and data, which are then only used for the email log.
         """
 
         if self.logged_in is None:
@@ -138,18 +717,19 @@ class Mail:
         # as the content if provided
         if text is not None:
             message.attach(MIMEText(text, "plain"))
-        elif email_template is not None and email_template_dict is not None:
-            html_body = current.response.render(
-                "email_templates/" + email_template, email_template_dict
-            )
-            message.attach(MIMEText(html2text.html2text(html_body), "plain"))
+        elif html_body is not None or (
+            email_template is not None and email_template_dict is not None
+        ):
+            if html_body is None:
+                html_body = render_email_template(email_template, email_template_dict)
+            message.attach(MIMEText(html_to_text(html_body), "plain"))
             message.attach(MIMEText(html_body, "html"))
         else:
             raise RuntimeError("text or email template and data required")
 
         try:
-            self.smtp_server.send_message(message)
-        except smtplib.SMTPException:
+            self._send(message)
+        except (smtplib.SMTPException, OSError):
             self._logmail(
                 False,
                 "Message did not send (SMTP error)",
@@ -158,31 +738,24 @@ class Mail:
                 email_template=email_template,
                 email_template_dict=email_template_dict,
             )
+
+            if local_login:
+                self.logout()
+
             return False
 
-        # If IMAP is being used, save the message to the Marking_Reports folder.
+        # If IMAP is being used, queue the message to be saved to the Marking_Reports
+        # folder when the session logs out.
         if self.use_imap:
-            try:
-                self.imap_server.append(
-                    '"Marking_Reports"',
-                    "\\Seen",
-                    imaplib.Time2Internaldate(time.time()),
-                    message.as_bytes(),
-                )
-            except socket.error:
-                self._logmail(
-                    False,
-                    "Message did not store (IMAP error) - it _did_ send",
+            self._queue_copy(
+                message,
+                dict(
                     to=to,
                     subject=subject,
                     email_template=email_template,
                     email_template_dict=email_template_dict,
-                )
-
-                return False
-
-        if local_login:
-            self.logout()
+                ),
+            )
 
         self._logmail(
             True,
@@ -193,12 +766,15 @@ class Mail:
             email_template_dict=email_template_dict,
         )
 
+        if local_login:
+            self.logout()
+
         return True
 
     def _logmail(self, sent, status, to, subject, email_template, email_template_dict):
 
-        # log it in the database
-        current.db.email_log.insert(
+        # log it in the buffer, which is flushed to the database on logout
+        self._log.add(
             email_to=to,
             subject=subject,
             email_template=email_template,
@@ -208,4 +784,7 @@ class Mail:
             status=status,
             message_date=datetime.datetime.now(),
         )
-        current.db.commit()
+
+        # Outside of a logged in session, write the entry straight away
+        if not self.logged_in:
+            self._log.flush()
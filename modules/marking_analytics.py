@@ -0,0 +1,317 @@
+## --------------------------------------------------------------------------------
+## MARKING ANALYTICS
+## Summaries of the submitted grades for an academic year, used to check marking
+## consistency. The numeric grades from the assignment_grades table are loaded with
+## a single query into NumPy arrays and all of the statistics are calculated across
+## the whole cohort at once using group indices, rather than looping over students
+## or markers:
+## - the grade distribution for each course presentation and marking role,
+## - the bias of each marker: the mean difference between their grades and the mean
+##   grade for the presentation and role,
+## - the differences between markers where a student has more than one report for
+##   the same role (double marking) and a list of students where that difference
+##   is larger than a threshold.
+## --------------------------------------------------------------------------------
+import numpy as np
+
+from gluon import current
+
+
+def load_grades(academic_year, field_name="grade"):
+    """Loads the numeric grades from submitted reports for a year
+
+    Returns a dictionary of arrays giving the student presentation, course
+    presentation, marking role, marker and grade for each report.
+    """
+
+    db = current.db
+
+    sql = db(
+        (db.assignment_grades.field_name == field_name)
+        & (db.assignment_grades.grade_percent != None)
+        & (db.assignment_grades.assignment == db.assignments.id)
+        & (db.assignments.status.belongs(["Submitted", "Released"]))
+        & (db.assignments.student_presentation == db.student_presentations.id)
+        & (db.student_presentations.academic_year == academic_year),
+        ignore_common_filters=True,
+    )._select(
+        db.assignments.student_presentation,
+        db.student_presentations.course_presentation,
+        db.assignments.marker_role_id,
+        db.assignments.marker,
+        db.assignment_grades.grade_percent,
+    )
+
+    data = np.array(db.executesql(sql), dtype=float).reshape(-1, 5)
+    ids = data[:, :4].astype(int)
+
+    return dict(
+        student_presentation=ids[:, 0],
+        presentation=ids[:, 1],
+        role=ids[:, 2],
+        marker=ids[:, 3],
+        grade=data[:, 4],
+    )
+
+
+def _groups(*keys):
+    """Returns the unique combinations of a set of key arrays and the group index
+    of each value"""
+
+    unique, inverse = np.unique(np.column_stack(keys), axis=0, return_inverse=True)
+
+    return unique, inverse.reshape(-1)
+
+
+def _group_stats(inverse, values):
+    """Calculates summary statistics of values within each group"""
+
+    n_groups = inverse.max() + 1 if len(inverse) else 0
+
+    n = np.bincount(inverse, minlength=n_groups)
+    mean = np.bincount(inverse, weights=values, minlength=n_groups) / n
+    sq_dev = np.bincount(
+        inverse, weights=(values - mean[inverse]) ** 2, minlength=n_groups
+    )
+    sd = np.sqrt(sq_dev / np.maximum(n - 1, 1))
+
+    # Sort values within groups and interpolate quantiles from the group offsets
+    sorted_values = values[np.lexsort((values, inverse))]
+    starts = np.cumsum(n) - n
+
+    def _quantile(q):
+        pos = starts + q * (n - 1)
+        lower = np.floor(pos).astype(int)
+        upper = np.ceil(pos).astype(int)
+        return sorted_values[lower] + (
+            sorted_values[upper] - sorted_values[lower]
+        ) * (pos - lower)
+
+    return dict(
+        n=n,
+        mean=mean,
+        sd=sd,
+        min=_quantile(0),
+        q1=_quantile(0.25),
+        median=_quantile(0.5),
+        q3=_quantile(0.75),
+        max=_quantile(1),
+    )
+
+
+def presentation_distributions(grades):
+    """Grade distributions by course presentation and marking role"""
+
+    keys, inverse = _groups(grades["presentation"], grades["role"])
+    stats = _group_stats(inverse, grades["grade"])
+
+    return dict(presentation=keys[:, 0], role=keys[:, 1], **stats)
+
+
+def marker_bias(grades):
+    """The bias of each marker against the cohort
+
+    The bias is the mean difference between the grades given by a marker and the
+    mean grade for the course presentation and role of each report.
+    """
+
+    _, cohort = _groups(grades["presentation"], grades["role"])
+    cohort_mean = _group_stats(cohort, grades["grade"])["mean"]
+    deviation = grades["grade"] - cohort_mean[cohort]
+
+    markers, inverse = _groups(grades["marker"])
+    stats = _group_stats(inverse, deviation)
+    mean_grade = _group_stats(inverse, grades["grade"])["mean"]
+
+    return dict(
+        marker=markers[:, 0],
+        n=stats["n"],
+        mean_grade=mean_grade,
+        bias=stats["mean"],
+        sd=stats["sd"],
+    )
+
+
+def marker_differences(grades, threshold):
+    """Differences between grades for students with more than one report in a role
+
+    Returns a summary of the differences for each role and a list of the students
+    where the range of grades is greater than the threshold.
+    """
+
+    keys, inverse = _groups(grades["student_presentation"], grades["role"])
+    stats = _group_stats(inverse, grades["grade"])
+
+    spread = stats["max"] - stats["min"]
+    multiple = stats["n"] > 1
+    flagged = multiple & (spread > threshold)
+
+    # Summarise by role over the groups with more than one report
+    roles, role_inverse = _groups(keys[multiple, 1])
+    role_stats = _group_stats(role_inverse, spread[multiple])
+    n_flagged = np.bincount(
+        role_inverse, weights=flagged[multiple].astype(float), minlength=len(roles)
+    )
+
+    summary = dict(
+        role=roles[:, 0],
+        n=role_stats["n"],
+        mean_difference=role_stats["mean"],
+        max_difference=role_stats["max"],
+        n_flagged=n_flagged.astype(int),
+    )
+
+    # Get the individual reports for the flagged groups
+    order = np.argsort(inverse, kind="stable")
+    starts = np.cumsum(stats["n"]) - stats["n"]
+
+    flags = []
+    for grp in np.flatnonzero(flagged):
+        members = order[starts[grp] : starts[grp] + stats["n"][grp]]
+        flags.append(
+            dict(
+                student_presentation=int(keys[grp, 0]),
+                role=int(keys[grp, 1]),
+                difference=spread[grp],
+                markers=grades["marker"][members].tolist(),
+                grades=grades["grade"][members].tolist(),
+            )
+        )
+
+    return summary, flags
+
+
+def grade_analytics(academic_year, threshold=10):
+    """Calculates the marking analytics for a year
+
+    Returns a dictionary of tables, each a dictionary containing a list of column
+    headers and a list of rows, with database ids replaced by names.
+    """
+
+    db = current.db
+    grades = load_grades(academic_year)
+
+    distributions = presentation_distributions(grades)
+    bias = marker_bias(grades)
+    differences, flags = marker_differences(grades, threshold)
+
+    # Name lookups for the ids
+    presentations = db(
+        db.course_presentations.id.belongs(set(grades["presentation"].tolist())),
+        ignore_common_filters=True,
+    ).select(db.course_presentations.id, db.course_presentations.name)
+    presentations = {rw.id: rw.name for rw in presentations}
+
+    roles = db(db.marking_roles.id.belongs(set(grades["role"].tolist()))).select(
+        db.marking_roles.id, db.marking_roles.name
+    )
+    roles = {rw.id: rw.name for rw in roles}
+
+    markers = db(
+        db.teaching_staff.id.belongs(set(grades["marker"].tolist())),
+        ignore_common_filters=True,
+    ).select(
+        db.teaching_staff.id,
+        db.teaching_staff.first_name,
+        db.teaching_staff.last_name,
+    )
+    markers = {rw.id: f"{rw.last_name}, {rw.first_name}" for rw in markers}
+
+    students = db(
+        db.student_presentations.id.belongs([fl["student_presentation"] for fl in flags])
+        & (db.student_presentations.student == db.students.id)
+    ).select(
+        db.student_presentations.id,
+        db.students.student_first_name,
+        db.students.student_last_name,
+    )
+    students = {
+        rw.student_presentations.id: f"{rw.students.student_last_name}, "
+        f"{rw.students.student_first_name}"
+        for rw in students
+    }
+
+    def _round(val):
+        return round(float(val), 1)
+
+    tables = dict(
+        distributions=dict(
+            headers=[
+                "Presentation",
+                "Role",
+                "N",
+                "Mean",
+                "SD",
+                "Min",
+                "Q1",
+                "Median",
+                "Q3",
+                "Max",
+            ],
+            rows=[
+                [presentations.get(pr), roles.get(rl), int(n)]
+                + [_round(v) for v in vals]
+                for pr, rl, n, *vals in zip(
+                    distributions["presentation"],
+                    distributions["role"],
+                    distributions["n"],
+                    distributions["mean"],
+                    distributions["sd"],
+                    distributions["min"],
+                    distributions["q1"],
+                    distributions["median"],
+                    distributions["q3"],
+                    distributions["max"],
+                )
+            ],
+        ),
+        bias=dict(
+            headers=["Marker", "Reports", "Mean grade", "Bias", "SD of bias"],
+            rows=[
+                [markers.get(mk), int(n), _round(mn), _round(bs), _round(sd)]
+                for mk, n, mn, bs, sd in zip(
+                    bias["marker"],
+                    bias["n"],
+                    bias["mean_grade"],
+                    bias["bias"],
+                    bias["sd"],
+                )
+            ],
+        ),
+        differences=dict(
+            headers=[
+                "Role",
+                "Double marked",
+                "Mean difference",
+                "Max difference",
+                f"Over {threshold}",
+            ],
+            rows=[
+                [roles.get(rl), int(n), _round(mn), _round(mx), int(fl)]
+                for rl, n, mn, mx, fl in zip(
+                    differences["role"],
+                    differences["n"],
+                    differences["mean_difference"],
+                    differences["max_difference"],
+                    differences["n_flagged"],
+                )
+            ],
+        ),
+        flags=dict(
+            headers=["Student", "Role", "Difference", "Grades"],
+            rows=[
+                [
+                    students.get(fl["student_presentation"]),
+                    roles.get(fl["role"]),
+                    _round(fl["difference"]),
+                    "; ".join(
+                        f"{markers.get(mk)} ({int(gr)})"
+                        for mk, gr in zip(fl["markers"], fl["grades"])
+                    ),
+                ]
+                for fl in sorted(flags, key=lambda fl: -fl["difference"])
+            ],
+        ),
+    )
+
+    return tables
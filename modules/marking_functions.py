@@ -6,19 +6,23 @@ import itertools
 import zipfile
 import io
 import re
+import hashlib
 import openpyxl
 import simplejson as json
-from collections import Counter
+from collections import deque
+from openpyxl.cell import WriteOnlyCell
 from itertools import groupby
-import fpdf
 import importlib
 from tempfile import NamedTemporaryFile
-from mailer import Mail
+from pdf_cache import PDFCache
+from report_pdf import render_pdf, render_pdfs, pdf_filename
+from mail_queue import queue_mail_job
 
 from gluon import (current, SQLFORM, DIV, LABEL, CAT, B, P, A, SPAN, INPUT,
                    URL, HTTP, BR, TABLE, H2, H4, XML, Field, IS_NULL_OR, IS_IN_SET)
 
 from gluon.sqlhtml import OptionsWidget
+from pydal.objects import Row, Query
 
 """
 This module contains key functions for processing marking reports. They have been 
@@ -136,20 +140,80 @@ def div_checkbox_widget_list_group(field, value, **attributes):
 ## LOCAL FUNCTIONS USED BY THE ASSIGNMENT PAGE TO TAKE ACTIONS ON SETS OF RECORD IDS
 ## --------------------------------------------------------------------------------
 
+def assignment_id_select(ids):
+    
+    """
+    The action functions accept either a list of assignment ids or a query that
+    selects assignments, such as the search query from the assignments grid. This
+    returns something that can be passed to belongs() for either: the list itself
+    or a nested SELECT of the assignment ids, so that the database finds the ids
+    and large selections are not loaded and sent back as long IN clauses.
+    """
+    
+    if isinstance(ids, Query):
+        db = current.db
+        return db(ids)._select(db.assignments.id)
+    
+    return ids
+
+
+def _count_assignments(ids):
+    
+    """Counts the assignments in a list of ids or a query"""
+    
+    if isinstance(ids, Query):
+        return current.db(ids).count(distinct=current.db.assignments.id)
+    
+    return len(ids)
+
+
+def _transition_status(ids, from_status, to_status, expected):
+    
+    """
+    Changes the status of the assignments in ids that currently have from_status
+    to to_status, using a single update conditional on the status, and increments
+    the assignment versions. The caller gives the number of assignments it found
+    with from_status when it read the selection. If another request has changed
+    any of the same assignments since then, a different number of rows is updated,
+    so the transaction is rolled back and None is returned so that a bulk action is
+    never run twice on the same assignments. Otherwise, the number of assignments
+    moved is returned.
+    """
+    
+    db = current.db
+    id_select = assignment_id_select(ids)
+    
+    updated = db((db.assignments.id.belongs(id_select)) &
+                 (db.assignments.status == from_status)
+                 ).update(status=to_status,
+                          version=db.assignments.version.coalesce_zero() + 1)
+    
+    if updated != expected:
+        db.rollback()
+        return None
+    
+    return updated
+
+
 def release(ids):
     
     """
-    Local function to email reports to students. It will only email released reports.
+    Local function to email reports to students. It releases submitted reports and
+    emails the links to all released reports in the selection, so repeating a
+    release re-sends the links for reports that were already released. The emails
+    are added to the mail queue rather than being sent immediately.
     """
     
     db = current.db    
+    id_select = assignment_id_select(ids)
     
-    qry_by_select_ids = ((db.assignments.id.belongs(ids)) &
+    qry_by_select_ids = ((db.assignments.id.belongs(id_select)) &
                          (db.assignments.status.belongs(['Submitted', 'Released'])))
     
-    db(qry_by_select_ids).update(status='Released')
-    
-    # Find students covered by these records
+    # Find students covered by these records. This is done before the status is 
+    # changed, because a selection query might itself depend on the status.
+    n_row = _count_assignments(ids)
+    markers = markers_for_assignments(ids)
     email = db(qry_by_select_ids & 
                (db.assignments.student_presentation == db.student_presentations.id) &
                (db.student_presentations.student == db.students.id)
@@ -159,7 +223,19 @@ def release(ids):
                         db.students.student_access_token,
                         db.assignments.marker,
                         db.assignments.marker_role_id,
-                        db.assignments.id)
+                        db.assignments.id,
+                        db.assignments.status)
+    
+    n_submitted = len([rec for rec in email if rec.assignments.status == 'Submitted'])
+    moved = _transition_status(ids, 'Submitted', 'Released', n_submitted)
+    
+    if moved is None:
+        current.session.flash = ('Some of the selected assignments were changed by another '
+                                 'user while they were being released. No emails have been '
+                                 'queued, please try again.')
+        return
+    
+    update_marker_progress(markers)
     
     # now group by student email (can't compare rows, so use unique email)
     # and then create groups of records using students detail tuples as keys
@@ -169,10 +245,8 @@ def release(ids):
                       for k, recs 
                       in itertools.groupby(email, lambda x: (x['students']))}
 
-    # Create a mailer instance to send multiple emails using the same connection
-    fails = 0
-    mailer = Mail()
-    mailer.login()
+    # Build the messages and add them to the mail queue
+    messages = []
     
     for (st_email, st_first, st_last, token), recs in student_blocks.items():
         
@@ -186,23 +260,19 @@ def release(ids):
                                          'student_access_token': token}))))
                 for r in recs]
         
-        success = mailer.sendmail(subject='Your Project Marking Reports', 
-                                  to=st_email, 
-                                  email_template='student_release.html',
-                                  email_template_dict={'name':f"{st_first} {st_last}",
-                                                       'links':CAT(links).xml()})
-        
-        if not success:
-            fails += 1
+        messages.append(dict(subject='Your Project Marking Reports', 
+                             to=st_email, 
+                             email_template='student_release.html',
+                             email_template_dict={'name':f"{st_first} {st_last}",
+                                                  'links':CAT(links).xml()}))
     
-    mailer.logout()
-    del mailer
+    queue_mail_job('Release to students', messages)
     
     # give some feedback
-    msg = 'Emailed {} released records from {} selected rows to {} students'.format(
-            len(email), len(ids), len(student_blocks) - fails)
-    if fails > 0:
-        msg = msg + "Warning: FAILED to send {} emails. Review email log.".format(fails)
+    msg = ('Released {} submitted records from {} selected rows. Queued emails for {} '
+           'released records to {} students, re-sending {} records that were already '
+           'released. Sending progress is shown below.').format(
+               moved, n_row, len(email), len(student_blocks), len(email) - moved)
     
     current.session.flash = msg
 
@@ -212,18 +282,22 @@ def distribute(ids):
     """
     This local function emails a set of records out to the relevant markers
     Note that this can be repeated to send reminders but won't email submitted
-    or released reports, to avoid hassling markers!
+    or released reports, to avoid hassling markers! The emails are added to the
+    mail queue rather than being sent immediately.
     """
     
     db = current.db
+    id_select = assignment_id_select(ids)
     
-    # Update the database to show distribution: Created -> Not started
-    qry_by_select_ids = db.assignments.id.belongs(ids)
-    db(qry_by_select_ids & (db.assignments.status == 'Created')).update(status='Not started')
+    qry_by_select_ids = db.assignments.id.belongs(id_select)
     
-    # Find the uncompleted records and group by marker and role
+    # Find the uncompleted records, including those about to be distributed, and
+    # group by marker and role. This is done before the status is changed, because
+    # a selection query might itself depend on the status.
+    n_row = _count_assignments(ids)
+    markers = markers_for_assignments(ids)
     email = db(qry_by_select_ids & 
-               (db.assignments.status.belongs(['Not started', 'Started'])) &
+               (db.assignments.status.belongs(['Created', 'Not started', 'Started'])) &
                (db.assignments.marker == db.teaching_staff.id)
                ).select(db.assignments.marker,
                         db.teaching_staff.id,
@@ -237,6 +311,17 @@ def distribute(ids):
                                  db.teaching_staff.first_name,
                                  db.assignments.marker_role_id))
     
+    n_created = db(qry_by_select_ids & (db.assignments.status == 'Created')).count()
+    
+    # Update the database to show distribution: Created -> Not started
+    if _transition_status(ids, 'Created', 'Not started', n_created) is None:
+        current.session.flash = ('Some of the selected assignments were changed by another '
+                                 'user while they were being distributed. No emails have been '
+                                 'queued, please try again.')
+        return
+    
+    update_marker_progress(markers)
+    
     # now render to text values and group by marker
     email = [e for e in email.render()]
     email.sort(key= lambda rec: rec['teaching_staff.email'])
@@ -244,12 +329,8 @@ def distribute(ids):
                      for k, recs 
                      in itertools.groupby(email, lambda x: x['teaching_staff.email'])}
     
-    # Create a mailer instance to send multiple emails using the same connection
-    rec_fails = 0
-    mail_fails = 0
-    
-    mailer = Mail()
-    mailer.login()
+    # Build the messages and add them to the mail queue
+    messages = []
     
     for marker, recs in marker_blocks.items():
         
@@ -260,24 +341,18 @@ def distribute(ids):
         login_url = URL('staff', 'staff_login', scheme=True, host=True,
                                   vars={'email': marker})
         
-        success = mailer.sendmail(subject='Silwood Park Masters Project Marking', 
-                                  to=marker, email_template='marker_distribute.html',
-                                  email_template_dict={'name':recs[0].teaching_staff.first_name,
-                                                       'reports_to_submit': reports_to_submit,
-                                                       'login_url': login_url})
-        
-        if not success:
-            rec_fails += sum([r.n for r in recs])
-            mail_fails += 1
+        messages.append(dict(subject='Silwood Park Masters Project Marking', 
+                             to=marker, email_template='marker_distribute.html',
+                             email_template_dict={'name':recs[0].teaching_staff.first_name,
+                                                  'reports_to_submit': reports_to_submit,
+                                                  'login_url': login_url}))
     
-    mailer.logout()
-    del mailer
+    queue_mail_job('Send to markers', messages)
     
     # give some feedback
-    n_row = len(ids)
-    msg = f"Emailed {n_row - rec_fails} records from {n_row} selected rows to {len(marker_blocks)} markers."
-    if mail_fails > 0:
-        msg = msg + f" Warning: FAILED to send {mail_fails} emails. Review email log."
+    n_rec = sum([r.n for recs in marker_blocks.values() for r in recs])
+    msg = (f"Queued emails for {n_rec} records from {n_row} selected rows to "
+           f"{len(marker_blocks)} markers. Sending progress is shown below.")
     
     current.session.flash = msg
 
@@ -286,220 +361,839 @@ def zip_pdfs(ids, confidential=False):
     
     """
     Local function to create a zipfile of pdfs for selected records and
-    return it to the user
+    return it to the user. All of the report details are retrieved up front
+    in a single joined query, the PDFs that are not cached are then rendered,
+    using the shared process pool for larger batches (see modules/report_pdf.py),
+    and the zipfile is streamed back to the client as each report is added, 
+    rather than being assembled in memory.
     """
     
     db = current.db
+    id_select = assignment_id_select(ids)
     
-    # create a zipfile of the selected pdfs and return it
-    contents = io.BytesIO()
-    zf = zipfile.ZipFile(contents, mode='w', compression=zipfile.ZIP_DEFLATED)
-    
-    # loop over the ids, creating the correct PDF and adding it.
-    for id in ids:
+    # Get all of the completed assignments along with the rows they reference. The
+    # common filters are ignored so that reports by inactive staff are included.
+    records = db((db.assignments.id.belongs(id_select)) &
+                 (db.assignments.status.belongs(['Submitted','Released'])) &
+                 (db.assignments.student_presentation == db.student_presentations.id) &
+                 (db.student_presentations.student == db.students.id) &
+                 (db.student_presentations.course_presentation == db.course_presentations.id) &
+                 (db.assignments.marker == db.teaching_staff.id) &
+                 (db.assignments.marker_role_id == db.marking_roles.id),
+                 ignore_common_filters=True
+                 ).select(db.assignments.ALL,
+                          db.student_presentations.ALL,
+                          db.students.ALL,
+                          db.course_presentations.ALL,
+                          db.teaching_staff.ALL,
+                          db.marking_roles.ALL,
+                          orderby=db.assignments.id)
+    
+    # Extract everything needed to render each report now, while the database
+    # connection is still available to the request. The form queries are only run 
+    # for reports that are not in the PDF cache, or that might need to be rendered
+    # if a cached file is evicted before it is streamed.
+    cache = PDFCache()
+    details = []
+    in_cache = []
+    
+    for rw in records:
         
-        record = db.assignments(id)
+        this_details = pdf_report_details(rw.assignments, rw.student_presentations,
+                                          rw.students, rw.course_presentations,
+                                          rw.teaching_staff, rw.marking_roles,
+                                          confidential=confidential,
+                                          queries=False)
+        hit = cache.has(this_details)
         
-        # can't create a PDF of incomplete assignments
-        if record.status in ['Submitted','Released']:
-            
-            # create the form
-            pdf, filename = create_pdf(record, confidential=confidential)
-            
-            zf.writestr(filename, pdf)
+        if not hit or _has_query_components(rw.marking_roles.form_json):
+            this_details['queries'] = pdf_report_queries(rw.assignments, 
+                                                         rw.marking_roles,
+                                                         confidential)
+        
+        details.append(this_details)
+        in_cache.append(hit)
     
-    # finalise and return the zip file
-    zf.close()
+    n_workers = current.configuration.get('fpdf.workers') or os.cpu_count()
     
-    current.response.headers['Content-Type'] = 'application/pdf'
     attachment = 'attachment;filename=MarkingRecords.zip'
+    current.response.headers['Content-Type'] = 'application/zip'
     current.response.headers['Content-Disposition'] = attachment
     
-    raise HTTP(200, contents.getvalue(),
-               **{'Content-Type':'application/pdf',
+    raise HTTP(200, _stream_zipped_pdfs(details, in_cache, n_workers, cache),
+               **{'Content-Type':'application/zip',
                   'Content-Disposition':attachment + ';'})
 
 
-def download_grades(ids):
+class _ZipStream(io.RawIOBase):
+    """
+    A write only, unseekable file object used to stream a zipfile. The zipfile
+    module writes into it and drain() hands back the bytes written so far.
+    """
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _has_query_components(form_json):
+    
+    """Checks if a marking form includes any query components"""
+    
+    return any(c['type'] == 'query' 
+               for q in form_json['questions'] for c in q['components'])
+
+
+def _stream_zipped_pdfs(details, in_cache, n_workers, cache):
+    """
+    Generator that renders report PDFs and yields a zipfile containing them
+    in chunks, one chunk for each report added to the archive. Reports found
+    in the PDF cache are read from disk and only the others are rendered.
+    """
+    
+    stream = _ZipStream()
+    
+    rendered = render_pdfs([dt for dt, hit in zip(details, in_cache) if not hit],
+                           n_workers)
+    
+    with zipfile.ZipFile(stream, mode='w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for this_details, hit in zip(details, in_cache):
+            
+            if hit:
+                pdf = cache.get(this_details)
+                # Handle files evicted since the check above
+                if pdf is None:
+                    pdf, _ = render_pdf(this_details)
+            else:
+                pdf, _ = next(rendered)
+                cache.put(this_details, pdf)
+            
+            zf.writestr(pdf_filename(this_details), pdf)
+            yield stream.drain()
+    
+    yield stream.drain()
+
+
+def download_grades(ids, output='xlsx'):
     
     """
     This local function takes a set of rows from the assignments grid
     and returns a collated excel file, one row per student, with the 
-    names and grades in separate columns. 
+    names and grades in separate columns. The output can also be 'csv'.
+    
+    The grades are read from the assignment_grades table rather than from the
+    assignment data. The records are read from the database as an iterator and the rows are
+    written as they are read, so memory use does not grow with the size of
+    the export: the Excel file is built by openpyxl in write only mode and the 
+    CSV file is written to a temporary file. All of the queries run before the
+    response is returned, and the file is then sent back in chunks.
     """
-    db = current.db
     
-    # Extract the data for the assignments to be collated
-    records = db((db.assignments.id.belongs(ids)) &
-                 (db.assignments.student_presentation == db.student_presentations.id) &
-                 (db.student_presentations.student == db.students.id)
-                 ).select(
-                    db.students.student_cid,
-                    db.students.student_last_name,
-                    db.students.student_first_name,
-                    db.student_presentations.course_presentation,
-                    db.student_presentations.academic_year,
-                    db.assignments.marker_role_id,
-                    db.assignments.marker,
-                    db.assignments.assignment_data,
-                    orderby=(db.student_presentations.course_presentation,
-                             db.students.student_cid))
+    today = datetime.date.today().isoformat()
+    rows = _grade_export_rows(ids)
     
-    # Find the set of marking roles in the selected data and then 
-    # get the set of exported details for each role
-    roles = {r.assignments.marker_role_id for r in records}
-    role_export = {}
+    if output == 'csv':
+        # Drop the title and spacer rows from the CSV layout
+        rows = (vals for idx, (vals, bold) in enumerate(rows) if idx > 2)
+        
+        raise HTTP(200, stream_csv_file(rows),
+                   **{'Content-Type': 'text/csv',
+                      'Content-Disposition': f'attachment;filename=Marking_Grades_{today}.csv;'})
     
-    for this_role in roles:
-        role_details = db.marking_roles[this_role]
-        role_export[role_details.name] = role_details.form_json['grade_export']
+    # Now create the write only workbook instance to be populated
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('Grades')
+    hdrfont = openpyxl.styles.Font(bold=True)
+    
+    for vals, bold in rows:
+        if bold:
+            vals = [_bold_cell(ws, v, hdrfont) for v in vals]
+        
+        ws.append(vals)
+    
+    tmp = NamedTemporaryFile()
+    wb.save(tmp)
+    
+    raise HTTP(200, _stream_file(tmp),
+               **{'Content-Type':'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                  'Content-Disposition': f'attachment;filename=Marking_Grades_{today}.xlsx;'})
+
+
+def _bold_cell(ws, value, font):
+    
+    if value is None:
+        return None
+    
+    cell = WriteOnlyCell(ws, value=value)
+    cell.font = font
+    return cell
+
+
+def stream_csv_file(rows):
+    
+    """
+    Writes rows of values as CSV to a temporary file and returns a generator that
+    yields the file contents in chunks. The rows are all written before this returns,
+    so any queries needed to generate them run within the request, rather than
+    while the response is being sent after the database connection is released.
+    """
+    
+    tmp = NamedTemporaryFile()
+    text = io.TextIOWrapper(tmp.file, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    
+    for vals in rows:
+        writer.writerow(vals)
+    
+    text.flush()
+    text.detach()
+    
+    return _stream_file(tmp)
+
+
+def _stream_file(tmp, chunk_size=2**16):
+    """Generator that yields the contents of an open file in chunks and then closes it"""
     
-    # Can now render the records to substitute marker names etc for id values
-    records = list(records.render())
+    with tmp:
+        tmp.seek(0)
+        
+        while True:
+            data = tmp.read(chunk_size)
+            
+            if not data:
+                break
+            
+            yield data
+
+
+def _grade_export_rows(ids):
+    
+    """
+    Generator of the rows in the grade export, as tuples of a list of values 
+    and whether the row is a header row. The first rows give a title and the 
+    headers, followed by one row per student.
+    """
+    
+    db = current.db
+    id_select = assignment_id_select(ids)
+    
+    # The common filters are ignored so that reports by inactive staff are included
+    qry = ((db.assignments.id.belongs(id_select)) &
+           (db.assignments.student_presentation == db.student_presentations.id) &
+           (db.student_presentations.student == db.students.id))
     
     # The next section figures out what columns are being written - the exported
     # values for possibly multiple instances of different roles.
     
     # 1) Get the count of each role by students and hence the maximum number of
-    #    each role across the set of records - might be faster ways of doing this
-    #    using sort and groupby, but this is shorter!
-    student_role_count = Counter([(r.students.student_cid, r.assignments.marker_role_id) for r in records])
-    
-    role_max = {ky:0 for ky in role_export}
-    for (_, rid), val in student_role_count.items():
-        role_max[rid] = max(role_max[rid], val)
-    
-    # 2) Now map export details to columns by marker role. This map is structured
-    # as a list of tuples with the following structure:
-    #    [(role_name, role_instance_name, marker_column, 
-    #      ((export field, column number), ...), 
-    #      ...]
-    # When the assignments for a given student are processed, a copy of the map is taken
-    # and then the role ids for the student can be used to pop off a map entry with
-    # matching role id for each assignment in turn
+    #    each role across the set of records
+    student_role_count = db(qry, ignore_common_filters=True).select(
+                            db.students.student_cid,
+                            db.assignments.marker_role_id,
+                            db.assignments.id.count().with_alias('n'),
+                            groupby=(db.students.student_cid, 
+                                     db.assignments.marker_role_id))
+    
+    role_max = {}
+    for rw in student_role_count:
+        rid = rw.assignments.marker_role_id
+        role_max[rid] = max(role_max.get(rid, 0), rw.n)
+    
+    # Get the set of exported details for each role
+    roles = db(db.marking_roles.id.belongs(list(role_max))).select(
+                db.marking_roles.id,
+                db.marking_roles.name,
+                db.marking_roles.form_json,
+                orderby=db.marking_roles.name)
+    
+    # 2) Now map export details to columns by marker role. This plan is structured
+    # as a dictionary keyed by role name of lists of slots with the following structure:
+    #    {role_name: [(role_instance_name, marker_column, 
+    #                  ((export field, column number), ...)), 
+    #                 ...]}
+    # When the assignments for a given student are processed, each list is copied into
+    # a queue and the next slot for a role is taken off the queue for each assignment.
     
     data_col = 6
-    field_map = []
+    field_plan = {}
     
-    for this_role, this_max in role_max.items():
+    for this_role in roles:
         # get the role export details
-        these_fields = role_export[this_role]
+        these_fields = this_role.form_json['grade_export']
         n_fields = len(these_fields)
+        slots = []
         
-        for this_copy in range(this_max):
+        for this_copy in range(role_max[this_role.id]):
             # get the tuple contents and increment the columns
-            this_name = this_role + '_' + str(this_copy + 1)
+            this_name = this_role.name + '_' + str(this_copy + 1)
             marker_col = data_col
             these_columns = list(range(data_col + 1, data_col + 1 + n_fields))
             data_col += n_fields + 1
-            field_map.append((this_role, this_name, marker_col, list(zip(these_fields, these_columns))))
-    
-    # Now create the workbook instance to be populated
-    wb = openpyxl.Workbook()
-    hdrfont = openpyxl.styles.Font(bold=True)
-
-    # name the worksheet and add a heading
-    ws = wb.active
-    ws.title = 'Grades'
-    ws.cell(row=1, column=1, value= f'Grades downloaded {datetime.datetime.today().isoformat()}')
-    ws.cell(row=1, column=1).font = hdrfont
-    
-    # Layout the standard headers
-    data_row = 6
-    hdr_row = data_row - 1  # Contains the field name
-    role_row = data_row - 2  # Contains role header to discriminate fields
-    
-    std_headers = [(1, 'CID'),
-                   (2, 'Last Name'),
-                   (3, 'First Name'),
-                   (4, 'Course Presentation'),
-                   (5, 'Year')]
-    
-    for col, hdr in std_headers:
-        cell = ws.cell(row=hdr_row, column=col)
-        cell.value = hdr
-        cell.font = hdrfont
-    
-    # Write the field map structure to the header rows
-    for _, role, marker, fields in field_map:
-        # insert the role header
-        cell = ws.cell(row = role_row, column = marker)
-        cell.value = role
-        cell.font = hdrfont
+            slots.append((this_name, marker_col, list(zip(these_fields, these_columns))))
         
-        # Marker column
-        cell = ws.cell(row = hdr_row, column = marker)
-        cell.value = 'marker'
-        cell.font = hdrfont
-        
-        # insert the field headers
-        for hdr, col in fields:
-            cell = ws.cell(row = hdr_row, column = col)
-            cell.value = hdr
-            cell.font = hdrfont
+        field_plan[this_role.name] = slots
+    
+    n_cols = data_col - 1
+    
+    # Title row, two blank rows and then the role and field header rows
+    yield [f'Grades downloaded {datetime.datetime.today().isoformat()}'], True
+    yield [], False
+    yield [], False
     
-    # A regex to convert '65% (B)' grades to numeric
-    grade_regex = re.compile('[0-9]+(?=%)')
+    role_hdr = [None] * n_cols
+    field_hdr = ['CID', 'Last Name', 'First Name', 'Course Presentation', 'Year']
+    field_hdr += [None] * (n_cols - len(field_hdr))
+    
+    for slots in field_plan.values():
+        for role, marker, fields in slots:
+            role_hdr[marker - 1] = role
+            field_hdr[marker - 1] = 'marker'
+            
+            for hdr, col in fields:
+                field_hdr[col - 1] = hdr
+    
+    yield role_hdr, True
+    yield field_hdr, True
+    
+    # Now iterate over the records, including the names of linked rows and the 
+    # exported grades, giving a row per grade field
+    records = db(qry &
+                 (db.student_presentations.course_presentation == db.course_presentations.id) &
+                 (db.assignments.marker == db.teaching_staff.id) &
+                 (db.assignments.marker_role_id == db.marking_roles.id),
+                 ignore_common_filters=True
+                 ).iterselect(
+                    db.students.student_cid,
+                    db.students.student_last_name,
+                    db.students.student_first_name,
+                    db.course_presentations.name,
+                    db.student_presentations.academic_year,
+                    db.assignments.id,
+                    db.marking_roles.name,
+                    db.teaching_staff.first_name,
+                    db.teaching_staff.last_name,
+                    db.assignment_grades.field_name,
+                    db.assignment_grades.grade_text,
+                    db.assignment_grades.grade_percent,
+                    left=db.assignment_grades.on(
+                        db.assignment_grades.assignment == db.assignments.id),
+                    orderby=(db.student_presentations.course_presentation,
+                             db.students.student_cid,
+                             db.assignments.id))
     
-    # Now group records by student and export to rows
+    # Group records by student and export to rows
     grouped_records = groupby(records, key=lambda row: row.students.student_cid)
     
-    for rw_idx, (this_student, student_records) in enumerate(grouped_records):
+    for this_student, student_records in grouped_records:
         
-        # Populate a list of the records
-        student_records = list(student_records)
+        this_row = [None] * n_cols
         
-        this_row = data_row + rw_idx
+        # Copy the field plan into queues for this student
+        this_plan = {role: deque(slots) for role, slots in field_plan.items()}
         
-        # write out the student details from the first entry
-        first = student_records[0]
-        ws.cell(row=this_row, column=1, value=first.students.student_cid)
-        ws.cell(row=this_row, column=2, value=first.students.student_last_name)
-        ws.cell(row=this_row, column=3, value=first.students.student_first_name)
-        ws.cell(row=this_row, column=4, value=first.student_presentations.course_presentation)
-        ws.cell(row=this_row, column=5, value=first.student_presentations.academic_year)
+        # Loop over the student assignments
+        for _, grade_rows in groupby(student_records, key=lambda row: row.assignments.id):
+            
+            grade_rows = list(grade_rows)
+            rec = grade_rows[0]
+            
+            # write out the student details
+            this_row[:5] = [rec.students.student_cid,
+                            rec.students.student_last_name,
+                            rec.students.student_first_name,
+                            rec.course_presentations.name,
+                            rec.student_presentations.academic_year]
+            
+            # Take a role slot from the queue for the record
+            _, marker_col, fields = this_plan[rec.marking_roles.name].popleft()
+            
+            # put in the marker
+            this_row[marker_col - 1] = (f'{rec.teaching_staff.first_name} '
+                                        f'{rec.teaching_staff.last_name}')
+            
+            # Fill in the fields to be exported - the grade table might not contain
+            # the field if the form has changed since the grades were stored
+            grades = {rw.assignment_grades.field_name: rw.assignment_grades 
+                      for rw in grade_rows}
+            
+            for fld, col in fields:
+                this_row[col - 1] = export_grade_value(grades.get(fld))
         
-        # Copy the field map for this student
-        this_map = field_map.copy()
+        yield this_row, False
+
+## --------------------------------------------------------------------------------
+## GRADE TABLE
+## The exported grades from each assignment are copied into the assignment_grades
+## table whenever the assignment data changes, so that grades can be read without
+## decoding the assignment data JSON.
+## --------------------------------------------------------------------------------
+
+# A regex to convert '65% (B)' grades to numeric
+GRADE_REGEX = re.compile('[0-9]+(?=%)')
+
+
+def update_assignment_grades(ids):
+    
+    """
+    Replaces the rows in the assignment_grades table for a set of assignment ids,
+    using the grade_export fields from the form for each assignment role. This
+    does not commit, so the grades are updated in the same transaction as the
+    assignment data.
+    """
+    
+    db = current.db
+    id_select = assignment_id_select(ids)
+    
+    records = db((db.assignments.id.belongs(id_select)) &
+                 (db.assignments.marker_role_id == db.marking_roles.id),
+                 ignore_common_filters=True
+                 ).select(db.assignments.id,
+                          db.assignments.assignment_data,
+                          db.marking_roles.form_json)
+    
+    db(db.assignment_grades.assignment.belongs(id_select)).delete()
+    
+    grades = []
+    
+    for rec in records:
+        
+        report_data = rec.assignments.assignment_data or {}
         
-        # Loop over the student records
-        for rec in student_records:
+        for position, fld in enumerate(rec.marking_roles.form_json['grade_export']):
             
-            # Pop a role slot from the map for the record
-            role_slot_index = [mp[0] for mp in this_map].index(rec.assignments.marker_role_id)
-            role_slot = this_map.pop(role_slot_index)
+            val = report_data.get(fld)
+            val = None if val is None else str(val)
+            perc_grade = None if val is None else GRADE_REGEX.match(val)
             
-            # put in the marker
-            ws.cell(row = this_row, column = role_slot[2], value = rec.assignments.marker)
+            grades.append(dict(assignment=rec.assignments.id,
+                               field_name=fld,
+                               position=position,
+                               grade_text=val,
+                               grade_percent=None if perc_grade is None 
+                                             else int(perc_grade.group(0))))
+    
+    db.assignment_grades.bulk_insert(grades)
+
+
+def rebuild_assignment_grades(chunk_size=500):
+    
+    """
+    Rebuilds the assignment_grades table for all assignments, to backfill the
+    table for existing records. Returns the number of assignments processed.
+    """
+    
+    db = current.db
+    
+    ids = db(db.assignments, ignore_common_filters=True).select(db.assignments.id)
+    ids = [rw.id for rw in ids]
+    
+    for idx in range(0, len(ids), chunk_size):
+        update_assignment_grades(ids[idx:idx + chunk_size])
+    
+    return len(ids)
+
+
+# Set once the grade table has been checked by this process
+_GRADES_CHECKED = set()
+
+
+def backfill_assignment_grades(chunk_size=500):
+    
+    """
+    Adds the assignment_grades rows for assignments that do not have any, such as
+    assignments created before the table existed, so that the grade downloads and
+    reports never read a missing grade. This is called by the marking model and only
+    checks the table once in each process. It does not depend on the migrate setting.
+    Assignments whose role form has no grade_export fields have no rows, so they are
+    rebuilt again by each new process, which is cheap.
+    """
+    
+    if 'assignment_grades' in _GRADES_CHECKED:
+        return
+    
+    db = current.db
+    grades = db.assignment_grades
+    
+    missing = db(~db.assignments.id.belongs(db(grades)._select(grades.assignment,
+                                                                 distinct=True)),
+                 ignore_common_filters=True).select(db.assignments.id)
+    missing = [rw.id for rw in missing]
+    
+    if missing:
+        for idx in range(0, len(missing), chunk_size):
+            update_assignment_grades(missing[idx:idx + chunk_size])
+        db.commit()
+    
+    _GRADES_CHECKED.add('assignment_grades')
+
+
+def export_grade_value(grade):
+    
+    """
+    Returns the exported value of an assignment_grades row: the numeric percentage
+    if there is one, otherwise the text or NA if the field is missing.
+    """
+    
+    if grade is None or grade.grade_text is None:
+        return 'NA'
+    
+    if grade.grade_percent is not None:
+        return grade.grade_percent
+    
+    return grade.grade_text
+
+
+## --------------------------------------------------------------------------------
+## MARKER PROGRESS COUNTS
+## The counts of assignments by marker, role, status and year in the 
+## marker_progress_counts table are recalculated for the markers affected whenever
+## assignments are created or change status.
+## --------------------------------------------------------------------------------
+
+def update_marker_progress(marker_ids=None):
+    
+    """
+    Recalculates the marker progress counts for a set of marker ids, or for all 
+    markers if marker_ids is None. This does not commit, so the counts are updated
+    in the same transaction as the assignments.
+    """
+    
+    db = current.db
+    
+    qry = (db.assignments.student_presentation == db.student_presentations.id)
+    
+    if marker_ids is None:
+        db(db.marker_progress_counts).delete()
+    else:
+        marker_ids = {mk for mk in marker_ids if mk is not None}
+        
+        if not marker_ids:
+            return
+        
+        db(db.marker_progress_counts.marker.belongs(marker_ids)).delete()
+        qry &= db.assignments.marker.belongs(marker_ids)
+    
+    n = db.assignments.id.count()
+    counts = db(qry, ignore_common_filters=True).select(
+                db.assignments.marker,
+                db.assignments.marker_role_id,
+                db.assignments.status,
+                db.student_presentations.academic_year,
+                n,
+                groupby=(db.assignments.marker,
+                         db.assignments.marker_role_id,
+                         db.assignments.status,
+                         db.student_presentations.academic_year))
+    
+    db.marker_progress_counts.bulk_insert(
+        [dict(marker=rw.assignments.marker,
+              marker_role_id=rw.assignments.marker_role_id,
+              status=rw.assignments.status,
+              academic_year=rw.student_presentations.academic_year,
+              n=rw[n])
+         for rw in counts])
+
+
+def markers_for_assignments(ids):
+    
+    """Returns the set of marker ids for a set of assignment ids"""
+    
+    db = current.db
+    id_select = assignment_id_select(ids)
+    
+    rows = db(db.assignments.id.belongs(id_select), ignore_common_filters=True).select(
+                db.assignments.marker, distinct=True)
+    
+    return {rw.marker for rw in rows}
+
+
+## --------------------------------------------------------------------------------
+## REFERENCE PREFETCHING
+## Following references from assignment rows (record.student_presentation.student)
+## runs a query for every reference on every row. These functions load the
+## referenced rows for a set of assignments with one query per table and store them
+## on the DAL Reference objects, so that following the references uses those rows.
+## --------------------------------------------------------------------------------
+
+def _prefetch(references, table):
+    
+    """
+    Loads the rows for a list of Reference values from a table with a single query
+    and attaches each row to its Reference. Returns the loaded rows.
+    """
+    
+    db = current.db
+    
+    references = [ref for ref in references if ref is not None]
+    ids = {int(ref) for ref in references}
+    
+    if not ids:
+        return []
+    
+    rows = db(table.id.belongs(ids), ignore_common_filters=True).select(table.ALL)
+    lookup = {rw.id: rw for rw in rows}
+    
+    for ref in references:
+        # Plain integer ids (e.g. from a just inserted row) can't hold a record
+        if hasattr(ref, '_record'):
+            ref._record = lookup.get(int(ref))
+    
+    return list(rows)
+
+
+def prefetch_assignment_references(rows):
+    
+    """
+    Takes a set of assignment rows, or a single row, and loads the referenced
+    student presentations, students, course presentations, markers and marking 
+    roles using one query per table. Returns the rows, whose references are then
+    followed without further queries.
+    """
+    
+    db = current.db
+    
+    if isinstance(rows, Row):
+        rows = [rows]
+    
+    stpres = _prefetch([rw.student_presentation for rw in rows], db.student_presentations)
+    _prefetch([rw.marker for rw in rows], db.teaching_staff)
+    _prefetch([rw.marker_role_id for rw in rows], db.marking_roles)
+    
+    _prefetch([rw.student for rw in stpres], db.students)
+    _prefetch([rw.course_presentation for rw in stpres], db.course_presentations)
+    
+    return rows
+
+
+## --------------------------------------------------------------------------------
+## COMPILED MARKING FORMS
+## Building a marking form means walking the form JSON for the marking role to 
+## create the fields, validators and layout. The compiled form is cached for each
+## marking role, keyed on the role id and a hash of the form JSON, so that this is
+## done once per process rather than on every request. An edited form JSON gives
+## a new key, so processes that have not seen the edit can never use a stale form,
+## and invalidate_compiled_form drops the old entries when a role is saved.
+## --------------------------------------------------------------------------------
+
+_COMPILED_FORMS = {}
+
+# Error messages for required components not completed on submission
+REQUIRED_MESSAGES = {'rubric': 'You must select an option',
+                     'comment': 'Please provide comments',
+                     'select': 'Please select a grade'}
+
+_SPACER = XML(DIV(_style='min-height:10px').xml())
+
+
+def _represent_comment(text):
+    
+    # protect carriage returns in the display of the text but stop anybody using 
+    # any other tags
+    if text is None:
+        return ""
+    
+    return XML(text.replace('\n', '<br />'), sanitize=True, permitted_tags=['br/'])
+
+
+def _compile_form(form_json):
+    
+    """Compiles a form JSON description into a dictionary containing:
+    
+    * fields: the Field definitions for the form controls,
+    * widget_settings: tuples of (variable, nrow, placeholder, value) for components
+      that modify the default widgets,
+    * layout: a list of blocks for style_sqlform. Static blocks (question titles,
+      info and spacers) are rendered to XML once, leaving 'widget' and 'query'
+      blocks to be filled in for each form,
+    * required: a list of (variable, error message) for required components,
+    * values: a dictionary of the form variables giving the set of allowed values
+      for rubric and select components and None for free text,
+    * queries: the query functions used by query components, looked up in the 
+      FORM_QUERIES registry.
+    """
+    
+    fields = []
+    widget_settings = []
+    layout = []
+    required = []
+    values = {}
+    queries = {}
+    
+    for q in form_json['questions']:
+        
+        title = DIV(H4(q['title']), _style='background-color:lightgrey;padding:1px')
+        info = DIV(XML(q['info'])) if q.get('info') is not None else DIV(_style='min-height:10px')
+        layout.append(('static', XML(CAT(title, info).xml())))
+        
+        for c in q['components']:
             
-            # get the form data
-            report_data = rec.get('assignments.assignment_data')
+            if c['type'] == 'rubric':
+                fields.append(Field(c['variable'], 
+                              type='string', 
+                              requires=IS_NULL_OR(IS_IN_SET(c['options'])),
+                              widget=div_radio_widget))
+            elif c['type'] == 'comment':
+                fields.append(Field(c['variable'], 
+                              type='text', 
+                              represent=_represent_comment))
+            elif c['type'] == 'select':
+                fields.append(Field(c['variable'], 
+                              type='string', 
+                              requires=IS_NULL_OR(IS_IN_SET(c['options']))))
             
-            # Fill in the fields to be exported
-            for fld, col in role_slot[3]:
-                
-                # Do we have any data for this grade - might be nothing at assignment level
-                # or might not be completed in the assignment data
-                val = None if report_data is None else report_data.get(fld)
-                val = 'NA' if val is None else val
+            if c['type'] in ('rubric', 'select'):
+                values[c['variable']] = set(c['options'])
+            elif c['type'] == 'comment':
+                values[c['variable']] = None
+            
+            if c['type'] == 'query':
+                # Only functions in the registry can be used - an unknown name
+                # fails here, when the form is compiled.
+                queries[c['query']] = FORM_QUERIES[c['query']]
+                layout.append(('query', (c['label'], c['query'])))
+            else:
+                layout.append(('widget', (c['label'], c['variable'])))
                 
-                # look for a percentage grade
-                perc_grade = grade_regex.match(val)
-                val = val if perc_grade is None else int(perc_grade.group(0))
+                if any(ky in c for ky in ('nrow', 'placeholder', 'value')):
+                    widget_settings.append((c['variable'], c.get('nrow'), 
+                                            c.get('placeholder'), c.get('value')))
                 
-                ws.cell(row = this_row, column = col, value = val)
+                if c.get('required') and c['type'] in REQUIRED_MESSAGES:
+                    required.append((c['variable'], REQUIRED_MESSAGES[c['type']]))
+            
+            if c.get('info') is not None:
+                layout.append(('static', XML(DIV(XML(c['info'])).xml())))
+            else:
+                layout.append(('static', _SPACER))
+        
+        layout.append(('static', _SPACER))
+    
+    return dict(fields=fields,
+                widget_settings=widget_settings,
+                layout=layout,
+                required=required,
+                values=values,
+                queries=queries)
+
+
+def compiled_form(role):
     
-    current.response.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    attachment = 'attachment;filename=Marking_Grades_{}.xlsx'.format(datetime.date.today().isoformat())
-    current.response.headers['Content-Disposition'] = attachment
+    """Returns the compiled form for a marking role row, compiling and caching
+    it if the role has not been seen with the current form JSON.
+    """
     
-    with NamedTemporaryFile() as tmp:
-            wb.save(tmp.name)
-            tmp.seek(0)
-            
-            raise HTTP(200, tmp.read(),
-                       **{'Content-Type':'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                          'Content-Disposition':attachment + ';'})
+    form_hash = hashlib.sha1(json.dumps(role.form_json, sort_keys=True)
+                             .encode('utf-8')).hexdigest()
+    key = (role.id, form_hash)
+    
+    compiled = _COMPILED_FORMS.get(key)
+    
+    if compiled is None:
+        compiled = _compile_form(role.form_json)
+        _COMPILED_FORMS[key] = compiled
+    
+    return compiled
+
+
+def invalidate_compiled_form(role_id):
+    
+    """Removes any compiled forms for a marking role from the cache"""
+    
+    for key in [ky for ky in list(_COMPILED_FORMS) if ky[0] == role_id]:
+        _COMPILED_FORMS.pop(key, None)
+
+
+## --------------------------------------------------------------------------------
+## AUTOSAVE
+## The write_report page posts changed form values to the autosave_report service
+## every few seconds. The changes are merged into the stored assignment data 
+## using the version number on the assignment, so that a save based on an out of 
+## date copy of the report is refused rather than overwriting newer changes.
+## --------------------------------------------------------------------------------
+
+def version_matches(version):
+    
+    """Returns a query matching assignments at a given version. Assignments 
+    created before versions were added have no version and are treated as 
+    version 0.
+    """
+    
+    db = current.db
+    
+    if not version:
+        return (db.assignments.version == None) | (db.assignments.version == 0)
+    
+    return db.assignments.version == version
+
+
+def autosave_assignment(record, changes, version):
+    
+    """Merges a dictionary of changed form values into the assignment data for
+    an assignment record. The version must match the version of the stored 
+    record and the update is conditional on that version, so a concurrent save
+    cannot be lost.
+    
+    Returns a tuple of the new version, or None if the save was refused, and a
+    dictionary of any invalid values, which are not saved.
+    """
+    
+    db = current.db
+    
+    current_version = record.version or 0
+    
+    if version != current_version:
+        return None, {}
+    
+    allowed = compiled_form(record.marker_role_id)['values']
+    
+    errors = {}
+    valid = {}
+    for variable, value in changes.items():
+        if variable not in allowed:
+            errors[variable] = 'Unknown form field'
+        elif value not in (None, '') and allowed[variable] is not None and value not in allowed[variable]:
+            errors[variable] = 'Value not in options'
+        else:
+            valid[variable] = None if value == '' else value
+    
+    if not valid:
+        return current_version, errors
+    
+    data = dict(record.assignment_data or {})
+    data.update(valid)
+    data['id'] = record.id
+    
+    update = dict(assignment_data=data, version=current_version + 1)
+    if record.status == 'Not started':
+        update['status'] = 'Started'
+    
+    updated = db((db.assignments.id == record.id) & 
+                 version_matches(current_version)).update(**update)
+    
+    if not updated:
+        return None, errors
+    
+    update_assignment_grades([record.id])
+    
+    if 'status' in update:
+        update_marker_progress([record.marker])
+    
+    if record.status in ['Submitted', 'Released']:
+        PDFCache().invalidate(record.student_presentation)
+    
+    return update['version'], errors
+
 
 ## --------------------------------------------------------------------------------
 ## HTML Report writing functions shared by show_form and write_report
@@ -557,37 +1251,11 @@ def assignment_to_sqlform(record, readonly, buttons=[]):
     but is restyled for display using style_sqlform to modify the default
     SQLFORM representation.
     
-    Returns the SQLFORM object and the form JSON description, which is used
-    for validation.
+    The fields are taken from the compiled form for the marking role and 
+    are cloned for each new form.
     """
     
-    # - Extract the set of fields from the components section of the questions array
-    #   This allows a question to have multiple bits (e.g. rubric + optional comments)
-    form_json = record.marker_role_id.form_json
-    
-    fields=[]
-    for q in form_json['questions']:
-        for c in q['components']:
-            if c['type'] == 'rubric':
-                fields.append(Field(c['variable'], 
-                              type='string', 
-                              requires=IS_NULL_OR(IS_IN_SET(c['options'])),
-                              widget=div_radio_widget))
-            elif c['type'] == 'comment':
-                # protect carriage returns in the display of the text but stop anybody using 
-                # any other tags
-                fields.append(Field(c['variable'], 
-                              type='text', 
-                              represent=lambda text: "" if text is None else XML(text.replace('\n', '<br />'),
-                              sanitize=True, 
-                              permitted_tags=['br/'])))
-            elif c['type'] == 'select':
-                fields.append(Field(c['variable'], 
-                              type='string', 
-                              requires=IS_NULL_OR(IS_IN_SET(c['options']))))
-            else:
-                # Other types that don't insert a form control- currently only 'query'
-                pass
+    compiled = compiled_form(record.marker_role_id)
     
     # - define the form for IO using the fields object,
     #   preloading any existing data
@@ -597,7 +1265,7 @@ def assignment_to_sqlform(record, readonly, buttons=[]):
         data_json=record.assignment_data
     
     # - define a SQLFORM object the fields object for processing data
-    form = SQLFORM.factory(*fields,
+    form = SQLFORM.factory(*[fld.clone() for fld in compiled['fields']],
                            readonly=readonly,
                            buttons=buttons,
                            record=data_json,
@@ -608,57 +1276,38 @@ def assignment_to_sqlform(record, readonly, buttons=[]):
 
 def style_sqlform(record, form, readonly=False):
     
-    form_json = record.marker_role_id.form_json
+    compiled = compiled_form(record.marker_role_id)
     
     # modify any widget settings for active forms
     if not readonly:
-        for q in form_json['questions']:
-            for c in q['components']:
-                if 'nrow' in list(c.keys()):
-                    form.custom.widget[c['variable']]['_rows'] = c['nrow']
-                if 'placeholder' in list(c.keys()):
-                    form.custom.widget[c['variable']].update(_placeholder=c['placeholder'])
-                if 'value' in list(c.keys()):
-                    form.custom.widget[c['variable']].components = [c['value']]
-    
-    # compile the laid out form in a list
+        for variable, nrow, placeholder, value in compiled['widget_settings']:
+            widget = form.custom.widget[variable]
+            if nrow is not None:
+                widget['_rows'] = nrow
+            if placeholder is not None:
+                widget.update(_placeholder=placeholder)
+            if value is not None:
+                widget.components = [value]
+    
+    # compile the laid out form in a list, filling in the form widgets and the
+    # output of query components between the pre-rendered static blocks
     html = [form.custom.begin]
     
-    # add the questions in the order they appear in the JSON array
-    for q in form_json['questions']:
-        html.append(DIV(H4(q['title']), _style='background-color:lightgrey;padding:1px'))
-        
-        if q.get('info') is not None:
-            html.append(DIV(XML(q.get('info'))))
+    for block_type, content in compiled['layout']:
+        if block_type == 'static':
+            html.append(content)
+        elif block_type == 'query':
+            label, query_name = content
+            query_data = compiled['queries'][query_name](record)
+            html.append(DIV(DIV(B(label), _class='col-sm-2'),
+                            DIV(query_data, _class='col-sm-10'),
+                            _class='row'))
         else:
-            html.append(DIV(_style='min-height:10px'))
-        
-        for c in q['components']:
-            
-            # Insert either the form variable and stored data or the output of a 
-            # query component.
-            if c['type'] == 'query':
-                # This is a tricky line. globals() contains globals functions, so needs
-                # the appropriate query function to be imported. All such functions
-                # get the assignment record as an input. You could use eval() here but
-                # that has security risks - hard to see them applying here, but hey.
-                query_data = globals()[c['query']](record)
-                html.append(DIV(DIV(B(c['label']), _class='col-sm-2'),
-                                DIV(query_data, _class='col-sm-10'),
-                                _class='row'))
-            else:
-                html.append(DIV(DIV(B(c['label']), _class='col-sm-2'),
-                                DIV(form.custom.widget[c['variable']], _class='col-sm-10'),
-                                _class='row'))
-            
-            if c.get('info') is not None:
-                html.append(DIV(XML(c.get('info'))))
-            else:
-                html.append(DIV(_style='min-height:10px'))
-            
-        html.append(DIV(_style='min-height:10px'))
+            label, variable = content
+            html.append(DIV(DIV(B(label), _class='col-sm-2'),
+                            DIV(form.custom.widget[variable], _class='col-sm-10'),
+                            _class='row'))
     
-        
     # finalise the form and send the whole thing back
     html.append(BR())
     html.append(form.custom.submit)
@@ -669,126 +1318,86 @@ def style_sqlform(record, form, readonly=False):
 
 ## --------------------------------------------------------------------------------
 ## PDF generation
+## The report details are collected here and then rendered by modules/report_pdf.py
 ## --------------------------------------------------------------------------------
 
-# Subclass of FPDF with a built in confidential page header
-class ConfidentialPDF(fpdf.FPDF):
-    
-    def header(self):
-        self.set_y(7)
-        self.set_font("Helvetica", size=12)
-        self.set_text_color(255, 40, 40)
-        self.cell(0, 8, txt = "This is a confidential document and "
-                  "must not be circulated to students.", align='C')
-        self.set_xy(10,20)
-
 
-def create_pdf(record, confidential):
+def pdf_report_queries(assignment, role, confidential):
     
     """
-    This code writes a simple PDF file of the marking report
-    using pyfpdf: very simple, can't do styling or templating easily 
-    but no external dependencies and reasonably fast
+    Runs the query components in the form for a report and returns a dictionary
+    of their outputs for the PDF.
     """
     
-    if confidential:
-        pdf = ConfidentialPDF(format='A4')
-    else:
-        pdf = fpdf.FPDF(format='A4')
+    form_queries = compiled_form(role)['queries']
     
+    return {c['query']: form_queries[c['query']](assignment, pdf=True)
+            for q in role.form_json['questions']
+            for c in q['components']
+            if c['type'] == 'query' and (confidential or not q['confidential'])}
+
+
+def pdf_report_details(assignment, student_presentation, student,
+                       course_presentation, marker, role, confidential,
+                       queries=True):
     
-    form_json = record.marker_role_id.form_json
+    """
+    Collects the data needed to render a report PDF into a plain dictionary, so
+    that the rendering itself needs no database access and can be run in
+    another process. Any query components in the form are run here, unless 
+    queries is False, which gives the details needed to check the PDF cache. The
+    queries can then be added using pdf_report_queries if the PDF is not cached.
+    """
     
-    # set up the fonts
-    fpdf.set_global('SYSTEM_TTFONTS', current.configuration.get('fpdf.font_dir'))
-    pdf.add_font('DejaVu', '', 'DejaVuSansCondensed.ttf', uni=True)
-    pdf.add_font('DejaVu', 'B', 'DejaVuSansCondensed-Bold.ttf', uni=True)
-    
-    #  add first page and insert the logo
-    pdf.set_top_margin(20)
-    pdf.add_page()
-    pdf.image(os.path.join(current.request.folder, 'static','images/imperial_logo_mono.png'), w=60)
-    logo_bottom = pdf.get_y()
-
-    # Title block
-    pdf.set_xy(80, 20)
-    pdf.set_font("DejaVu", style='B', size=14)
-    pdf.cell(0, 10, txt="Silwood Park Masters Courses", align="R",  ln=1)
-    pdf.cell(0, 10, txt=form_json['pdftitle'], align="R",  ln=1)
-    pdf.set_xy(10, logo_bottom + 10)
-    pdf.set_font("DejaVu", size=14)
-    pdf.set_text_color(0, 0, 0)
-    
-    # ID table
-    label =   ['Student', 'CID', 'Course Presentation', 'Year', 'Marker', 'Marker Role']
-    content = ['{student_presentation.student.student_first_name} '  # Intentionally no comma
-               '{student_presentation.student.student_last_name}',
-               '{student_presentation.student.student_cid}',
-               '{student_presentation.course_presentation.name}',
-               '{student_presentation.academic_year}',
-               '{marker.first_name} {marker.last_name}',
-               '{marker_role_id.name}']
-    
-    for l, c in zip(label, content):
-        pdf.set_font("DejaVu", size=12, style='B')
-        pdf.cell(60, 8, txt=l, align="L")
-        pdf.set_font("DejaVu", size=12)
-        pdf.cell(0, 8, txt=c.format(**record), align="L", ln=1)
-    
-    
-    # add the questions in the order they appear in the JSON array
-    pdf.set_fill_color(200,200,200)
+    return dict(id=assignment.id,
+                version=assignment.version or 0,
+                student_presentation_id=student_presentation.id,
+                confidential=confidential,
+                form_json=role.form_json,
+                assignment_data=assignment.assignment_data,
+                queries=(pdf_report_queries(assignment, role, confidential) 
+                         if queries else {}),
+                student=f'{student.student_first_name} {student.student_last_name}',
+                student_first_name=student.student_first_name,
+                student_last_name=student.student_last_name,
+                student_cid=student.student_cid,
+                course_presentation=course_presentation.name,
+                academic_year=student_presentation.academic_year,
+                marker=f'{marker.first_name} {marker.last_name}',
+                marker_role=role.name,
+                font_dir=current.configuration.get('fpdf.font_dir'),
+                logo_path=os.path.join(current.request.folder, 'static',
+                                       'images/imperial_logo_mono.png'))
+
+
+def create_pdf(record, confidential):
     
-    for q in form_json['questions']:
-        
-        # skip confidential questions if the report is not confidential
-        if not confidential and q['confidential']:
-            continue
-        
-        # insert the question title in a grey bar
-        pdf.rect(pdf.get_x(), pdf.get_y(), h=8, w=190, style='F')
-        pdf.set_font("DejaVu", size=12, style='B')
-        pdf.cell(0, 8, txt=q['title'], align="L", ln=1)
-        
-        # insert the components
-        for c in q['components']:
-            
-            # skip confidential components if the report is not confidential
-            if not confidential and q['confidential']:
-                continue
-            
-            pdf.set_font("DejaVu", size=12, style='B')
-            pdf.cell(60, 8, txt=c['label'], align="L")
-            pdf.ln()
-            pdf.set_font("DejaVu", size=12)
-            
-            if c['type'] == 'query':
-                # This is a tricky line. globals() contains globals functions, so needs
-                # the appropriate query function to be imported. All such functions
-                # get the assignment record as an input. You could use eval() here but
-                # that has security risks - hard to see them applying here, but hey.
-                contents = globals()[c['query']](record, pdf=True)
-            else:
-                contents = record.assignment_data[c['variable']]
-            
-            if contents is None:
-                contents = ""
-            pdf.set_left_margin(70)
-            pdf.write(6, txt=contents)
-            pdf.set_left_margin(10)
-            pdf.ln()
-        
-        # spacer
-        pdf.ln()
-    
-    pdf.close()
-    pdf = pdf.output(dest='S').encode('latin-1') # unicode string to bytes
-    filename = '{} {} {} {} {} {}.pdf'.format(record.student_presentation.course_presentation.name,
-                                            record.student_presentation.academic_year, 
-                                            record.student_presentation.student.student_last_name,
-                                            record.student_presentation.student.student_first_name,
-                                            record.marker_role_id.name,
-                                            record.id)
+    """
+    This code writes a simple PDF file of the marking report for an assignment
+    record, following the references from the record to get the report details.
+    Rendered reports are stored in the PDF cache and reused while the report
+    is unchanged, and the form queries are only run if the PDF is not cached.
+    """
+    
+    role = record.marker_role_id
+    details = pdf_report_details(record, 
+                                 record.student_presentation,
+                                 record.student_presentation.student,
+                                 record.student_presentation.course_presentation,
+                                 record.marker,
+                                 role,
+                                 confidential=confidential,
+                                 queries=False)
+    
+    cache = PDFCache()
+    pdf = cache.get(details)
+    
+    if pdf is None:
+        details['queries'] = pdf_report_queries(record, role, confidential)
+        pdf, filename = render_pdf(details)
+        cache.put(details, pdf)
+    else:
+        filename = pdf_filename(details)
     
     return (pdf, filename)
 
@@ -798,6 +1407,7 @@ def create_pdf(record, confidential):
 ## component in the form json. These should accept an assignments record as the first argument
 ## and then the option to provide either html (default, for web display) or a text repr
 ## for use in the PDF.
+## New query functions must be added to the FORM_QUERIES registry at the end of the module.
 
 def query_report_marker_grades(record, pdf=False):
     """Creates a table of existing individual report marker grades
@@ -810,20 +1420,22 @@ def query_report_marker_grades(record, pdf=False):
     # the table, so reset that here to ensure that status can be read
     db.assignments.status.represent = None
     
-    report_grades = db(#(db.student_presentations.id == record.student_presentation) &
-                       (db.assignments.student_presentation == record.student_presentation) &
+    report_grades = db((db.assignments.student_presentation == record.student_presentation) &
                        (db.assignments.marker_role_id == db.marking_roles.id) &
                        (db.marking_roles.name== 'Marker')
                        ).select(
                            db.assignments.marker,
-                           db.assignments.assignment_data,
-                           db.assignments.status)
+                           db.assignments.status,
+                           db.assignment_grades.grade_text,
+                           left=db.assignment_grades.on(
+                               (db.assignment_grades.assignment == db.assignments.id) &
+                               (db.assignment_grades.field_name == 'grade')))
     
     report_grades = list(report_grades.render())
     
-    report_grades = [(rw.marker, rw.assignment_data['grade']) 
-                        if rw.status in ['Submitted', 'Released']
-                        else (rw.marker, 'Not submitted')
+    report_grades = [(rw.assignments.marker, rw.assignment_grades.grade_text) 
+                        if rw.assignments.status in ['Submitted', 'Released']
+                        else (rw.assignments.marker, 'Not submitted')
                         for rw in report_grades]
     
     if pdf:
@@ -832,3 +1444,6 @@ def query_report_marker_grades(record, pdf=False):
     else:
         return TABLE(report_grades, _class='table')
 
+
+# Registry of the functions that can be used by query components in form JSON
+FORM_QUERIES = {'query_report_marker_grades': query_report_marker_grades}
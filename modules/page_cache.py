@@ -0,0 +1,156 @@
+## --------------------------------------------------------------------------------
+## PUBLIC PAGE CACHE
+## The public project pages (the proposals grid and the project details) are viewed
+## many times by anonymous users and change rarely. Those pages are cached in memory
+## as rendered HTML and also sent with ETag and Last-Modified headers, so browsers
+## can revalidate them and get a 304 response without the page being built.
+##
+## Cache entries are keyed on the request URL and the values of change counters held
+## in the cache_counters table. Callbacks on the projects table increment a counter
+## for the whole table and one for each changed project. That way any project change
+## invalidates the listing and a change to one project only invalidates its own page.
+## The pages also show supervisor details, so they depend on the teaching_staff
+## counter, which is incremented by the callbacks in modules/typeahead.py. Because
+## the counters are in the database, the invalidation applies to every process.
+## --------------------------------------------------------------------------------
+import datetime
+import hashlib
+import threading
+from collections import OrderedDict
+
+from gluon import current, HTTP
+
+# Change counter for the teaching_staff table
+STAFF_COUNTER = "teaching_staff"
+
+# Rendered pages keyed by ETag
+_PAGE_CACHE = OrderedDict()
+_PAGE_CACHE_LOCK = threading.Lock()
+
+
+def project_counter(project_id):
+    """The name of the change counter for a single project"""
+
+    return f"project:{project_id}"
+
+
+def bump_counters(names):
+    """Increments a set of change counters, creating any that do not exist"""
+
+    db = current.db
+    counters = db.cache_counters
+    # UTC, since the times are used for the HTTP Last-Modified header
+    now = datetime.datetime.utcnow()
+
+    names = set(names)
+    existing = db(counters.name.belongs(names)).select(counters.name)
+    existing = {rw.name for rw in existing}
+
+    if existing:
+        db(counters.name.belongs(existing)).update(
+            counter=counters.counter + 1, updated_on=now
+        )
+
+    missing = names - existing
+    if missing:
+        counters.bulk_insert(
+            [dict(name=nm, counter=1, updated_on=now) for nm in missing]
+        )
+
+
+def setup_project_counters(db):
+    """Registers callbacks on the projects table to increment the change counters"""
+
+    def _project_ids(dbset):
+        return [rw.id for rw in dbset.select(db.projects.id)]
+
+    def _bump(ids):
+        bump_counters(["projects"] + [project_counter(pid) for pid in ids])
+
+    table = db.projects
+    table._after_insert.append(lambda fields, id: _bump([id]))
+    table._after_update.append(lambda dbset, fields: _bump(_project_ids(dbset)))
+    table._before_delete.append(lambda dbset: _bump(_project_ids(dbset)))
+
+
+def is_cacheable():
+    """Checks whether the current request is for an anonymous user with nothing
+    specific to the session shown on the page"""
+
+    auth = current.auth
+    session = current.session
+    response = current.response
+
+    return (
+        current.request.env.request_method == "GET"
+        and auth.user is None
+        and session.magic_auth is None
+        and not response.flash
+        and not session.flash
+    )
+
+
+def cached_page(counter_names, build, key_parts=()):
+    """Returns a cached rendering of a page, or builds and caches it
+
+    The build function should return the dictionary for the view. The counter_names
+    give the change counters that the page content depends on and key_parts gives
+    any other values that change the content. For requests from logged in users,
+    the build function is just called as normal.
+
+    The Last-Modified time only reflects the counters, so it is not used when there
+    are key_parts and revalidation then relies on the ETag alone.
+    """
+
+    if not is_cacheable():
+        return build()
+
+    db = current.db
+    request = current.request
+    response = current.response
+
+    counters = db(db.cache_counters.name.belongs(counter_names)).select(
+        db.cache_counters.name, db.cache_counters.counter, db.cache_counters.updated_on
+    )
+    counters = {rw.name: rw for rw in counters}
+
+    key = [request.env.path_info, request.env.query_string or ""]
+    key += [f"{nm}={counters[nm].counter if nm in counters else 0}" for nm in counter_names]
+    key += [str(part) for part in key_parts]
+    etag = '"' + hashlib.sha1("|".join(key).encode("utf-8")).hexdigest() + '"'
+
+    if key_parts:
+        modified = []
+    else:
+        modified = [
+            rw.updated_on for rw in counters.values() if rw.updated_on is not None
+        ]
+
+    headers = {"ETag": etag, "Cache-Control": "public, no-cache"}
+    if modified:
+        headers["Last-Modified"] = max(modified).strftime("%a, %d %b %Y %H:%M:%S GMT")
+
+    if request.env.http_if_none_match is not None:
+        if request.env.http_if_none_match == etag:
+            raise HTTP(304, **headers)
+    elif modified and request.env.http_if_modified_since == headers["Last-Modified"]:
+        raise HTTP(304, **headers)
+
+    with _PAGE_CACHE_LOCK:
+        page = _PAGE_CACHE.get(etag)
+        if page is not None:
+            _PAGE_CACHE.move_to_end(etag)
+
+    if page is None:
+        page = response.render(build())
+
+        max_size = current.configuration.get("page_cache.size") or 200
+
+        with _PAGE_CACHE_LOCK:
+            _PAGE_CACHE[etag] = page
+            while len(_PAGE_CACHE) > max_size:
+                _PAGE_CACHE.popitem(last=False)
+
+    response.headers.update(headers)
+
+    return page
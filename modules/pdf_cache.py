@@ -0,0 +1,195 @@
+## --------------------------------------------------------------------------------
+## REPORT PDF CACHE
+## Submitted and released reports rarely change, but the PDFs are requested many times
+## (downloads by staff, students following release links, bulk zip downloads). This
+## stores rendered PDFs on disk, using a file name built from the student presentation
+## and assignment ids, the confidential flag, the assignment version and a hash of the
+## report header fields and form definition. These are all available from the rows
+## loaded for a report, so the cache is checked before running the form queries. Every
+## change to an assignment increments its version, so a changed report never matches
+## an old file. The form queries can show details of the other reports for the same
+## student, so all of the files for a student presentation are removed when any of
+## its reports are changed. The total size of the cache is bounded by removing the
+## least recently used files.
+##
+## Each process keeps a running total of the cache size, found by scanning the folder
+## once and then adding the size of each file it stores. The folder is only scanned
+## again to evict files when that total goes over the limit. The total does not see
+## files stored by other processes, so the cache can go over the limit by the files
+## they have stored since their last scan.
+## --------------------------------------------------------------------------------
+import os
+import glob
+import hashlib
+import threading
+import simplejson as json
+
+from gluon import current
+
+# Running totals of the cache size by folder for this process
+_SIZES = {}
+_SIZES_LOCK = threading.Lock()
+
+
+def _digest(value):
+    """Returns a short stable hash of a JSON serialisable value."""
+
+    content = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:20]
+
+
+class PDFCache:
+    def __init__(self, folder=None, max_size_mb=None):
+        conf = current.configuration
+
+        if folder is None:
+            folder = os.path.join(current.request.folder, "cache", "report_pdfs")
+
+        if max_size_mb is None:
+            max_size_mb = conf.get("pdf_cache.max_size_mb") or 500
+
+        self.folder = folder
+        self.max_size = max_size_mb * 2 ** 20
+
+        os.makedirs(self.folder, exist_ok=True)
+
+    def path(self, details):
+        """
+        Gets the cache file path for a dictionary of report details from
+        marking_functions.pdf_report_details. The form query outputs are not part
+        of the path, so this can be found before the queries are run.
+        """
+
+        content = _digest(
+            [
+                details["form_json"],
+                [
+                    details[ky]
+                    for ky in (
+                        "student",
+                        "student_cid",
+                        "course_presentation",
+                        "academic_year",
+                        "marker",
+                        "marker_role",
+                    )
+                ],
+            ]
+        )
+        access = "confidential" if details["confidential"] else "public"
+
+        return os.path.join(
+            self.folder,
+            f"{details['student_presentation_id']}_{details['id']}_{access}_"
+            f"{details['version']}_{content}.pdf",
+        )
+
+    def get(self, details):
+        """Returns the cached PDF bytes for some report details or None."""
+
+        path = self.path(details)
+
+        try:
+            with open(path, "rb") as pdf_file:
+                pdf = pdf_file.read()
+        except FileNotFoundError:
+            return None
+
+        # Touch the file to record the use for the LRU eviction, unless it has
+        # already been removed by another process
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return pdf
+
+    def has(self, details):
+        return os.path.exists(self.path(details))
+
+    def put(self, details, pdf):
+        """Stores PDF bytes for some report details and trims the cache."""
+
+        path = self.path(details)
+
+        # Write to a temporary file and then move it into place, so that a
+        # concurrent reader never sees a partial file.
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as pdf_file:
+            pdf_file.write(pdf)
+
+        os.replace(tmp_path, path)
+
+        with _SIZES_LOCK:
+            if self.folder not in _SIZES:
+                _SIZES[self.folder] = self._scan_size()
+            else:
+                _SIZES[self.folder] += len(pdf)
+
+            over_limit = _SIZES[self.folder] > self.max_size
+
+        if over_limit:
+            self.evict()
+
+    def invalidate(self, *student_presentation_ids):
+        """Removes all cached PDFs for the reports on some student presentations."""
+
+        for sp_id in set(student_presentation_ids):
+            for path in glob.glob(os.path.join(self.folder, f"{sp_id}_*.pdf")):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _entries(self):
+        """
+        Returns a list of (modified time, size, path) tuples for the cached PDFs,
+        skipping any files removed by another process during the scan.
+        """
+
+        entries = []
+
+        for ent in os.scandir(self.folder):
+            if not ent.name.endswith(".pdf"):
+                continue
+
+            try:
+                stat = ent.stat()
+            except FileNotFoundError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, ent.path))
+
+        return entries
+
+    def _scan_size(self):
+        """Returns the total size of the cached PDFs."""
+
+        return sum(ent[1] for ent in self._entries())
+
+    def evict(self):
+        """
+        Removes the least recently used files until the cache is back under 90%
+        of its maximum size, and resets the running total of the cache size.
+        """
+
+        entries = self._entries()
+        total = sum(ent[1] for ent in entries)
+
+        if total > self.max_size:
+            entries.sort()
+            target = 0.9 * self.max_size
+
+            for _, size, path in entries:
+                if total <= target:
+                    break
+
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+                total -= size
+
+        with _SIZES_LOCK:
+            _SIZES[self.folder] = total
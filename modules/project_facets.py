@@ -0,0 +1,198 @@
+## --------------------------------------------------------------------------------
+## PROJECT FACETS
+## The project base and the list:string fields describing projects (type, length,
+## dates and course restrictions) are copied into the project_facets table, with one
+## row per project, field and value. This allows the project proposals to be filtered
+## by facet values and the number of projects with each value to be counted using
+## simple indexed queries, rather than by searching the encoded list fields with LIKE.
+##
+## The table is kept up to date by callbacks on the projects table and rows are
+## removed with their project by the cascading reference.
+## --------------------------------------------------------------------------------
+from collections import OrderedDict
+
+from gluon import current
+
+# Facet fields and their labels, in display order
+FACET_FIELDS = OrderedDict(
+    [
+        ("project_base", "Base"),
+        ("project_type", "Project type"),
+        ("project_length", "Length"),
+        ("available_project_dates", "Available dates"),
+        ("course_restrictions", "Courses"),
+    ]
+)
+
+# Prefix for request variables giving selected facet values
+FACET_VAR_PREFIX = "f_"
+
+# Set once the facet table has been checked by this process
+_CHECKED = set()
+
+
+def _facet_values(value):
+    """Returns the values of a project field as a list"""
+
+    if value is None:
+        return []
+
+    if isinstance(value, (list, tuple)):
+        return [val for val in value if val not in (None, "")]
+
+    return [value] if value != "" else []
+
+
+def setup_project_facets(db):
+    """Registers the callbacks that keep the project_facets table up to date
+
+    The first call in each process also adds the facet rows for any projects that
+    do not have them, such as projects created before the table existed. This does
+    not depend on the migrate setting.
+    """
+
+    table = db.projects
+    table._after_insert.append(lambda fields, id: index_project_facets(db, [id]))
+    table._after_update.append(
+        lambda dbset, fields: index_project_facets(
+            db, [rw.id for rw in dbset.select(db.projects.id)]
+        )
+        if any(fld in fields for fld in FACET_FIELDS)
+        else None
+    )
+
+    if "project_facets" in _CHECKED:
+        return
+
+    # Every project has a base, so has at least one facet row once indexed
+    facets = db.project_facets
+    missing = db(
+        ~db.projects.id.belongs(db(facets)._select(facets.project, distinct=True))
+    ).select(db.projects.id)
+
+    if missing:
+        index_project_facets(db, [rw.id for rw in missing])
+        db.commit()
+
+    _CHECKED.add("project_facets")
+
+
+def index_project_facets(db, ids=None):
+    """Replaces the facet rows for a list of project ids, or for all projects if ids
+    is None"""
+
+    facets = db.project_facets
+    projects = db.projects
+
+    if ids is None:
+        db(facets).delete()
+        qry = projects
+    else:
+        if not ids:
+            return
+        db(facets.project.belongs(ids)).delete()
+        qry = projects.id.belongs(ids)
+
+    rows = db(qry).select(projects.id, *[projects[fld] for fld in FACET_FIELDS])
+
+    values = [
+        dict(project=rw.id, facet=fld, facet_value=val)
+        for rw in rows
+        for fld in FACET_FIELDS
+        for val in _facet_values(rw[fld])
+    ]
+
+    if values:
+        facets.bulk_insert(values)
+
+
+def selected_facets(request_vars):
+    """Gets the selected facet values from the request variables
+
+    Returns a dictionary of facet field names to lists of selected values.
+    """
+
+    selected = {}
+
+    for fld in FACET_FIELDS:
+        values = request_vars.get(FACET_VAR_PREFIX + fld)
+        values = _facet_values(values)
+        if values:
+            selected[fld] = values
+
+    return selected
+
+
+def facet_filter(selected):
+    """Returns a query on projects matching selected facet values
+
+    Projects must match at least one selected value for each facet with selected
+    values.
+    """
+
+    db = current.db
+    facets = db.project_facets
+
+    qry = db.projects.id > 0
+
+    for fld, values in selected.items():
+        qry &= db.projects.id.belongs(
+            db((facets.facet == fld) & facets.facet_value.belongs(values))._select(
+                facets.project
+            )
+        )
+
+    return qry
+
+
+def _grouped_counts(qry, facet_names):
+    """Counts the projects for each value of a set of facets within a query"""
+
+    db = current.db
+    facets = db.project_facets
+    n_projects = facets.project.count(distinct=True)
+
+    rows = db(
+        facets.project.belongs(db(qry)._select(db.projects.id))
+        & facets.facet.belongs(facet_names)
+    ).select(
+        facets.facet,
+        facets.facet_value,
+        n_projects,
+        groupby=facets.facet | facets.facet_value,
+        orderby=facets.facet | facets.facet_value,
+    )
+
+    return [
+        (rw.project_facets.facet, rw.project_facets.facet_value, rw[n_projects])
+        for rw in rows
+    ]
+
+
+def facet_counts(qry, selected):
+    """Counts the projects for each facet value
+
+    The counts for facets without a selection use the projects matching the query
+    and all of the selected values. The counts for a facet with a selection ignore
+    the selection for that facet, so that they show how many projects each other
+    value would add. The matching project ids are found by the database as a
+    subquery, so the counts for all of the unselected facets come from a single
+    grouped query, with one more query for each selected facet.
+
+    Returns an ordered dictionary of facet fields to lists of (value, count) tuples.
+    """
+
+    unselected = [fld for fld in FACET_FIELDS if fld not in selected]
+
+    rows = _grouped_counts(qry & facet_filter(selected), unselected) if unselected else []
+
+    for fld in selected:
+        others = {ky: vl for ky, vl in selected.items() if ky != fld}
+        rows += _grouped_counts(qry & facet_filter(others), [fld])
+
+    counts = OrderedDict((fld, []) for fld in FACET_FIELDS)
+
+    for facet, value, n in rows:
+        counts[facet].append((value, n))
+
+    return counts
@@ -0,0 +1,237 @@
+## --------------------------------------------------------------------------------
+## PROJECT SEARCH
+## A full text index over the descriptive fields of project proposals, used to search
+## the public proposals grid. The index uses the native full text search of the
+## database:
+## - SQLite: an FTS5 virtual table, projects_fts, using the project id as the rowid.
+##   This is created and filled from the projects table the first time each process
+##   finds it missing and is kept in sync by callbacks on the projects table.
+## - PostgreSQL: a GIN index on the weighted tsvector of the fields, which the
+##   database keeps up to date itself.
+## Other databases, or SQLite builds without FTS5, fall back to searching the fields
+## using LIKE.
+##
+## Search terms are matched as prefixes and all terms must match. Results are ranked
+## with matches in the project title given more weight.
+## --------------------------------------------------------------------------------
+import re
+
+from gluon import current
+from pydal.objects import Expression
+
+SEARCH_FIELDS = [
+    "project_title",
+    "project_description",
+    "requirements",
+    "support",
+    "eligibility",
+]
+
+# Relative weights of the fields in the SQLite ranking and the equivalent
+# PostgreSQL weight labels
+SEARCH_WEIGHTS = [10.0, 2.0, 1.0, 1.0, 1.0]
+TSVECTOR_WEIGHTS = ["A", "B", "C", "C", "C"]
+
+FTS_TABLE = "projects_fts"
+TSVECTOR_INDEX = "projects_search_weighted_idx"
+
+# Earlier index without field weights, which no longer matches the searches
+OLD_TSVECTOR_INDEX = "projects_search_idx"
+
+# Whether the full text index is available, set once it has been checked by this
+# process
+_AVAILABLE = {}
+
+
+def _tsvector(db):
+    """The weighted tsvector expression used for the PostgreSQL index and searches"""
+
+    table = db.projects
+
+    return " || ".join(
+        f"setweight(to_tsvector('english', coalesce({table[fld]._rname}, '')), '{wt}')"
+        for fld, wt in zip(SEARCH_FIELDS, TSVECTOR_WEIGHTS)
+    )
+
+
+def search_terms(text):
+    """Splits search text into a list of lower case word terms"""
+
+    return re.findall(r"\w+", (text or "").lower())
+
+
+def setup_project_search(db):
+    """Sets up the search index for the projects table
+
+    The first call in each process checks that the index exists and creates it if
+    needed. On SQLite, the callbacks that keep the index up to date are then
+    registered if the index is available.
+    """
+
+    if "projects" not in _AVAILABLE:
+        _AVAILABLE["projects"] = _create_index(db)
+
+    if db._dbname == "sqlite" and _AVAILABLE["projects"]:
+        table = db.projects
+        table._after_insert.append(lambda fields, id: index_projects(db, [id]))
+        table._after_update.append(
+            lambda dbset, fields: index_projects(db, _set_ids(db, dbset))
+            if any(fld in fields for fld in SEARCH_FIELDS)
+            else None
+        )
+        table._before_delete.append(
+            lambda dbset: _remove_projects(db, _set_ids(db, dbset))
+        )
+
+
+def _create_index(db):
+    """Creates the full text index if it does not already exist
+
+    This does not depend on the migrate setting, because the index is needed by
+    the callbacks and searches. Returns whether the index is available.
+    """
+
+    try:
+        if db._dbname == "sqlite":
+            exists = db.executesql(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name = "
+                f"{db._adapter.adapt(FTS_TABLE)};"
+            )
+
+            if not exists:
+                db.executesql(
+                    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                    f"{', '.join(SEARCH_FIELDS)}, tokenize = 'porter unicode61');"
+                )
+                _fill_index(db)
+                db.commit()
+
+        elif db._dbname == "postgres":
+            db.executesql(f"DROP INDEX IF EXISTS {OLD_TSVECTOR_INDEX};")
+            db.executesql(
+                f"CREATE INDEX IF NOT EXISTS {TSVECTOR_INDEX} ON {db.projects._rname} "
+                f"USING GIN (({_tsvector(db)}));"
+            )
+            db.commit()
+
+        else:
+            return False
+
+    except Exception:
+        # For example, SQLite without FTS5. PostgreSQL searches still work without
+        # the index, just more slowly.
+        db.rollback()
+        return db._dbname == "postgres"
+
+    return True
+
+
+def _set_ids(db, dbset):
+    """Gets the ids of the projects in a DAL set"""
+
+    return [rw.id for rw in dbset.select(db.projects.id)]
+
+
+def _remove_projects(db, ids):
+    """Removes projects from the SQLite index"""
+
+    if ids:
+        db.executesql(
+            f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({', '.join(str(int(i)) for i in ids)});"
+        )
+
+
+def _fill_index(db, ids=None):
+    """Copies project text into the SQLite index within the database
+
+    If ids is None, the whole index is rebuilt.
+    """
+
+    table = db.projects
+    columns = ", ".join(table[fld]._rname for fld in SEARCH_FIELDS)
+    insert = (
+        f"INSERT INTO {FTS_TABLE} (rowid, {', '.join(SEARCH_FIELDS)}) "
+        f"SELECT {table._id._rname}, {columns} FROM {table._rname}"
+    )
+
+    if ids is None:
+        db.executesql(f"DELETE FROM {FTS_TABLE};")
+        db.executesql(f"{insert};")
+    elif ids:
+        _remove_projects(db, ids)
+        id_list = ", ".join(str(int(i)) for i in ids)
+        db.executesql(f"{insert} WHERE {table._id._rname} IN ({id_list});")
+
+
+def index_projects(db, ids=None):
+    """Adds or replaces projects in the SQLite index
+
+    The project text is copied within the database, rather than being loaded and
+    inserted. If ids is None, the whole index is rebuilt.
+    """
+
+    if db._dbname != "sqlite" or not _AVAILABLE.get("projects"):
+        return
+
+    _fill_index(db, ids)
+
+
+def search_projects(text, limit=None):
+    """Searches the projects and returns a list of matching ids, best match first
+
+    All of the terms in the search text must match the start of a word in one of
+    the indexed fields.
+    """
+
+    db = current.db
+    terms = search_terms(text)
+
+    if not terms:
+        return []
+
+    limit_sql = "" if limit is None else f" LIMIT {int(limit)}"
+
+    if db._dbname == "sqlite" and _AVAILABLE.get("projects"):
+        match = " ".join(f'"{term}"*' for term in terms)
+        weights = ", ".join(str(wt) for wt in SEARCH_WEIGHTS)
+        rows = db.executesql(
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH "
+            f"{db._adapter.adapt(match)} ORDER BY bm25({FTS_TABLE}, {weights}){limit_sql};"
+        )
+
+    elif db._dbname == "postgres":
+        query = " & ".join(f"{term}:*" for term in terms)
+        tsquery = f"to_tsquery('english', {db._adapter.adapt(query)})"
+        rows = db.executesql(
+            f"SELECT {db.projects._id._rname} FROM {db.projects._rname} "
+            f"WHERE {_tsvector(db)} @@ {tsquery} "
+            f"ORDER BY ts_rank({_tsvector(db)}, {tsquery}) DESC{limit_sql};"
+        )
+
+    else:
+        qry = db.projects.id > 0
+        for term in terms:
+            term_qry = db.projects[SEARCH_FIELDS[0]].contains(term)
+            for fld in SEARCH_FIELDS[1:]:
+                term_qry |= db.projects[fld].contains(term)
+            qry &= term_qry
+
+        rows = db(qry).select(
+            db.projects.id, limitby=None if limit is None else (0, limit)
+        )
+        rows = [(rw.id,) for rw in rows]
+
+    return [rw[0] for rw in rows]
+
+
+def ranked_orderby(ids):
+    """An orderby expression putting projects in the order of a list of ids"""
+
+    db = current.db
+
+    if not ids:
+        return None
+
+    cases = " ".join(f"WHEN {int(pid)} THEN {idx}" for idx, pid in enumerate(ids))
+
+    return Expression(db, f"CASE {db.projects._id._rname} {cases} END")
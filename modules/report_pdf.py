@@ -0,0 +1,261 @@
+## --------------------------------------------------------------------------------
+## REPORT PDF RENDERING
+## Renders marking reports to PDF from the plain dictionaries of report details
+## created by marking_functions.pdf_report_details, so that rendering needs no
+## database access. Parsing the fonts and logo is the slow part of creating a
+## report, so each process parses them once and copies them into each new PDF.
+##
+## Bulk downloads are rendered by a process pool that is created once per web2py
+## process and reused by later requests. The workers are started with the spawn
+## method, because forking the threaded server can copy locks held by other request
+## threads into the workers and deadlock them. Spawned workers import this module
+## by its full package name (applications.<app>.modules.report_pdf), so it must not
+## import gluon or any other application module. Small batches are rendered in the
+## request, where the cost of sending the details to the pool is not worth paying.
+## --------------------------------------------------------------------------------
+import copy
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import fpdf
+
+# Batches with fewer reports than this are rendered in the calling process
+POOL_MIN_REPORTS = 8
+
+# Parsed fonts and logo for this process
+_PDF_RESOURCES = {}
+
+# The process pool for bulk rendering and the arguments used to create it
+_POOL = None
+_POOL_ARGS = None
+_POOL_LOCK = threading.Lock()
+
+
+class ConfidentialPDF(fpdf.FPDF):
+    """Subclass of FPDF with a built in confidential page header"""
+
+    def header(self):
+        self.set_y(7)
+        self.set_font("Helvetica", size=12)
+        self.set_text_color(255, 40, 40)
+        self.cell(
+            0,
+            8,
+            txt="This is a confidential document and "
+            "must not be circulated to students.",
+            align="C",
+        )
+        self.set_xy(10, 20)
+
+
+def _load_pdf_resources(font_dir, logo_path):
+    """Parses the DejaVu fonts and the logo image into the process level cache."""
+
+    fpdf.set_global("SYSTEM_TTFONTS", font_dir)
+
+    pdf = fpdf.FPDF(format="A4")
+    pdf.add_font("DejaVu", "", "DejaVuSansCondensed.ttf", uni=True)
+    pdf.add_font("DejaVu", "B", "DejaVuSansCondensed-Bold.ttf", uni=True)
+    pdf.add_page()
+    pdf.image(logo_path, w=60)
+
+    _PDF_RESOURCES.clear()
+    _PDF_RESOURCES.update(
+        font_dir=font_dir,
+        logo_path=logo_path,
+        fonts=pdf.fonts,
+        font_files=pdf.font_files,
+        logo=pdf.images[logo_path],
+    )
+
+
+def _add_pdf_resources(pdf, font_dir, logo_path):
+    """
+    Adds the cached fonts and logo to a new PDF object. The character subset
+    of each font is modified as text is written, so that is copied for each
+    PDF rather than shared.
+    """
+
+    if (
+        _PDF_RESOURCES.get("font_dir") != font_dir
+        or _PDF_RESOURCES.get("logo_path") != logo_path
+    ):
+        _load_pdf_resources(font_dir, logo_path)
+
+    for key, font in _PDF_RESOURCES["fonts"].items():
+        pdf.fonts[key] = dict(font, subset=copy.deepcopy(font["subset"]))
+
+    for key, font_file in _PDF_RESOURCES["font_files"].items():
+        pdf.font_files[key] = dict(font_file)
+
+    pdf.images[logo_path] = dict(_PDF_RESOURCES["logo"])
+
+
+def pdf_filename(details):
+    """Gets the download file name for a report from the report details"""
+
+    return "{} {} {} {} {} {}.pdf".format(
+        details["course_presentation"],
+        details["academic_year"],
+        details["student_last_name"],
+        details["student_first_name"],
+        details["marker_role"],
+        details["id"],
+    )
+
+
+def render_pdf(details):
+    """
+    Renders a dictionary of report details into a simple PDF file using pyfpdf:
+    very simple, can't do styling or templating easily but no external dependencies
+    and reasonably fast. Returns a tuple of the PDF bytes and the file name.
+    """
+
+    confidential = details["confidential"]
+
+    if confidential:
+        pdf = ConfidentialPDF(format="A4")
+    else:
+        pdf = fpdf.FPDF(format="A4")
+
+    form_json = details["form_json"]
+
+    # set up the fonts and logo
+    _add_pdf_resources(pdf, details["font_dir"], details["logo_path"])
+
+    # add first page and insert the logo
+    pdf.set_top_margin(20)
+    pdf.add_page()
+    pdf.image(details["logo_path"], w=60)
+    logo_bottom = pdf.get_y()
+
+    # Title block
+    pdf.set_xy(80, 20)
+    pdf.set_font("DejaVu", style="B", size=14)
+    pdf.cell(0, 10, txt="Silwood Park Masters Courses", align="R", ln=1)
+    pdf.cell(0, 10, txt=form_json["pdftitle"], align="R", ln=1)
+    pdf.set_xy(10, logo_bottom + 10)
+    pdf.set_font("DejaVu", size=14)
+    pdf.set_text_color(0, 0, 0)
+
+    # ID table
+    label = ["Student", "CID", "Course Presentation", "Year", "Marker", "Marker Role"]
+    content = [
+        "student",
+        "student_cid",
+        "course_presentation",
+        "academic_year",
+        "marker",
+        "marker_role",
+    ]
+
+    for l, c in zip(label, content):
+        pdf.set_font("DejaVu", size=12, style="B")
+        pdf.cell(60, 8, txt=l, align="L")
+        pdf.set_font("DejaVu", size=12)
+        pdf.cell(0, 8, txt=str(details[c]), align="L", ln=1)
+
+    # add the questions in the order they appear in the JSON array
+    pdf.set_fill_color(200, 200, 200)
+
+    for q in form_json["questions"]:
+
+        # skip confidential questions if the report is not confidential
+        if not confidential and q["confidential"]:
+            continue
+
+        # insert the question title in a grey bar
+        pdf.rect(pdf.get_x(), pdf.get_y(), h=8, w=190, style="F")
+        pdf.set_font("DejaVu", size=12, style="B")
+        pdf.cell(0, 8, txt=q["title"], align="L", ln=1)
+
+        # insert the components
+        for c in q["components"]:
+
+            # skip confidential components if the report is not confidential
+            if not confidential and q["confidential"]:
+                continue
+
+            pdf.set_font("DejaVu", size=12, style="B")
+            pdf.cell(60, 8, txt=c["label"], align="L")
+            pdf.ln()
+            pdf.set_font("DejaVu", size=12)
+
+            if c["type"] == "query":
+                contents = details["queries"][c["query"]]
+            else:
+                contents = details["assignment_data"][c["variable"]]
+
+            if contents is None:
+                contents = ""
+            pdf.set_left_margin(70)
+            pdf.write(6, txt=contents)
+            pdf.set_left_margin(10)
+            pdf.ln()
+
+        # spacer
+        pdf.ln()
+
+    pdf.close()
+    pdf = pdf.output(dest="S").encode("latin-1")  # unicode string to bytes
+
+    return (pdf, pdf_filename(details))
+
+
+def _get_pool(n_workers, font_dir, logo_path):
+    """Returns the process pool, creating it if needed"""
+
+    global _POOL, _POOL_ARGS
+
+    args = (n_workers, font_dir, logo_path)
+
+    with _POOL_LOCK:
+        if _POOL is None or _POOL_ARGS != args:
+            if _POOL is not None:
+                _POOL.shutdown(wait=False)
+
+            _POOL = ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_load_pdf_resources,
+                initargs=(font_dir, logo_path),
+            )
+            _POOL_ARGS = args
+
+        return _POOL
+
+
+def _discard_pool(pool):
+    """Drops a broken pool, so that the next batch creates a new one"""
+
+    global _POOL
+
+    with _POOL_LOCK:
+        if _POOL is pool:
+            _POOL = None
+
+
+def render_pdfs(details, n_workers):
+    """
+    Renders a list of report details into (pdf, filename) tuples, in order. Batches
+    of at least POOL_MIN_REPORTS reports are rendered by the process pool when
+    n_workers is more than one. If the pool breaks, for example because a worker
+    was killed, the remaining reports are rendered in this process.
+    """
+
+    if n_workers < 2 or len(details) < POOL_MIN_REPORTS:
+        yield from map(render_pdf, details)
+        return
+
+    pool = _get_pool(n_workers, details[0]["font_dir"], details[0]["logo_path"])
+    n_done = 0
+
+    try:
+        for result in pool.map(render_pdf, details, chunksize=POOL_MIN_REPORTS):
+            yield result
+            n_done += 1
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        yield from map(render_pdf, details[n_done:])
@@ -1,32 +1,144 @@
 import re
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from office365.runtime.auth.user_credential import UserCredential
 from office365.sharepoint.client_context import ClientContext
 from gluon import current, BR, P, LI, UL, CAT
 
+# REGEX to extract CID from end of file name _########.pdf
+CID_REGEX = re.compile("(?<=_)[0-9]+(?=.pdf$)")
 
-def get_sharepoint_folder_contents(ctx, dir):
+
+def sharepoint_context():
+    """
+    Creates a ClientContext for the configured sharepoint site, using the
+    credentials of a college role user that has been given access to the site.
+    """
+
+    conf = current.configuration
+
+    tenant_name = conf.get("sharepoint.tenant_name")
+    site = conf.get("sharepoint.site")
+
+    user_credentials = UserCredential(
+        conf.get("email.imap_user"), conf.get("email.password")
+    )
+
+    return ClientContext(f"{tenant_name}/sites/{site}").with_credentials(
+        user_credentials
+    )
+
+
+def get_sharepoint_folder_contents(ctx, relative_url, list_files=True):
     """
-    Function to provide a dictionary of folders and files within a
-    sharepoint folder.
+    Function to provide a dictionary of folders and files within a sharepoint
+    folder, given its server relative url. The folders are returned as tuples
+    of the url and the last modified time and the files as dictionaries of file
+    properties. The file listing can be skipped for folders known to be
+    unchanged. Both requests are sent in a single round trip.
     """
 
+    folder = ctx.web.get_folder_by_server_relative_url(relative_url)
+
     # Get the sub-directories
-    subdirs = dir.folders
+    subdirs = folder.folders
     ctx.load(subdirs)
-    ctx.execute_query()
 
     # Get the files
-    files = dir.files
-    ctx.load(files)
+    if list_files:
+        files = folder.files
+        ctx.load(files)
+
     ctx.execute_query()
 
     return dict(
-        folders=[(sub.properties["ServerRelativeUrl"], sub) for sub in subdirs],
-        files=[(f.properties["Name"], f) for f in files],
+        folders=[
+            (sub.properties["ServerRelativeUrl"], sub.properties["TimeLastModified"])
+            for sub in subdirs
+        ],
+        files=[f.properties for f in files] if list_files else [],
+    )
+
+
+def list_sharepoint_tree(root_url, ctx_factory, watermarks, max_workers=4):
+    """Concurrently list a sharepoint folder tree
+
+    The folders are listed by a pool of threads, each using its own ClientContext
+    from ctx_factory. The files in a folder are only listed if its last modified
+    time differs from the value in the watermarks dictionary, keyed by folder url.
+    Note that a sharepoint folder's modified time does not change when files in
+    its subfolders change, so the whole folder tree is still walked.
+
+    Returns a dictionary of the modified times of all folders found, the set of
+    folders whose files were listed and a list of file properties.
+    """
+
+    local = threading.local()
+
+    def _list(url, list_files):
+        ctx = getattr(local, "ctx", None)
+        if ctx is None:
+            ctx = local.ctx = ctx_factory()
+
+        return get_sharepoint_folder_contents(ctx, url, list_files)
+
+    folders = {}
+    listed = {root_url}
+    files = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+
+        pending = {pool.submit(_list, root_url, True)}
+
+        while pending:
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                contents = future.result()
+                files.extend(contents["files"])
+
+                for url, modified in contents["folders"]:
+                    folders[url] = modified
+                    changed = watermarks.get(url) != modified
+
+                    if changed:
+                        listed.add(url)
+
+                    pending.add(pool.submit(_list, url, changed))
+
+    return dict(folders=folders, listed=listed, files=files)
+
+
+def _file_details(unique_id, filename, relative_url):
+    """
+    Extracts the details of a marking file from the sharepoint file name and url.
+    The files are expected to be structured within root_dir_relative_url as:
+        Presentation/Year/Role/File.pdf
+    because the file url is always relative to the account root, need to trim
+    down to the final 3 directories of the path name.
+    """
+
+    # Get the student CID
+    cid = CID_REGEX.search(filename)
+    if cid is not None:
+        cid = int(cid.group())
+
+    path = relative_url.split("/")
+
+    return dict(
+        unique_id=unique_id,
+        filename=filename,
+        cid=cid,
+        presentation=path[-4],
+        academic_year=path[-3],
+        marker_role=path[-2],
+        relative_url=relative_url,
     )
 
 
-def scan_files():
+def scan_files(ctx_factory=None, full=False):
     """Recursively scan files
 
     This function takes a configured document root directory on a sharepoint site and
@@ -45,87 +157,69 @@ def scan_files():
     look like.
 
         url = f"{tenant_name}/:t:/s/{site}/{cryptic_share_code}
+
+    The file listing is incremental but the folder walk is not: every folder in the
+    tree is still listed on each scan, because a folder's modified time does not
+    change when its subfolders change, but the files are only listed for folders that
+    have been modified since the last scan, unless full is True. Files in unchanged
+    folders are taken from the existing marking_files table, so that all files are
+    matched against the current students and roles. The scan therefore still takes
+    one request per folder and runs within the calling request. The ctx_factory
+    argument provides a function returning a ClientContext and defaults to
+    sharepoint_context. Returns the numbers of marking_files rows inserted, updated
+    and deleted.
     """
 
     # Get access to the db object
     db = current.db
 
-    # Get the configured sharepoint tenant, site and relative url
-    # and credentials for a college role user that has been given access
-    # to that relative URL.
-
     conf = current.configuration
 
-    tenant_name = conf.get("sharepoint.tenant_name")
-    site = conf.get("sharepoint.site")
-    root_dir_relative_url = conf.get("sharepoint.root_dir_relative_url")
-
-    user_credentials = UserCredential(
-        conf.get("email.imap_user"), conf.get("email.password")
-    )
+    if ctx_factory is None:
+        ctx_factory = sharepoint_context
 
-    # Connect to sharepoint
-    ctx = ClientContext(f"{tenant_name}/sites/{site}").with_credentials(
-        user_credentials
-    )
+    # Get the folder watermarks from the last scan
+    watermarks = {}
 
-    # Get the root directory
-    root = ctx.web.get_folder_by_server_relative_url(root_dir_relative_url)
+    if not full:
+        watermarks = {
+            rw.relative_url: rw.time_last_modified
+            for rw in db(db.sharepoint_folders).select()
+        }
 
-    # Scan the directory for files, until this list is emptied.
-    dir_filo = [("root", root)]
+    tree = list_sharepoint_tree(
+        conf.get("sharepoint.root_dir_relative_url"),
+        ctx_factory,
+        watermarks,
+        max_workers=conf.get("sharepoint.max_workers") or 4,
+    )
 
-    # Now iterate over the directory contents collecting dictionaries of file data
+    # Now collect dictionaries of file data
     file_data = []
 
-    # REGEX to extract CID from end of file name _########.pdf
-    cid_regex = re.compile("(?<=_)[0-9]+(?=.pdf$)")
-
-    while dir_filo:
-
-        # Get the first entry from the FILO for directories and scan it
-        this_dir = dir_filo.pop(0)
-        contents = get_sharepoint_folder_contents(ctx, this_dir[1])
+    for file_props in tree["files"]:
 
-        # Contents is a dictionary of folders and files, so add the folders onto the
-        # front of the directory FILO (depth first search)
-        dir_filo = contents["folders"] + dir_filo
+        # Can't see how to filter to only PDFs using the sharepoint API, so
+        # do it here.
+        if not file_props["Name"].endswith(".pdf"):
+            continue
 
-        # If there are any files, they are 2-tuples of (name,
-        # office365.sharepoint.files.file.File) which can be used to retrieve key
-        # information
-        for each_file in contents["files"]:
-
-            file_props = each_file[1].properties
-
-            # Can't see how to filter to only PDFs using the sharepoint API, so
-            # do it here.
-            if not file_props["Name"].endswith(".pdf"):
-                continue
-
-            # Get the student CID
-            cid = cid_regex.search(file_props["Name"])
-            if cid is not None:
-                cid = int(cid.group())
-
-            # The files are expected to be structured within root_dir_relative_url as:
-            #   Presentation/Year/Role/File.pdf
-            # because the file url is always relative to the account root, need to trim
-            # down to the final 3 directories of the path name
+        file_data.append(
+            _file_details(
+                file_props["UniqueId"],
+                file_props["Name"],
+                file_props["ServerRelativeUrl"],
+            )
+        )
 
-            path = file_props["ServerRelativeUrl"].split("/")
+    # Add the existing records for files in folders that were not listed
+    existing = {rw["unique_id"]: rw for rw in db(db.marking_files).select().as_list()}
 
+    for rw in existing.values():
+        folder = rw["relative_url"].rsplit("/", 1)[0]
+        if folder in tree["folders"] and folder not in tree["listed"]:
             file_data.append(
-                dict(
-                    unique_id=file_props["UniqueId"],
-                    filename=file_props["Name"],
-                    filesize=file_props["Length"],
-                    cid=cid,
-                    presentation=path[-4],
-                    academic_year=path[-3],
-                    marker_role=path[-2],
-                    relative_url=file_props["ServerRelativeUrl"],
-                )
+                _file_details(rw["unique_id"], rw["filename"], rw["relative_url"])
             )
 
     # Now do checking on the results: Load presentations, marker roles and student ids,
@@ -155,12 +249,10 @@ def scan_files():
         for dt in student_presentations
     }
 
-    # Insert what is available
-    for this_file in file_data:
+    # Match the files and reduce them to records of the table fields
+    records = []
 
-        this_path = "{presentation}/{academic_year}/{marker_role}/{filename}".format(
-            **this_file
-        )
+    for this_file in file_data:
 
         # Lookup ID numbers of presentation, role and student in
         this_file["course_presentation_id"] = presentation_lookup.get(
@@ -205,14 +297,84 @@ def scan_files():
                 "Combination of student, year and course presentation not found"
             )
 
-        this_file["matching_issues"] = ','.join(these_problems)
+        this_file["matching_issues"] = ",".join(these_problems)
 
-        db.marking_files.update_or_insert(
-            db.marking_files.unique_id == this_file["unique_id"], **this_file
-        )
+        records.append(db.marking_files._filter_fields(this_file))
+
+    changes = reconcile_marking_files(records, existing)
+
+    # Update the watermarks
+    db(db.sharepoint_folders).delete()
+    db.sharepoint_folders.bulk_insert(
+        [
+            dict(relative_url=url, time_last_modified=modified)
+            for url, modified in tree["folders"].items()
+        ]
+    )
 
     db.commit()
 
+    return changes
+
+
+def reconcile_marking_files(records, existing, batch_size=500):
+    """Reconcile the marking_files table with the scanned files
+
+    This takes a list of records of the marking_files fields for every file found in
+    the scan and a dictionary of the existing rows, as dictionaries keyed by
+    unique_id. The inserts, updates and deletes are found by comparing the sets of
+    unique ids and the changes are then applied in batches. Rows for files that are
+    no longer in Sharepoint are deleted. Changed rows are updated in place, grouping
+    rows with the same changed values into a single UPDATE, since rescans usually
+    make the same change to many files. The changes are not committed, so they are
+    applied in a single transaction with the rest of the scan. Returns a dictionary
+    of the number of changes.
+    """
+
+    db = current.db
+
+    records = {rec["unique_id"]: rec for rec in records}
+
+    new_keys = records.keys() - existing.keys()
+    gone_keys = existing.keys() - records.keys()
+    changed_keys = {
+        ky
+        for ky in records.keys() & existing.keys()
+        if any(existing[ky][fld] != val for fld, val in records[ky].items())
+    }
+
+    delete_ids = [existing[ky]["id"] for ky in gone_keys]
+
+    for idx in range(0, len(delete_ids), batch_size):
+        db(db.marking_files.id.belongs(delete_ids[idx : idx + batch_size])).delete()
+
+    # Group the changed rows by the values that have changed
+    updates = defaultdict(list)
+    for ky in changed_keys:
+        changes = tuple(
+            sorted(
+                (fld, val)
+                for fld, val in records[ky].items()
+                if existing[ky][fld] != val
+            )
+        )
+        updates[changes].append(existing[ky]["id"])
+
+    for changes, update_ids in updates.items():
+        for idx in range(0, len(update_ids), batch_size):
+            db(db.marking_files.id.belongs(update_ids[idx : idx + batch_size])).update(
+                **dict(changes)
+            )
+
+    inserts = [records[ky] for ky in new_keys]
+
+    for idx in range(0, len(inserts), batch_size):
+        db.marking_files.bulk_insert(inserts[idx : idx + batch_size])
+
+    return dict(
+        inserted=len(new_keys), updated=len(changed_keys), deleted=len(gone_keys)
+    )
+
 
 def download_url(record):
     """
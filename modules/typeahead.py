@@ -0,0 +1,349 @@
+## --------------------------------------------------------------------------------
+## TYPEAHEAD SEARCH FOR STUDENT AND STAFF FIELDS
+## The forms for projects and marking assignments need to pick students and staff.
+## Drop down menus of every option are slow to build, because each student label
+## needs the student and course presentation records, and long to scroll through.
+## Instead, those fields use a typeahead widget that searches for matches as the
+## user types.
+##
+## The searches use an in memory index of the labels and search keys for each
+## source, which is built from a single joined query. The index is rebuilt when the
+## change counters for the underlying tables are incremented by the table callbacks
+## (see modules/page_cache.py), so edits are picked up by every process.
+## --------------------------------------------------------------------------------
+import re
+import threading
+from bisect import bisect_left
+
+from gluon import current, URL, DIV, SPAN, INPUT, SELECT, OPTION, UL, LI, A
+from page_cache import bump_counters, STAFF_COUNTER
+
+# Change counter names for each source. The staff counter is also used by the page
+# cache for pages showing supervisor details.
+COUNTERS = {
+    "students": "students",
+    "staff": STAFF_COUNTER,
+}
+
+# Tables whose changes alter the labels or keys of each source
+SOURCE_TABLES = {
+    "students": ["students", "student_presentations", "course_presentations"],
+    "staff": ["teaching_staff"],
+}
+
+# Search indexes keyed by (source, academic year)
+_INDEXES = {}
+_INDEX_LOCK = threading.Lock()
+
+
+def _normalise(text):
+    """Reduces text to lower case words separated by single spaces"""
+
+    return " ".join(re.findall(r"\w+", str(text or "").lower()))
+
+
+def setup_typeahead_counters(db):
+    """Registers callbacks that record changes to the tables for each source"""
+
+    for source, table_names in SOURCE_TABLES.items():
+        for table_name in table_names:
+            table = db[table_name]
+            changed = lambda source=source: source_changed(source)
+            table._after_insert.append(lambda fields, id, changed=changed: changed())
+            table._after_update.append(lambda dbset, fields, changed=changed: changed())
+            table._before_delete.append(lambda dbset, changed=changed: changed())
+
+
+def source_changed(source):
+    """Records a change to the tables used by a source
+
+    The insert callbacks run for every row of a bulk insert, so the change counter
+    is only incremented by the first change in each request. Other processes cannot
+    see the new counter value until the request commits, when all of its changes
+    are visible. This process drops its own indexes for the source on every change.
+    """
+
+    with _INDEX_LOCK:
+        for key in [ky for ky in _INDEXES if ky[0] == source]:
+            del _INDEXES[key]
+
+    request = current.request
+    if request._typeahead_changed is None:
+        request._typeahead_changed = set()
+
+    if source not in request._typeahead_changed:
+        bump_counters([COUNTERS[source]])
+        request._typeahead_changed.add(source)
+
+
+def _student_rows(dbset):
+    """Selects student presentations with the student and presentation details"""
+
+    db = current.db
+
+    return dbset(
+        (db.student_presentations.student == db.students.id)
+        & (db.student_presentations.course_presentation == db.course_presentations.id)
+    ).select(
+        db.student_presentations.id,
+        db.students.student_first_name,
+        db.students.student_last_name,
+        db.students.student_cid,
+        db.students.student_email,
+        db.course_presentations.name,
+    )
+
+
+def _student_entry(row):
+    """Returns the id, label and search keys for a student presentation row"""
+
+    first = row.students.student_first_name
+    last = row.students.student_last_name
+    label = f"{last}, {first} ({row.course_presentations.name})"
+    keys = [
+        last,
+        first,
+        f"{first} {last}",
+        f"{last} {first}",
+        row.students.student_cid,
+        row.students.student_email,
+    ]
+
+    return row.student_presentations.id, label, keys
+
+
+def _staff_rows(dbset):
+    """Selects the teaching staff details"""
+
+    db = current.db
+
+    return dbset.select(
+        db.teaching_staff.id,
+        db.teaching_staff.first_name,
+        db.teaching_staff.last_name,
+        db.teaching_staff.email,
+        db.teaching_staff.is_internal,
+    )
+
+
+def _staff_entry(row):
+    """Returns the id, label and search keys for a teaching staff row"""
+
+    label = f"{row.last_name}, {row.first_name} ({row.email})"
+    keys = [
+        row.last_name,
+        row.first_name,
+        f"{row.first_name} {row.last_name}",
+        f"{row.last_name} {row.first_name}",
+        row.email,
+    ]
+
+    return row.id, label, keys
+
+
+def _build_index(source, year):
+    """Builds the search index for a source from a single query"""
+
+    db = current.db
+
+    if source == "students":
+        rows = _student_rows(db(db.student_presentations.academic_year == year))
+        entries = [_student_entry(rw) for rw in rows]
+        internal = set()
+    else:
+        # The teaching_staff common filter restricts this to active staff
+        rows = _staff_rows(db(db.teaching_staff))
+        entries = [_staff_entry(rw) for rw in rows]
+        internal = {rw.id for rw in rows if rw.is_internal}
+
+    keys = sorted(
+        {(_normalise(key), rid) for rid, _, row_keys in entries for key in row_keys}
+    )
+
+    return dict(
+        keys=[ky for ky in keys if ky[0]],
+        labels={rid: label for rid, label, _ in entries},
+        internal=internal,
+    )
+
+
+def _get_index(source, year=None):
+    """Returns the search index for a source, rebuilding it if the underlying
+    tables have changed"""
+
+    db = current.db
+
+    counter = db(db.cache_counters.name == COUNTERS[source]).select(
+        db.cache_counters.counter
+    ).first()
+    counter = 0 if counter is None else counter.counter
+
+    key = (source, year)
+
+    with _INDEX_LOCK:
+        cached = _INDEXES.get(key)
+
+    if cached is not None and cached[0] == counter:
+        return cached[1]
+
+    index = _build_index(source, year)
+
+    with _INDEX_LOCK:
+        _INDEXES[key] = (counter, index)
+
+    return index
+
+
+def search(source, term, year=None, internal_only=False, unassigned=False, limit=20):
+    """Searches a source for records with a search key starting with a term
+
+    The student source searches the student presentations for an academic year, and
+    can be restricted to the students that have not been assigned a project. The
+    staff source searches active staff and can be restricted to internal staff.
+
+    Returns a list of dictionaries giving the id and label of the matches, sorted
+    by label.
+    """
+
+    if source not in COUNTERS:
+        raise ValueError(f"Unknown typeahead source: {source}")
+
+    term = _normalise(term)
+
+    if not term:
+        return []
+
+    index = _get_index(source, year)
+    keys = index["keys"]
+
+    ids = set()
+    idx = bisect_left(keys, (term,))
+    while idx < len(keys) and keys[idx][0].startswith(term):
+        ids.add(keys[idx][1])
+        idx += 1
+
+    if internal_only:
+        ids &= index["internal"]
+
+    if unassigned and ids:
+        db = current.db
+        assigned = db(db.projects.project_student.belongs(ids)).select(
+            db.projects.project_student
+        )
+        ids -= {rw.project_student for rw in assigned}
+
+    labels = index["labels"]
+    results = sorted(ids, key=lambda rid: labels[rid].lower())
+
+    return [dict(id=rid, label=labels[rid]) for rid in results[:limit]]
+
+
+def labels_for(source, ids):
+    """Gets the labels for a set of record ids from a source using a single query
+
+    Labels are found for inactive staff, so that existing values are still shown.
+    Returns a dictionary of ids to labels.
+    """
+
+    db = current.db
+
+    ids = [int(i) for i in ids if str(i).isdigit()]
+
+    if not ids:
+        return {}
+
+    if source == "students":
+        rows = _student_rows(db(db.student_presentations.id.belongs(ids)))
+        entries = [_student_entry(rw) for rw in rows]
+    else:
+        rows = _staff_rows(
+            db(db.teaching_staff.id.belongs(ids), ignore_common_filters=True)
+        )
+        entries = [_staff_entry(rw) for rw in rows]
+
+    return {rid: label for rid, label, _ in entries}
+
+
+def typeahead_widget(source, placeholder="Start typing to search", **search_vars):
+    """Creates a form widget that uses the typeahead service to pick records
+
+    The selected values are held in a hidden select, so the field validators work
+    as normal, and labels are only loaded for the selected values. The search_vars
+    are passed to the search and set the academic year and any restrictions. The
+    page needs to include static/js/typeahead.js.
+    """
+
+    def widget(field, value, **attributes):
+
+        request = current.request
+        multiple = field.type.startswith("list:")
+
+        # Show the submitted values when a form is redisplayed with errors
+        if request.post_vars:
+            value = request.post_vars.get(field.name)
+
+        if value is None:
+            values = []
+        elif isinstance(value, (list, tuple)):
+            values = list(value)
+        else:
+            values = [value]
+
+        labels = labels_for(source, values)
+        values = [int(v) for v in values if str(v).isdigit() and int(v) in labels]
+
+        options = [OPTION(labels[v], _value=v, _selected="selected") for v in values]
+
+        if not multiple:
+            options.insert(0, OPTION("", _value=""))
+
+        select = SELECT(
+            *options,
+            _name=field.name,
+            _id=f"{field._tablename}_{field.name}",
+            _multiple="multiple" if multiple else None,
+            _style="display:none;",
+            requires=field.requires,
+            hideerror=False,
+        )
+
+        text = INPUT(
+            _type="text",
+            _class="form-control typeahead-input",
+            _placeholder=placeholder,
+            _autocomplete="off",
+            _value="" if multiple or not values else labels[values[0]],
+        )
+
+        if multiple:
+            selected = UL(
+                *[
+                    LI(
+                        labels[v],
+                        A(
+                            SPAN("×", _class="ml-2"),
+                            _href="#",
+                            _class="typeahead-remove",
+                            **{"_data-value": v},
+                        ),
+                        _class="list-group-item py-1",
+                    )
+                    for v in values
+                ],
+                _class="list-group typeahead-selected mb-2",
+            )
+        else:
+            selected = ""
+
+        url = URL("projects", "typeahead", vars=dict(source=source, **search_vars))
+
+        return DIV(
+            selected,
+            text,
+            DIV(_class="dropdown-menu typeahead-menu"),
+            select,
+            _class="typeahead dropdown",
+            **{"_data-url": url},
+        )
+
+    return widget
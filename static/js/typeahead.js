@@ -0,0 +1,93 @@
+// Typeahead widgets for picking students and staff (see modules/typeahead.py).
+// Each widget has a text input for the search, a dropdown menu of matches and a
+// hidden select holding the chosen values, which is what the form submits. Widgets
+// for multiple values also show a list of the chosen values with remove links.
+
+$(function () {
+    $('.typeahead').each(function () {
+        var widget = $(this);
+        var input = widget.find('.typeahead-input');
+        var menu = widget.find('.typeahead-menu');
+        var select = widget.find('select');
+        var selected = widget.find('.typeahead-selected');
+        var multiple = select.prop('multiple');
+        var url = widget.data('url');
+        var timer = null;
+        var request = null;
+
+        function choose(id, label) {
+            if (multiple) {
+                if (select.find('option[value="' + id + '"]').length === 0) {
+                    select.append($('<option>', {value: id, selected: true}).text(label));
+                    selected.append(
+                        $('<li class="list-group-item py-1">').text(label).append(
+                            $('<a href="#" class="typeahead-remove">')
+                                .attr('data-value', id)
+                                .append('<span class="ml-2">&times;</span>')
+                        )
+                    );
+                }
+                input.val('');
+            } else {
+                select.empty()
+                    .append($('<option>', {value: ''}))
+                    .append($('<option>', {value: id, selected: true}).text(label));
+                input.val(label);
+            }
+            menu.removeClass('show').empty();
+        }
+
+        function show(results) {
+            menu.empty();
+            if (results.length === 0) {
+                menu.append($('<span class="dropdown-item-text text-muted">').text('No matches'));
+            }
+            $.each(results, function (idx, result) {
+                $('<a href="#" class="dropdown-item">')
+                    .text(result.label)
+                    .on('mousedown', function (event) {
+                        event.preventDefault();
+                        choose(result.id, result.label);
+                    })
+                    .appendTo(menu);
+            });
+            menu.addClass('show');
+        }
+
+        input.on('input', function () {
+            var term = input.val().trim();
+
+            clearTimeout(timer);
+
+            // Clearing a single value field removes the selection
+            if (!multiple && term === '') {
+                select.val('');
+            }
+
+            if (term.length < 2) {
+                menu.removeClass('show').empty();
+                return;
+            }
+
+            timer = setTimeout(function () {
+                if (request !== null) {
+                    request.abort();
+                }
+                request = $.getJSON(url, {term: term}, function (data) {
+                    show(data.results);
+                });
+            }, 200);
+        });
+
+        input.on('blur', function () {
+            menu.removeClass('show');
+        });
+
+        selected.on('click', '.typeahead-remove', function (event) {
+            event.preventDefault();
+            var id = $(this).attr('data-value');
+            select.find('option[value="' + id + '"]').remove();
+            $(this).closest('li').remove();
+        });
+    });
+});
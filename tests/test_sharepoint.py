@@ -0,0 +1,247 @@
+## --------------------------------------------------------------------------------
+## SHAREPOINT SCAN TESTS
+## Tests of modules/sharepoint.py scan_files, using a fake ClientContext serving a
+## folder tree held in memory and an in memory SQLite database holding just the
+## tables used by the scan. Run from the web2py folder with:
+##
+##   python web2py.py -S marking_reports -R applications/marking_reports/tests/test_sharepoint.py
+## --------------------------------------------------------------------------------
+import unittest
+
+from gluon import current
+from pydal import DAL, Field
+
+from sharepoint import scan_files
+
+ROOT = "/sites/marking/Shared Documents/Reports"
+
+
+class FakeItem:
+    """A sharepoint folder or file, with its properties"""
+
+    def __init__(self, properties):
+        self.properties = properties
+
+
+class FakeItemList(list):
+    """The folders or files collection of a folder"""
+
+    def __init__(self, url, kind, items):
+        super().__init__(items)
+        self.url = url
+        self.kind = kind
+
+
+class FakeFolder:
+    def __init__(self, tree, url):
+        children = [
+            fld
+            for fld in tree
+            if fld.rsplit("/", 1)[0] == url and fld != url
+        ]
+
+        self.folders = FakeItemList(
+            url,
+            "folders",
+            [
+                FakeItem(
+                    {
+                        "ServerRelativeUrl": fld,
+                        "TimeLastModified": tree[fld]["modified"],
+                    }
+                )
+                for fld in sorted(children)
+            ],
+        )
+
+        self.files = FakeItemList(
+            url,
+            "files",
+            [
+                FakeItem(
+                    {
+                        "UniqueId": uid,
+                        "Name": name,
+                        "ServerRelativeUrl": f"{url}/{name}",
+                    }
+                )
+                for uid, name in tree[url]["files"]
+            ],
+        )
+
+
+class FakeWeb:
+    def __init__(self, tree):
+        self.tree = tree
+
+    def get_folder_by_server_relative_url(self, url):
+        return FakeFolder(self.tree, url)
+
+
+class FakeContext:
+    """Implements the parts of ClientContext used by the scan, recording the
+    folders whose files are loaded"""
+
+    def __init__(self, tree, file_loads):
+        self.web = FakeWeb(tree)
+        self.file_loads = file_loads
+
+    def load(self, items):
+        if items.kind == "files":
+            self.file_loads.append(items.url)
+
+    def execute_query(self):
+        pass
+
+
+class ScanFilesTest(unittest.TestCase):
+    def setUp(self):
+
+        self._current = {
+            ky: getattr(current, ky, None) for ky in ("db", "configuration")
+        }
+
+        db = DAL("sqlite:memory")
+
+        db.define_table("course_presentations", Field("name", "string"))
+        db.define_table("marking_roles", Field("name", "string"))
+        db.define_table("students", Field("student_cid", "integer"))
+        db.define_table(
+            "student_presentations",
+            Field("student", "reference students"),
+            Field("academic_year", "integer"),
+            Field("course_presentation", "reference course_presentations"),
+        )
+        db.define_table(
+            "marking_files",
+            Field("unique_id", length=64),
+            Field("filename", "string"),
+            Field("relative_url", "string"),
+            Field("marker_role_id", "reference marking_roles"),
+            Field("student", "reference student_presentations"),
+            Field("matching_issues", "string"),
+        )
+        db.define_table(
+            "sharepoint_folders",
+            Field("relative_url", "string"),
+            Field("time_last_modified", "string"),
+        )
+
+        pres = db.course_presentations.insert(name="EEC MSc")
+        db.marking_roles.insert(name="Marker")
+        db.marking_roles.insert(name="Supervisor")
+
+        for cid in (1001, 1002, 1003):
+            student = db.students.insert(student_cid=cid)
+            db.student_presentations.insert(
+                student=student, academic_year=2021, course_presentation=pres
+            )
+
+        current.db = db
+        current.configuration = {
+            "sharepoint.root_dir_relative_url": ROOT,
+            "sharepoint.max_workers": 2,
+        }
+
+        self.db = db
+        self.year = f"{ROOT}/EEC_MSc/2021"
+        self.marker = f"{self.year}/Marker"
+        self.supervisor = f"{self.year}/Supervisor"
+
+        self.tree = {
+            ROOT: dict(modified="t1", files=[]),
+            f"{ROOT}/EEC_MSc": dict(modified="t1", files=[]),
+            self.year: dict(modified="t1", files=[]),
+            self.marker: dict(
+                modified="t1",
+                files=[("m1", "Smith_1001.pdf"), ("m2", "Jones_1002.pdf")],
+            ),
+            self.supervisor: dict(
+                modified="t1",
+                files=[("s1", "Smith_1001.pdf"), ("s2", "notes.txt")],
+            ),
+        }
+
+        self.file_loads = []
+
+    def tearDown(self):
+        self.db.close()
+
+        for ky, val in self._current.items():
+            setattr(current, ky, val)
+
+    def scan(self, **kwargs):
+        """Runs scan_files with fake contexts, recording the folders whose files
+        are listed"""
+
+        self.file_loads.clear()
+
+        return scan_files(
+            ctx_factory=lambda: FakeContext(self.tree, self.file_loads), **kwargs
+        )
+
+    def files(self):
+        rows = self.db(self.db.marking_files).select()
+        return {rw.unique_id: rw for rw in rows}
+
+    def test_first_scan(self):
+
+        changes = self.scan()
+
+        self.assertEqual(changes, dict(inserted=3, updated=0, deleted=0))
+        self.assertEqual(set(self.file_loads), set(self.tree))
+
+        files = self.files()
+        self.assertEqual(set(files), {"m1", "m2", "s1"})
+        self.assertEqual(files["m1"].matching_issues, "")
+
+        watermarks = self.db(self.db.sharepoint_folders).select()
+        self.assertEqual(
+            {rw.relative_url: rw.time_last_modified for rw in watermarks},
+            {url: "t1" for url in self.tree if url != ROOT},
+        )
+
+    def test_incremental_scan(self):
+
+        self.scan()
+
+        # Change the Marker folder: rename one file, remove one and add one
+        self.tree[self.marker] = dict(
+            modified="t2",
+            files=[("m1", "Smith_1003.pdf"), ("m3", "Brown_1003.pdf")],
+        )
+
+        # Files in the unchanged Supervisor folder are not listed again, so a file
+        # that appears without the folder modified time changing is not found.
+        self.tree[self.supervisor]["files"].append(("s3", "Jones_1002.pdf"))
+
+        changes = self.scan()
+
+        self.assertEqual(changes, dict(inserted=1, updated=1, deleted=1))
+
+        # Only the root and the changed folder have their files listed
+        self.assertEqual(set(self.file_loads), {ROOT, self.marker})
+
+        # The rows for the unlisted folder are kept
+        files = self.files()
+        self.assertEqual(set(files), {"m1", "m3", "s1"})
+        self.assertEqual(files["m1"].filename, "Smith_1003.pdf")
+
+        # A full scan lists every folder and finds the new file
+        changes = self.scan(full=True)
+
+        self.assertEqual(changes, dict(inserted=1, updated=0, deleted=0))
+        self.assertEqual(set(self.file_loads), set(self.tree))
+        self.assertIn("s3", self.files())
+
+    def test_unchanged_scan(self):
+
+        self.scan()
+        changes = self.scan()
+
+        self.assertEqual(changes, dict(inserted=0, updated=0, deleted=0))
+        self.assertEqual(self.file_loads, [ROOT])
+
+
+if __name__ == "__main__":
+    unittest.main(argv=["test_sharepoint"], exit=False)